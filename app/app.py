@@ -1,27 +1,63 @@
 from fastapi import FastAPI, Response, Query, HTTPException
-from fastapi.params import Cookie, Depends, Form
-from collections import defaultdict
+from fastapi.params import Cookie, Depends, Form, Header
+import arrow
+import csv
+import hmac
+import io
+import json
+import threading
 from fastapi import status
 import jinja2
 from fastapi.templating import Jinja2Templates
-from pydantic import BaseModel
+from pydantic import BaseModel, conint
 from fastapi.staticfiles import StaticFiles
 from starlette.datastructures import FormData
 from starlette.requests import Request
-from starlette.responses import RedirectResponse
-from starlette.status import HTTP_412_PRECONDITION_FAILED
+from starlette.concurrency import run_in_threadpool
+from starlette.responses import FileResponse, PlainTextResponse, RedirectResponse, StreamingResponse
+from starlette.status import HTTP_400_BAD_REQUEST, HTTP_401_UNAUTHORIZED, HTTP_403_FORBIDDEN, HTTP_404_NOT_FOUND, HTTP_412_PRECONDITION_FAILED
 from .models import *
 from fastapi.staticfiles import StaticFiles
-from typing import DefaultDict, Literal, Optional, overload
-
-from .db import Database, UserAlreadyExists
+from dataclasses import asdict
+from datetime import date
+from typing import AsyncIterator, DefaultDict, Dict, Iterable, List, Literal, Optional, Sequence, Tuple, overload
+
+from .db import (Database, CartPincodeMismatch, UserAlreadyExists, SHOPS_PER_PAGE, ORDERS_PER_PAGE, SHOP_ORDERS_PER_PAGE,
+	SEARCH_PER_PAGE, SEARCH_SHOPS_PER_ITEM, HISTORY_STATUSES, MAX_CART_DELTA)
+from .async_db import AsyncDatabase
+from .write_behind import WriteBehindConfig
+from .settings import Settings
+from .fragments import FragmentCache, precompile
+from .http_cache import AssetStore, IMMUTABLE, PAGE_PRIVATE, PAGE_PUBLIC, REVALIDATE, etag_matches, not_modified, page_etag, with_validators
+from .images import ImagePipeline, MEDIA_TYPES, WIDTHS
+from .metrics import REGISTRY, SamplingProfiler
+from .http_metrics import MetricsMiddleware, TimedTemplate
 
 templates = Jinja2Templates("templates")
 app = FastAPI()
 # app.mount("/static", StaticFiles(directory="static"), name="static")
-DEBUG = True
-
-db = Database("rental.json")
+settings = Settings.from_env()
+DEBUG = settings.debug
+# per-request storage/parse/render timings: `Server-Timing` on every response and totals on `/metrics`
+profiler = SamplingProfiler(settings.profile_slow_ms / 1000, settings.profile_dir) if settings.profile_slow_ms else None
+app.add_middleware(MetricsMiddleware, profiler=profiler)
+templates.env.template_class = TimedTemplate
+# compiled templates survive restarts, and outside DEBUG their sources aren't re-checked on every render
+templates.env.bytecode_cache = jinja2.FileSystemBytecodeCache()
+templates.env.auto_reload = DEBUG
+fragments = FragmentCache(templates.env)
+# images and other files are linked through `asset_url`, which puts their content hash in the url
+assets = AssetStore(["rental", "static"])
+templates.env.globals["asset_url"] = assets.url
+# item images also come resized and as webp/avif (when Pillow is installed), see `/images/...`
+images = ImagePipeline(assets)
+templates.env.globals["image_url"] = images.url
+templates.env.globals["image_srcset"] = images.srcset
+
+# write-behind keeps the data in this process, so it's only used when running a single worker
+db = Database(settings.db_path, session_max_age=settings.session_ttl,
+	write_behind=None if settings.shared else WriteBehindConfig(), shared=settings.shared)
+adb = AsyncDatabase(db)
 
 DEFAULT_PIN_CODE = "332404"
 
@@ -40,7 +76,7 @@ async def exception_handler(request: Request, exc: RequiresLoginException) -> Re
 class UserDepends:
 	required: bool = False
 
-	def __call__(self, token: Optional[str] = Cookie(None)) -> Optional[User]:
+	async def __call__(self, token: Optional[str] = Cookie(None)) -> Optional[User]:
 		def not_logged_action():
 			if self.required:
 				raise RequiresLoginException()
@@ -49,7 +85,7 @@ class UserDepends:
 
 		if token is None:
 			return not_logged_action()
-		user = db.get_logged_in_user(token)
+		user = await adb.get_logged_in_user(token)
 		if user is None:
 			return not_logged_action()
 		return user
@@ -58,26 +94,26 @@ class AddressId(BaseModel):
 	address_id: int
 
 @app.get("/")
-def home_page(request: Request, user: Optional[User] = Depends(UserDepends(False))):
+async def home_page(request: Request, user: Optional[User] = Depends(UserDepends(False))):
 	return templates.TemplateResponse("home_page.html", {"request": request, "user": user})
 
 
 @app.get("/login_page")
-def get_login_page(request: Request, user: Optional[User] = Depends(UserDepends(False))):
+async def get_login_page(request: Request, user: Optional[User] = Depends(UserDepends(False))):
 	if user is not None: # already logged in
 		return RedirectResponse("/")
 	return templates.TemplateResponse("login_page.html", {"request": request})
 
 
 @app.get("/sign_up")
-def get_singup_page(request: Request, user: Optional[User] = Depends(UserDepends(False))):
+async def get_singup_page(request: Request, user: Optional[User] = Depends(UserDepends(False))):
 	if user is not None: # already logged in
 		return RedirectResponse("/")
 	return templates.TemplateResponse("signup_page.html", {"request": request})
 
 
 @app.post("/do_sign_up")
-def do_signup(
+async def do_signup(
 	request: Request,
 	first_name: str = Form(...),
 	last_name: str = Form(...),
@@ -93,10 +129,10 @@ def do_signup(
 			}
 		)
 	try:
-		db.new_user(first_name, last_name, email, password)
+		await adb.new_user(first_name, last_name, email, password)
 		resp = RedirectResponse("/", status_code=status.HTTP_303_SEE_OTHER)
-		user = db.get_user(email, password)
-		session = db.create_session(user.id)
+		user = await adb.get_user(email, password)
+		session = await adb.create_session(user.id)
 		resp.set_cookie("token", session.token)
 		return resp
 	except UserAlreadyExists:
@@ -104,64 +140,82 @@ def do_signup(
 
 
 @app.get("/logout")
-def logout(request: Request, user: User = Depends(UserDepends(True)), token: str = Cookie(None)):
-	db.logout_session(token)
+async def logout(request: Request, user: User = Depends(UserDepends(True)), token: str = Cookie(None)):
+	await adb.logout_session(token)
 	return RedirectResponse("/")
 
 
 def is_valid(pin_code: str):
-	return len(pin_code) == 6
+	return len(pin_code) == 6 and pin_code.isdigit()
 
 
 @app.get("/shops/")
 @app.get("/shops/{pin_code}")
-def get_shops(request: Request, pin_code: str = DEFAULT_PIN_CODE, page_no: int = Query(0), user: Optional[User] = Depends(UserDepends(False))):
+async def get_shops(request: Request, pin_code: str = DEFAULT_PIN_CODE, page_no: int = Query(0), user: Optional[User] = Depends(UserDepends(False))):
 	error = None
 	if not is_valid(pin_code):
 		error = f"pin_code: {pin_code} not valid"
-	shops = db.get_shops(int(pin_code))
-
-	return templates.TemplateResponse(
+	page_no = max(page_no, 0)
+	version = await adb.current_catalog_version()
+	etag = page_etag("shops", version, pin_code, page_no, user.id if user else None)
+	cache_control = PAGE_PRIVATE if user else PAGE_PUBLIC
+	if etag_matches(request, etag):
+		return not_modified(etag, cache_control)
+	catalog = None
+	if error is None:
+		key = ("shops", int(pin_code), page_no)
+		fragment = fragments.get(key, version)
+		if fragment is None:
+			shops = await adb.get_shops(int(pin_code), page_no)
+			has_next_page = (page_no + 1) * SHOPS_PER_PAGE < await adb.count_shops(int(pin_code))
+			fragment = fragments.render("fragments/shop_catalog.html", key, version, {
+				"shops": shops,
+				"pin_code": pin_code,
+				"page_no": page_no,
+				"has_next_page": has_next_page,
+			})
+		catalog = fragment.fill()
+
+	return with_validators(templates.TemplateResponse(
 		"shop_list.html", {
 			"request": request,
 			"error": error,
-			"shops": shops,
+			"catalog": catalog,
 			"invalid_pin_code": error is not None,
 			"user": user
 		}
-	)
+	), etag, cache_control)
 
 @app.get("/see_shops")
-def see_shops_form(request: Request, pincode: str):
+async def see_shops_form(request: Request, pincode: str):
 	return RedirectResponse("/shops/" + pincode)
 
 @app.get("/items/{shop_id}")
-def get_items(request: Request, shop_id: int, page_no: int = Query(0), user: Optional[User] = Depends(UserDepends(True))):
+async def get_items(request: Request, shop_id: int, page_no: int = Query(0), user: Optional[User] = Depends(UserDepends(True))):
 	error = None
-	shop = db.get_shop(shop_id)
-	assert shop is not None
-
-	items = db.get_items(shop)
-	item_ids = {i.id for i in items}
-	orders = db.get_user_orders(user.id)
-	counts = defaultdict(int)
-	for o in orders:
-		if o.status != OrderStatus.Cart or o.shop_id != shop_id:
-			continue
-		if o.item_id in item_ids:
-			counts[o.item_id] += o.quantity
-
-
-	return templates.TemplateResponse(
+	version = await adb.current_catalog_version()
+	counts = (await adb.get_cart(user.id)).shop_counts(shop_id)
+	etag = page_etag("items", version, shop_id, user.id, sorted(counts.items()))
+	if etag_matches(request, etag):
+		return not_modified(etag, PAGE_PRIVATE)
+	key = ("items", shop_id)
+	fragment = fragments.get(key, version)
+	if fragment is None:
+		shop = await adb.get_shop(shop_id)
+		assert shop is not None
+		items = await adb.get_items(shop)
+		fragment = fragments.render("fragments/item_catalog.html", key, version, {"shop": shop, "items": items})
+
+	return with_validators(templates.TemplateResponse(
 		"item_list.html", {
 			"request": request,
 			"error": error,
-			"items": items,
-			"counts": counts,
-			"shop": shop,
+			"catalog": fragment.fill(counts),
+			"shop_id": shop_id,
+			"max_cart_delta": MAX_CART_DELTA,
 			"user": user
 		}
-	)
+	), etag, PAGE_PRIVATE)
 
 
 class OrderInfo(BaseModel):
@@ -169,68 +223,231 @@ class OrderInfo(BaseModel):
 	item_id: int
 
 
+class CartChange(BaseModel):
+	shop_id: int
+	item_id: int
+	delta: conint(ge=-MAX_CART_DELTA, le=MAX_CART_DELTA) # type: ignore
+
+
+class CartChanges(BaseModel):
+	changes: List[CartChange]
+
+
+MAX_CART_CHANGES = 100
+
+
+async def change_cart(user: User, changes: List[Tuple[int, int, int]]) -> Dict[Tuple[int, int], int]:
+	try:
+		return await adb.change_cart(user.id, changes)
+	except CartPincodeMismatch as e:
+		raise HTTPException(status_code=HTTP_412_PRECONDITION_FAILED,
+			detail="can't have order from two different pincodes at same time",
+			headers={"pincode": str(e.pincode)})
+	except ValueError as e:
+		raise HTTPException(status_code=HTTP_400_BAD_REQUEST, detail=str(e))
+
+
 @app.post("/order/increase_order_quantity")
 async def add_order(request: Request, order_info: OrderInfo, user: User = Depends(UserDepends(True))):
-	orders = [o for o in db.get_user_orders(user.id) if o.status==OrderStatus.Cart]
-	if len(orders)>0:
-		pincode_now = db.get_shop(order_info.shop_id).address.pincode
-		pincode_old = db.get_shop(orders[0].shop_id).address.pincode
-		if pincode_now != pincode_old:
-			raise HTTPException(status_code=HTTP_412_PRECONDITION_FAILED,
-				detail="can't have order from two different pincodes at same time",
-				headers={"pincode": str(pincode_now)})
-	return db.new_order(user.id, order_info.item_id, order_info.shop_id)
+	return (await change_cart(user, [(order_info.shop_id, order_info.item_id, 1)]))[(order_info.shop_id, order_info.item_id)]
 
 
 @app.post("/order/decrease_order_quantity")
-def remove_order(request: Request, order_info: OrderInfo, user: User = Depends(UserDepends(True))):
-	return db.decrease_order_quantity(user.id, order_info.item_id, order_info.shop_id)
+async def remove_order(request: Request, order_info: OrderInfo, user: User = Depends(UserDepends(True))):
+	return (await change_cart(user, [(order_info.shop_id, order_info.item_id, -1)]))[(order_info.shop_id, order_info.item_id)]
+
+
+@app.post("/order/change_cart")
+async def change_cart_batch(request: Request, batch: CartChanges, user: User = Depends(UserDepends(True))):
+	# several +/- clicks in one request and one commit, applied all together or not at all
+	if len(batch.changes) > MAX_CART_CHANGES:
+		raise HTTPException(status_code=HTTP_400_BAD_REQUEST, detail=f"at most {MAX_CART_CHANGES} changes per request")
+	quantities = await change_cart(user, [(c.shop_id, c.item_id, c.delta) for c in batch.changes])
+	return {"quantities": [{"shop_id": shop_id, "item_id": item_id, "quantity": q} for (shop_id, item_id), q in quantities.items()]}
 
 
 @app.post("/order/place_cart_order")
-def place_orders(request: Request, addressId: AddressId, user: User = Depends(UserDepends(True))):
-	db.place_orders(user.id, addressId.address_id)
+async def place_orders(request: Request, addressId: AddressId, user: User = Depends(UserDepends(True))):
+	await adb.place_orders(user.id, addressId.address_id)
+
+
+def parse_statuses(status: Optional[List[str]], default: Sequence[OrderStatus] = HISTORY_STATUSES) -> List[OrderStatus]:
+	if not status:
+		return list(default)
+	try:
+		return [OrderStatus[s] for s in status]
+	except KeyError as e:
+		raise HTTPException(status_code=HTTP_400_BAD_REQUEST, detail=f"unknown order status {e.args[0]}")
+
+
+async def get_order_page(user: User, statuses: List[OrderStatus], cursor: Optional[str], limit: int = ORDERS_PER_PAGE) -> OrderPage:
+	try:
+		return await adb.get_order_page(user.id, statuses, cursor, limit)
+	except ValueError as e:
+		raise HTTPException(status_code=HTTP_400_BAD_REQUEST, detail=str(e))
 
 
 @app.get("/show_orders")
-def show_orders_and_cart(request: Request, user: User = Depends(UserDepends(True))):
-	orders = db.get_user_orders(user.id)
-	shops = {o.shop_id: db.get_shop(o.shop_id) for o in orders}
-	items = {o.item_id: db.get_item(o.item_id) for o in orders}
-	cart_orders = []
-	other_orders = []
-	for order in orders:
-		if order.status == OrderStatus.Cart:
-			cart_orders.append(order)
-		else:
-			other_orders.append(order)
-	total_cart_price = sum(db.get_price(order) for order in cart_orders)
-	other_orders.sort(key=lambda x: x.status.value)
+async def show_orders_and_cart(request: Request, status: Optional[List[str]] = Query(None), cursor: Optional[str] = Query(None),
+		user: User = Depends(UserDepends(True))):
+	statuses = parse_statuses(status)
+	page = await get_order_page(user, statuses, cursor)
+	cart = await adb.get_cart(user.id)
+	cart_orders = list(cart.lines.values())
+	shops = await adb.get_shops_by_ids([o.shop_id for o in page.orders] + [l.shop_id for l in cart_orders])
+	items = await adb.get_items_by_ids([o.item_id for o in page.orders] + [l.item_id for l in cart_orders])
 	return templates.TemplateResponse(
 		"orders.html", {
 			"request": request,
 			"user": user,
 			"cart_orders": cart_orders,
-			"other_orders": other_orders,
-			"total_cart_price": total_cart_price,
+			"other_orders": page.orders,
+			"next_cursor": page.next_cursor,
+			"statuses": [s.name for s in statuses],
+			"all_statuses": [s.name for s in HISTORY_STATUSES],
+			"total_cart_price": cart.total,
 			"shops": shops,
 			"items": items
 		}
 	)
 
 
+@app.get("/orders")
+async def list_orders(status: Optional[List[str]] = Query(None), cursor: Optional[str] = Query(None),
+		limit: int = Query(ORDERS_PER_PAGE, ge=1, le=100), user: User = Depends(UserDepends(True))):
+	page = await get_order_page(user, parse_statuses(status), cursor, limit)
+	return {"orders": [order_json(o) for o in page.orders], "next_cursor": page.next_cursor}
+
+
+ORDER_FIELDS = ("id", "placed_at", "updated_at", "user_id", "item_id", "shop_id", "quantity", "status", "address_id")
+EXPORT_BATCH = 1000 # orders per storage round trip while exporting
+
+
+def order_json(o: Order) -> dict:
+	return {
+		"id": o.id,
+		"placed_at": o.placed_at_raw,
+		"updated_at": o.updated_at_raw,
+		"user_id": o.user_id,
+		"item_id": o.item_id,
+		"shop_id": o.shop_id,
+		"quantity": o.quantity,
+		"status": o.status.name,
+		"address_id": o.address.id if o.address is not None else None,
+	}
+
+
+async def shop_key(x_shop_key: Optional[str] = Header(None)):
+	# one key for every shop, from RENTAL_SHOP_API_KEY; without it the shop endpoints are off
+	if settings.shop_api_key is None:
+		raise HTTPException(status_code=HTTP_403_FORBIDDEN, detail="shop endpoints are disabled, set RENTAL_SHOP_API_KEY")
+	if x_shop_key is None or not hmac.compare_digest(x_shop_key.encode(), settings.shop_api_key.encode()):
+		raise HTTPException(status_code=HTTP_401_UNAUTHORIZED, detail="missing or wrong X-Shop-Key")
+
+
+async def existing_shop(shop_id: int) -> int:
+	if await adb.get_shop(shop_id) is None:
+		raise HTTPException(status_code=HTTP_404_NOT_FOUND, detail=f"no shop {shop_id}")
+	return shop_id
+
+
+def parse_time_bound(name: str, value: Optional[str]) -> Optional[str]:
+	# a date or an ISO timestamp -> the isoformat UTC string orders are stored (and compared) with
+	if not value:
+		return None
+	try:
+		return arrow.get(value).to("UTC").isoformat()
+	except (ValueError, TypeError): # arrow's ParserError is a ValueError
+		raise HTTPException(status_code=HTTP_400_BAD_REQUEST, detail=f"{name}: {value!r} is not a date or ISO timestamp")
+
+
+class OrderIds(BaseModel):
+	order_ids: List[int]
+
+
+@app.get("/shop/{shop_id}/orders", dependencies=[Depends(shop_key)])
+async def list_shop_orders(shop_id: int = Depends(existing_shop), status: Optional[List[str]] = Query(None),
+		cursor: Optional[str] = Query(None), limit: int = Query(SHOP_ORDERS_PER_PAGE, ge=1, le=500)):
+	# placed (by default) orders of a shop, newest first, from the (shop_id, status, placed_at) index
+	try:
+		page = await adb.get_shop_order_page(shop_id, parse_statuses(status, (OrderStatus.Placed,)), cursor, limit)
+	except ValueError as e:
+		raise HTTPException(status_code=HTTP_400_BAD_REQUEST, detail=str(e))
+	return {"orders": [order_json(o) for o in page.orders], "next_cursor": page.next_cursor}
+
+
+@app.post("/shop/{shop_id}/orders/deliver", dependencies=[Depends(shop_key)])
+async def deliver_shop_orders(body: OrderIds, shop_id: int = Depends(existing_shop)):
+	try:
+		delivered = await adb.deliver_orders(shop_id, body.order_ids)
+	except ValueError as e:
+		raise HTTPException(status_code=HTTP_400_BAD_REQUEST, detail=str(e))
+	return {"delivered": delivered, "skipped": sorted(set(body.order_ids) - set(delivered))}
+
+
+def parse_day(name: str, value: Optional[str]) -> Optional[str]:
+	if not value:
+		return None
+	try:
+		return date.fromisoformat(value).isoformat()
+	except ValueError:
+		raise HTTPException(status_code=HTTP_400_BAD_REQUEST, detail=f"{name}: {value!r} is not a YYYY-MM-DD date")
+
+
+@app.get("/reports/sales", dependencies=[Depends(shop_key)])
+async def sales_report(group_by: List[Literal["day", "shop", "item", "pincode"]] = Query(["day"]),
+		since: Optional[str] = Query(None), until: Optional[str] = Query(None), shop_id: Optional[int] = Query(None),
+		item_id: Optional[int] = Query(None), pincode: Optional[int] = Query(None)):
+	# precomputed per (day, shop, item) rollups of the order event log, summed per `group_by`, days in [since, until)
+	report = await adb.sales_report(list(dict.fromkeys(group_by)), parse_day("since", since), parse_day("until", until),
+		shop_id, item_id, pincode)
+	return {"rows": report.rows, "totals": report.totals}
+
+
+def encode_orders(orders: Iterable[Order], fmt: str) -> str:
+	if fmt == "ndjson":
+		return "".join(json.dumps(order_json(o)) + "\n" for o in orders)
+	buffer = io.StringIO()
+	csv.writer(buffer).writerows([order_json(o)[f] for f in ORDER_FIELDS] for o in orders)
+	return buffer.getvalue()
+
+
+@app.get("/shop/{shop_id}/orders/export", dependencies=[Depends(shop_key)])
+async def export_shop_orders(shop_id: int = Depends(existing_shop), format: Literal["csv", "ndjson"] = Query("csv"),
+		status: Optional[List[str]] = Query(None), since: Optional[str] = Query(None), until: Optional[str] = Query(None)):
+	# orders placed in [since, until), newest first, read and sent EXPORT_BATCH at a time so memory stays flat
+	statuses = parse_statuses(status)
+	low, high = parse_time_bound("since", since), parse_time_bound("until", until)
+
+	async def rows() -> AsyncIterator[str]:
+		if format == "csv":
+			yield ",".join(ORDER_FIELDS) + "\r\n"
+		cursor = None
+		while True:
+			page = await adb.get_shop_order_page(shop_id, statuses, cursor, EXPORT_BATCH, low, high)
+			if page.orders:
+				yield encode_orders(page.orders, format)
+			cursor = page.next_cursor
+			if cursor is None:
+				return
+
+	media_type = "text/csv" if format == "csv" else "application/x-ndjson"
+	return StreamingResponse(rows(), media_type=media_type,
+		headers={"Content-Disposition": f'attachment; filename="shop-{shop_id}-orders.{format}"'})
+
+
 @app.get("/do_login")
-def log_user_in_get(request: Request):
+async def log_user_in_get(request: Request):
 	return RedirectResponse(f"/login_page", status_code=status.HTTP_303_SEE_OTHER)
 
 
 @app.post("/do_login")
-def log_user_in(
+async def log_user_in(
 	request: Request, email: str = Form(...), password: str = Form(...), user: Optional[User] = Depends(UserDepends(False))
 ):
 	if user is not None: # already logged in
 		return RedirectResponse("/")
-	user = db.get_user(email, password) #
+	user = await adb.get_user(email, password) #
 	if user is None:
 		return templates.TemplateResponse(
 			"login_page.html", {
@@ -239,23 +456,13 @@ def log_user_in(
 			}, 401
 		)
 	resp = RedirectResponse(f"/", status_code=status.HTTP_303_SEE_OTHER)
-	session = db.create_session(user.id)
+	session = await adb.create_session(user.id)
 	resp.set_cookie("token", session.token)
 	return resp
 
 
-@app.get("/debug")
-def debug(request: Request, user: Optional[User] = Depends(UserDepends(False))):
-	return user.name if user else None
-
-
-@app.get("/breakpoint")
-def debug_bp(request: Request):
-	breakpoint()
-	return "done"
-
 @app.get("/add_address")
-def add_address_ep(request: Request, user: User = Depends(UserDepends(True))):
+async def add_address_ep(request: Request, user: User = Depends(UserDepends(True))):
 	return templates.TemplateResponse(
 		"add_address.html", {
 			"request": request,
@@ -263,18 +470,138 @@ def add_address_ep(request: Request, user: User = Depends(UserDepends(True))):
 		}
 	)
 
+def parse_search_filters(pincode: Optional[str], min_price: Optional[str], max_price: Optional[str]):
+	# the search form sends empty strings for the filters left blank
+	if pincode and not is_valid(pincode):
+		raise HTTPException(status_code=HTTP_400_BAD_REQUEST, detail=f"pincode: {pincode} not valid")
+	try:
+		prices = [float(p) if p else None for p in (min_price, max_price)]
+	except ValueError:
+		raise HTTPException(status_code=HTTP_400_BAD_REQUEST, detail="prices have to be numbers")
+	return int(pincode) if pincode else None, prices[0], prices[1]
+
+
+@app.get("/search")
+async def search_items_page(request: Request, q: str = Query(""), pincode: Optional[str] = Query(None),
+		shop_id: Optional[int] = Query(None), min_price: Optional[str] = Query(None), max_price: Optional[str] = Query(None),
+		page_no: int = Query(0, ge=0), user: Optional[User] = Depends(UserDepends(False))):
+	pin_code, low, high = parse_search_filters(pincode, min_price, max_price)
+	page = await adb.search_items(q, pin_code, shop_id, low, high, page_no)
+	shops = await adb.get_shops_by_ids({s for shop_ids in page.shop_ids.values() for s in shop_ids})
+	return templates.TemplateResponse(
+		"search.html", {
+			"request": request,
+			"user": user,
+			"q": q,
+			"pincode": pincode or "",
+			"shop_id": shop_id,
+			"min_price": min_price or "",
+			"max_price": max_price or "",
+			"page": page,
+			"shops": shops,
+			"previous_url": request.url.include_query_params(page_no=page_no - 1) if page_no > 0 else None,
+			"next_url": request.url.include_query_params(page_no=page_no + 1) if (page_no + 1) * SEARCH_PER_PAGE < page.total else None,
+		}
+	)
+
+
+@app.get("/search/items")
+async def search_items(q: str = Query(...), pincode: Optional[str] = Query(None), shop_id: Optional[int] = Query(None),
+		min_price: Optional[str] = Query(None), max_price: Optional[str] = Query(None),
+		page_no: int = Query(0, ge=0), limit: int = Query(SEARCH_PER_PAGE, ge=1, le=100),
+		shops: int = Query(SEARCH_SHOPS_PER_ITEM, ge=0, le=100)):
+	pin_code, low, high = parse_search_filters(pincode, min_price, max_price)
+	page = await adb.search_items(q, pin_code, shop_id, low, high, page_no, limit, shops)
+	return {
+		"items": [
+			{"id": i.id, "name": i.name, "price": i.price, "image_url": images.url(i.image_name),
+				"shop_ids": page.shop_ids[i.id], "shop_count": page.shop_counts[i.id]}
+			for i in page.items
+		],
+		"total": page.total,
+		"has_next_page": (page_no + 1) * limit < page.total,
+	}
+
+
 @app.post("/do_address_add")
-def add_address_post(request: Request, user: User = Depends(UserDepends(True)),
+async def add_address_post(request: Request, user: User = Depends(UserDepends(True)),
 		person_name: str = Form(...), building: str = Form(...), city: str = Form(...),
 		district: str = Form(...), state: str = Form(...),
-		pincode: int = Form(...), landmark: Optional[str] = Form(None), street: Optional[str] = Form(None)):
-	address_id = db.add_address(person_name, pincode, building, city,
+		pincode: int = Form(..., ge=100000, le=999999), landmark: Optional[str] = Form(None), street: Optional[str] = Form(None)):
+	address_id = await adb.add_address(person_name, pincode, building, city,
 		district, state, landmark, street)
-	db.add_address_to_user(address_id, user.id)
+	await adb.add_address_to_user(address_id, user.id)
 
 	return RedirectResponse(f"/add_address", status_code=status.HTTP_303_SEE_OTHER)
 
-app.mount("/static", StaticFiles(directory="rental"), "static")
+app.mount("/static", assets, "static")
+
+
+@app.get("/images/{digest}/{width}/{name:path}")
+async def image_variant(request: Request, digest: str, width: int, name: str):
+	known, versioned = images.resolve(digest, name)
+	if not known:
+		raise HTTPException(status.HTTP_404_NOT_FOUND)
+	if not images.available or width not in WIDTHS:
+		return RedirectResponse(images.url(name, width) if images.available else assets.url(name))
+	fmt = images.pick_format(name, request.headers.get("accept", ""))
+	etag = f'"{assets.assets[name].digest}-{width}-{fmt}"'
+	headers = {"ETag": etag, "Cache-Control": IMMUTABLE if versioned else REVALIDATE, "Vary": "Accept"}
+	if etag_matches(request, etag):
+		return Response(status_code=304, headers=headers)
+	path = await run_in_threadpool(images.variant, name, width, fmt)
+	return FileResponse(path, media_type=MEDIA_TYPES[fmt], headers=headers)
+
+
+@app.get("/metrics/sessions")
+async def session_metrics():
+	return asdict(db.sessions.stats())
+
+
+def cache_gauges():
+	sessions = db.sessions.stats()
+	return [
+		("rental_sessions_live", "Sessions that haven't expired or been logged out.", sessions.live),
+		("rental_sessions_expired", "Sessions removed by the sweeper.", sessions.expired),
+		("rental_fragment_cache_entries", "Rendered catalog fragments kept in memory.", len(fragments)),
+		("rental_user_cache_entries", "Logged-in users kept in memory.", len(db.user_cache)),
+		("rental_item_map_entries", "Items in the identity map.", len(db.item_map)),
+		("rental_address_map_entries", "Addresses in the identity map.", len(db.address_map)),
+	]
+
+REGISTRY.gauges.append(cache_gauges)
+
+
+@app.get("/metrics")
+async def prometheus_metrics():
+	return PlainTextResponse(REGISTRY.exposition(), media_type="text/plain; version=0.0.4")
+
+
+@app.on_event("startup")
+def start_session_sweeper():
+	db.sessions.start_sweeper(settings.session_sweep_interval)
+
+
+@app.on_event("startup")
+def start_profiler():
+	if profiler is not None:
+		profiler.start()
+
+
+@app.on_event("startup")
+def precompile_templates():
+	precompile(templates.env)
+	# gzip -9 / brotli of every text asset takes a while, don't hold the first request for it
+	threading.Thread(target=assets.precompress, name="precompress", daemon=True).start()
+
+
+@app.on_event("shutdown")
+def shutdown_database():
+	db.sessions.stop_sweeper()
+	if profiler is not None:
+		profiler.stop()
+	adb.shutdown()
+	db.storage.flush()
 
 if __name__ == "__main__":
 	import uvicorn
@@ -0,0 +1,51 @@
+import asyncio
+import contextvars
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Optional
+
+from .db import Database
+from .models import User
+
+IO_WORKERS = 4
+
+
+class AsyncDatabase:
+	# Runs the blocking `Database` methods on a dedicated, bounded executor so storage I/O
+	# never runs on the event loop: `await adb.new_order(...)` instead of `db.new_order(...)`.
+	def __init__(self, db: Database, max_workers: int = IO_WORKERS) -> None:
+		self.db = db
+		self.max_workers = max_workers
+		self.executor: Optional[ThreadPoolExecutor] = None
+
+	async def run(self, func, *args, **kwargs) -> Any:
+		if self.executor is None:
+			self.executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="db-io")
+		loop = asyncio.get_running_loop()
+		call = functools.partial(contextvars.copy_context().run, func, *args, **kwargs)
+		return await loop.run_in_executor(self.executor, call)
+
+	def __getattr__(self, name: str):
+		attr = getattr(self.db, name)
+		if not callable(attr):
+			return attr
+
+		@functools.wraps(attr)
+		async def call(*args, **kwargs):
+			return await self.run(attr, *args, **kwargs)
+
+		return call
+
+	async def get_logged_in_user(self, token: str) -> Optional[User]:
+		# warm tokens are answered from memory without an executor hop, unless other
+		# processes may have invalidated them (checking that needs storage)
+		if not self.db.shared:
+			user = self.db.user_cache.get(token)
+			if user is not None:
+				return user
+		return await self.run(self.db.get_logged_in_user, token)
+
+	def shutdown(self):
+		if self.executor is not None:
+			self.executor.shutdown(wait=True)
+			self.executor = None
@@ -0,0 +1,264 @@
+import argparse
+import asyncio
+import json
+import math
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from dataclasses import asdict, dataclass
+from typing import Awaitable, Callable, Dict, List, Optional
+
+import httpx
+
+from .db import Database
+from .seed import SeededData, seed_synthetic
+from .write_behind import WriteBehindConfig
+
+
+@dataclass
+class EndpointReport:
+	requests: int
+	errors: int
+	p50_ms: float
+	p95_ms: float
+	p99_ms: float
+	mean_ms: float
+	rps: float
+
+
+def percentile(sorted_values: List[float], p: float) -> float:
+	if not sorted_values:
+		return 0.0
+	rank = max(math.ceil(p / 100 * len(sorted_values)) - 1, 0)
+	return sorted_values[rank]
+
+
+def succeeded(response: httpx.Response) -> bool:
+	return response.status_code < 400
+
+
+async def drive(request: Callable[[int], Awaitable[httpx.Response]], requests: int, concurrency: int, ok: Callable[[httpx.Response], bool] = succeeded) -> EndpointReport:
+	latencies: List[float] = []
+	errors = 0
+	counter = iter(range(requests))
+
+	async def worker():
+		nonlocal errors
+		for i in counter:
+			start = time.perf_counter()
+			response = await request(i)
+			latencies.append((time.perf_counter() - start) * 1000)
+			if not ok(response):
+				errors += 1
+
+	start = time.perf_counter()
+	await asyncio.gather(*(worker() for _ in range(concurrency)))
+	elapsed = time.perf_counter() - start
+	latencies.sort()
+	return EndpointReport(
+		requests=requests,
+		errors=errors,
+		p50_ms=round(percentile(latencies, 50), 3),
+		p95_ms=round(percentile(latencies, 95), 3),
+		p99_ms=round(percentile(latencies, 99), 3),
+		mean_ms=round(sum(latencies) / len(latencies), 3) if latencies else 0.0,
+		rps=round(requests / elapsed, 1) if elapsed else 0.0,
+	)
+
+
+def seed_database(path: str, args) -> SeededData:
+	# one group commit at close instead of a file rewrite per seeded row
+	write_behind = WriteBehindConfig(flush_interval=3600, flush_bytes=1 << 40, journal=False)
+	db = Database(path, write_behind=write_behind)
+	data = seed_synthetic(db, users=args.users, pincodes=args.pincodes, shops_per_pincode=args.shops_per_pincode,
+		items_per_shop=args.items_per_shop, orders_per_user=args.orders_per_user, catalog_size=args.catalog_size, seed=args.seed)
+	db.close()
+	return data
+
+
+async def run_endpoints(app, data: SeededData, args) -> Dict[str, EndpointReport]:
+	from .app import db
+
+	rng = random.Random(args.seed)
+	tokens = {user_id: db.create_session(user_id).token for user_id, _, _ in data.users}
+	user_ids = list(tokens)
+
+	def auth(user_id: int) -> dict:
+		return {"cookie": f"token={tokens[user_id]}"}
+
+	transport = httpx.ASGITransport(app=app)
+	async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+
+		def shops(i):
+			return client.get(f"/shops/{rng.choice(data.pincodes)}")
+
+		def items(i):
+			user_id = rng.choice(user_ids)
+			shop_id = rng.choice(data.shop_ids[data.user_pincodes[user_id]])
+			return client.get(f"/items/{shop_id}", headers=auth(user_id))
+
+		def show_orders(i):
+			return client.get("/show_orders", headers=auth(rng.choice(user_ids)))
+
+		def increase(i):
+			user_id = rng.choice(user_ids)
+			shop_id = rng.choice(data.shop_ids[data.user_pincodes[user_id]])
+			body = {"shop_id": shop_id, "item_id": rng.choice(data.items[shop_id])}
+			return client.post("/order/increase_order_quantity", json=body, headers=auth(user_id))
+
+		async def login(i):
+			_, email, password = rng.choice(data.users)
+			# a client without cookies: with the shared jar every login after the first is a 307 "already logged in"
+			async with httpx.AsyncClient(transport=transport, base_url="http://bench") as anonymous:
+				return await anonymous.post("/do_login", data={"email": email, "password": password})
+
+		endpoints = {
+			"GET /shops/{pin_code}": shops,
+			"GET /items/{shop_id}": items,
+			"GET /show_orders": show_orders,
+			"POST /order/increase_order_quantity": increase,
+			"POST /do_login": login,
+		}
+		# "already logged in" is a 307, only the 303 is a fresh session
+		checks = {"POST /do_login": lambda response: response.status_code == 303}
+		selected = {name: fn for name, fn in endpoints.items() if not args.only or any(o in name for o in args.only)}
+		reports = {}
+		for name, fn in selected.items():
+			ok = checks.get(name, succeeded)
+			await drive(fn, min(args.warmup, args.requests), args.concurrency, ok)
+			reports[name] = await drive(fn, args.requests, args.concurrency, ok)
+		return reports
+
+
+# run in a fresh interpreter: imports, opens the database, runs the startup handlers and serves one page
+STARTUP_PROBE = """
+import json, sys, time
+start = time.perf_counter()
+import app.db
+imported = time.perf_counter()
+from app.app import app
+opened = time.perf_counter()
+from starlette.testclient import TestClient
+with TestClient(app) as client:
+	ready = time.perf_counter()
+	status = client.get("/shops/" + sys.argv[1]).status_code
+	served = time.perf_counter()
+print(json.dumps({"status": status, "import_db_ms": (imported - start) * 1000, "import_app_ms": (opened - imported) * 1000,
+	"startup_ms": (ready - opened) * 1000, "first_request_ms": (served - ready) * 1000}))
+"""
+
+
+def measure_startup(db_path: str, pincode: int, runs: int) -> Dict[str, float]:
+	# medians over `runs` cold starts; `process_ms` also counts the interpreter starting up
+	env = {**os.environ, "RENTAL_DB": db_path, "RENTAL_WORKERS": "1"}
+	samples: Dict[str, List[float]] = {}
+	for _ in range(runs):
+		start = time.perf_counter()
+		out = subprocess.run([sys.executable, "-c", STARTUP_PROBE, str(pincode)], env=env, capture_output=True, text=True, check=True).stdout
+		wall = (time.perf_counter() - start) * 1000
+		result = json.loads(out.strip().splitlines()[-1])
+		if result.pop("status") >= 400:
+			raise RuntimeError("the first request failed")
+		for name, value in {**result, "process_ms": wall}.items():
+			samples.setdefault(name, []).append(value)
+	start = time.perf_counter()
+	Database(db_path).close()
+	report = {name: round(percentile(sorted(values), 50), 2) for name, values in samples.items()}
+	report["database_open_ms"] = round((time.perf_counter() - start) * 1000, 2)
+	report["file_bytes"] = os.path.getsize(db_path)
+	return report
+
+
+def git_revision() -> str:
+	try:
+		return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+	except (OSError, subprocess.CalledProcessError):
+		return "unknown"
+
+
+def main():
+	parser = argparse.ArgumentParser(description="seed a synthetic dataset and load-test the storefront endpoints in-process")
+	parser.add_argument("--users", type=int, default=50)
+	parser.add_argument("--pincodes", type=int, default=5)
+	parser.add_argument("--shops-per-pincode", type=int, default=30)
+	parser.add_argument("--items-per-shop", type=int, default=20)
+	parser.add_argument("--orders-per-user", type=int, default=10)
+	parser.add_argument("--catalog-size", type=int, default=200)
+	parser.add_argument("--requests", type=int, default=200, help="requests per endpoint")
+	parser.add_argument("--warmup", type=int, default=20)
+	parser.add_argument("--concurrency", type=int, default=10)
+	parser.add_argument("--backend", choices=["tinydb", "snapshot", "sqlite"], default="tinydb")
+	parser.add_argument("--startup", type=int, metavar="RUNS", help="measure cold starts instead of the endpoints")
+	parser.add_argument("--only", nargs="*", help="substrings of the endpoints to run")
+	parser.add_argument("--seed", type=int, default=0)
+	parser.add_argument("--json", dest="json_path", help="write the machine readable report here")
+	parser.add_argument("--keep", action="store_true", help="keep the seeded database instead of deleting it")
+	args = parser.parse_args()
+
+	workdir = tempfile.mkdtemp(prefix="rental-bench-")
+	try:
+		run(args, workdir)
+	finally:
+		if args.keep:
+			print(f"seeded data kept in {workdir}", file=sys.stderr)
+		else:
+			shutil.rmtree(workdir, ignore_errors=True)
+
+
+def run(args: argparse.Namespace, workdir: str):
+	db_path = os.path.join(workdir, {"tinydb": "bench.json", "snapshot": "bench.snapshot", "sqlite": "bench.sqlite3"}[args.backend])
+	start = time.perf_counter()
+	data = seed_database(db_path, args)
+	seed_seconds = time.perf_counter() - start
+
+	if args.startup:
+		startup = measure_startup(db_path, data.pincodes[0], args.startup)
+		print(f"{'':<24} {'ms':>9}")
+		for name, value in startup.items():
+			print(f"{name:<24} {value:>9}")
+		write_report({
+			"revision": git_revision(),
+			"config": {k: v for k, v in vars(args).items() if k != "json_path"},
+			"seed_seconds": round(seed_seconds, 3),
+			"startup": startup,
+		}, args.json_path)
+		return
+
+	# `app.app` opens its database at import time
+	os.environ["RENTAL_DB"] = db_path
+	os.environ["RENTAL_WORKERS"] = "1"
+	from .app import adb, app, db
+	try:
+		reports = asyncio.run(run_endpoints(app, data, args))
+	finally:
+		# the write-behind flusher must be done with the work directory before it is deleted
+		adb.shutdown()
+		db.close()
+
+	report = {
+		"revision": git_revision(),
+		"config": {k: v for k, v in vars(args).items() if k != "json_path"},
+		"seed_seconds": round(seed_seconds, 3),
+		"endpoints": {name: asdict(r) for name, r in reports.items()},
+	}
+	print(f"{'endpoint':<40} {'p50':>9} {'p95':>9} {'p99':>9} {'rps':>9} {'errors':>7}")
+	for name, r in reports.items():
+		print(f"{name:<40} {r.p50_ms:>9.2f} {r.p95_ms:>9.2f} {r.p99_ms:>9.2f} {r.rps:>9.1f} {r.errors:>7}")
+	write_report(report, args.json_path)
+
+
+def write_report(report: dict, json_path: Optional[str]):
+	if json_path:
+		with open(json_path, "w") as f:
+			json.dump(report, f, indent="\t")
+	else:
+		json.dump(report, sys.stdout, indent="\t")
+		print()
+
+
+if __name__ == "__main__":
+	main()
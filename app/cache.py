@@ -0,0 +1,86 @@
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable, Generic, Hashable, Optional, Tuple, TypeVar
+
+K = TypeVar("K", bound=Hashable)
+V = TypeVar("V")
+
+
+class TTLCache(Generic[K, V]):
+	def __init__(self, maxsize: int = 1024, ttl: float = 60.0, clock: Callable[[], float] = time.monotonic) -> None:
+		self.maxsize = maxsize
+		self.ttl = ttl
+		self.clock = clock
+		self.entries: "OrderedDict[K, Tuple[float, V]]" = OrderedDict()
+		self.lock = threading.Lock()
+
+	def get(self, key: K) -> Optional[V]:
+		with self.lock:
+			entry = self.entries.get(key)
+			if entry is None:
+				return None
+			expires_at, value = entry
+			if expires_at <= self.clock():
+				del self.entries[key]
+				return None
+			self.entries.move_to_end(key)
+			return value
+
+	def set(self, key: K, value: V, ttl: Optional[float] = None):
+		ttl = self.ttl if ttl is None else min(ttl, self.ttl)
+		with self.lock:
+			self.entries[key] = (self.clock() + ttl, value)
+			self.entries.move_to_end(key)
+			while len(self.entries) > self.maxsize:
+				self.entries.popitem(last=False)
+
+	def pop(self, key: K):
+		with self.lock:
+			self.entries.pop(key, None)
+
+	def pop_where(self, predicate: Callable[[V], bool]):
+		with self.lock:
+			for key in [k for k, (_, v) in self.entries.items() if predicate(v)]:
+				del self.entries[key]
+
+	def clear(self):
+		with self.lock:
+			self.entries.clear()
+
+	def __len__(self) -> int:
+		return len(self.entries)
+
+
+class IdentityMap(Generic[K, V]):
+	# one shared instance per key, for entities that are never updated in place (items, addresses)
+	def __init__(self, maxsize: int = 65536) -> None:
+		self.maxsize = maxsize
+		self.entries: "OrderedDict[K, V]" = OrderedDict()
+		self.lock = threading.Lock()
+
+	def get(self, key: K) -> Optional[V]:
+		with self.lock:
+			value = self.entries.get(key)
+			if value is not None:
+				self.entries.move_to_end(key)
+			return value
+
+	def intern(self, key: K, value: V) -> V:
+		# returns the instance already mapped to `key`, if any, so callers share it
+		with self.lock:
+			existing = self.entries.get(key)
+			if existing is not None:
+				self.entries.move_to_end(key)
+				return existing
+			self.entries[key] = value
+			while len(self.entries) > self.maxsize:
+				self.entries.popitem(last=False)
+			return value
+
+	def clear(self):
+		with self.lock:
+			self.entries.clear()
+
+	def __len__(self) -> int:
+		return len(self.entries)
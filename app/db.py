@@ -1,220 +1,559 @@
-from fastapi import staticfiles
-from tinydb import TinyDB, Query
 from typing import Optional
 
+import arrow
 from tinydb.table import Document
-import tinydb.table
-from .models import *
+from .models import Address, Cart, Item, Order, OrderPage, OrderStatus, SalesReport, SearchPage, Session, Shop, User
+from .storage import Storage, Table, open_storage
+from .write_behind import WriteBehindConfig
+from .indexes import PincodeIndex
+from .cache import IdentityMap, TTLCache
+from .locks import KeyedLocks
+from .sessions import SessionStore
+from .metrics import InstrumentedStorage
+from .search import SearchIndex
+from . import reports
 import base64
-from typing import List
-import uuid
-import enum
-
-
-class Table(enum.Enum):
-	users = enum.auto()
-	sessions = enum.auto()
-	orders = enum.auto()
-	shops = enum.auto()
-	items = enum.auto()
-	addresses = enum.auto()
+import threading
+import heapq
+import itertools
+import json
+from typing import Any, Dict, Iterable, List, Tuple
+
+
+SHOPS_PER_PAGE = 20
+USER_CACHE_SIZE = 4096
+USER_CACHE_TTL = 300.0 # seconds a token -> User entry may be served without touching storage
+INVALIDATIONS_KEPT = 1000 # newest entries kept in the shared invalidation log
+ORDERS_PER_PAGE = 20
+SHOP_ORDERS_PER_PAGE = 50
+MAX_DELIVERIES = 1000 # order ids per `deliver_orders` call
+MAX_CART_DELTA = 100 # units one cart change may add or take out
+MAX_LINE_QUANTITY = 1000 # units of one item from one shop in a cart
+SEARCH_PER_PAGE = 20
+SEARCH_SHOPS_PER_ITEM = 5 # shop ids listed per hit, the rest are only counted
+HISTORY_STATUSES = (OrderStatus.Placed, OrderStatus.Delivered)
+IDENTITY_MAP_SIZE = 65536 # interned items/addresses kept per Database
 
 
 class UserAlreadyExists(Exception):
 	...
 
 
-class Database:
-	def __init__(self, db_path: str = "tinydb.json") -> None:
-		self.database = TinyDB(db_path)
-		self.database.table("users")
+def encode_cursor(order_by_value: Any, doc_id: int) -> str:
+	return base64.urlsafe_b64encode(json.dumps([order_by_value, doc_id]).encode()).decode()
+
+
+def decode_cursor(cursor: str) -> Tuple[str, int]:
+	# ValueError for anything we didn't hand out; pages are ordered by timestamps, so the value is a str
+	# (anything else would reach the sorted index and fail comparing with them)
+	try:
+		value, doc_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+	except (TypeError, ValueError, UnicodeDecodeError) as e:
+		raise ValueError(f"invalid cursor {cursor!r}") from e
+	if not isinstance(value, str) or not isinstance(doc_id, int) or isinstance(doc_id, bool):
+		raise ValueError(f"invalid cursor {cursor!r}")
+	return value, doc_id
+
+
+class CartPincodeMismatch(Exception):
+	def __init__(self, pincode: int) -> None:
+		super().__init__(pincode)
+		self.pincode = pincode # of the shop that was refused
+
 
-	def get_table(self, table: Table) -> tinydb.table.Table:
-		return self.database.table(table.name)
+class Database:
+	def __init__(self, db_path: str = "tinydb.json", storage: Optional[Storage] = None,
+			session_max_age: Optional[float] = None, write_behind: Optional[WriteBehindConfig] = None,
+			shared: bool = False) -> None:
+		storage = storage if storage is not None else open_storage(db_path, write_behind=write_behind, shared=shared)
+		# times the storage calls and counts the documents they return, per request (see `metrics`)
+		self.storage: Storage = InstrumentedStorage(storage) # type: ignore
+		# `shared`: other processes use the same datastore, so the in-memory caches below are kept
+		# coherent through the invalidation log (see `publish` and `sync`)
+		self.shared = shared
+		self.session_max_age = session_max_age
+		self.sessions = SessionStore(self.storage, session_max_age)
+		self.locks = KeyedLocks()
+		self.user_cache: TTLCache[str, User] = TTLCache(USER_CACHE_SIZE, USER_CACHE_TTL)
+		self.pincode_index = PincodeIndex()
+		self.search_index = SearchIndex()
+		# items and addresses are insert-only, so one instance per id is shared by every request
+		self.item_map: IdentityMap[int, Item] = IdentityMap(IDENTITY_MAP_SIZE)
+		self.address_map: IdentityMap[int, Address] = IdentityMap(IDENTITY_MAP_SIZE)
+		# bumped on every shop/item change (here or, through `sync`, in another worker); tags cached catalog fragments
+		self.catalog_version = 0
+		self.catalog_lock = threading.Lock()
+		self.generation = self.storage.generation()
+		self.last_invalidation = max((d.doc_id for d in self.storage.all(Table.invalidations)), default=0)
+		self.rebuild_pincode_index()
+
+	def rebuild_pincode_index(self):
+		addresses = [self.doc_to_address(a) for a in self.storage.all(Table.addresses)]
+		shops = self.storage.all(Table.shops)
+		self.pincode_index.rebuild(shops, addresses)
+		self.search_index.rebuild(
+			(self.doc_to_item(i) for i in self.storage.all(Table.items)),
+			((s.doc_id, self.pincode_index.address_of(s.doc_id).pincode, s['items']) for s in shops),
+		)
+
+	def bump_catalog(self):
+		with self.catalog_lock:
+			self.catalog_version += 1
+
+	def current_catalog_version(self) -> int:
+		self.sync()
+		return self.catalog_version
+
+	def close(self):
+		self.sessions.stop_sweeper()
+		self.storage.close()
+
+	def publish(self, kind: str, key):
+		if not self.shared:
+			return
+		doc_id = self.storage.insert(Table.invalidations, {"kind": kind, "key": key, "created_at": arrow.now("UTC").isoformat()})
+		if doc_id % INVALIDATIONS_KEPT == 0:
+			old = [d.doc_id for d in self.storage.all(Table.invalidations) if d.doc_id <= doc_id - INVALIDATIONS_KEPT]
+			self.storage.remove(Table.invalidations, doc_ids=old)
+
+	def sync(self):
+		if not self.shared:
+			return
+		generation = self.storage.generation()
+		if generation == self.generation:
+			return
+		self.generation = generation
+		entries = self.storage.since(Table.invalidations, self.last_invalidation)
+		if not entries:
+			return
+		if entries[0].doc_id > self.last_invalidation + 1: # fell behind the pruned log, start over
+			self.user_cache.clear()
+			self.rebuild_pincode_index()
+			self.bump_catalog()
+		else:
+			for entry in entries:
+				self.apply_invalidation(entry['kind'], entry['key'])
+		self.last_invalidation = entries[-1].doc_id
+
+	def apply_invalidation(self, kind: str, key):
+		if kind == "session":
+			self.user_cache.pop(key)
+		elif kind == "user":
+			self.user_cache.pop_where(lambda u: u.id == key)
+		elif kind == "shop":
+			shop = self.storage.get(Table.shops, key)
+			if shop is not None:
+				self.pincode_index.add_address(self.get_address(shop['address_id']))
+				self.pincode_index.add_shop(key, shop['address_id'])
+				self.index_shop_items(key, shop['items'])
+			self.bump_catalog()
+		elif kind == "item":
+			self.search_index.add_item(self.get_item(key))
+			self.bump_catalog()
+		elif kind == "catalog":
+			shop = self.storage.get(Table.shops, key) if key is not None else None
+			if shop is not None:
+				self.index_shop_items(key, shop['items'])
+			self.bump_catalog()
+
+	def index_shop_items(self, shop_id: int, item_ids: List[int]):
+		self.search_index.add_shop_items(shop_id, self.pincode_index.address_of(shop_id).pincode, item_ids)
 
 	def new_user(self, first_name: str, last_name: str, email: str, password: str):
-		table = self.get_table(Table.users)
-		result = table.search(Query().fragment({"email": email}))
-		if len(result) != 0:
-			raise UserAlreadyExists()
-		table.insert({"first_name": first_name, "last_name": last_name, "email": email, "password": password, "address_ids": []})
+		with self.locks.hold((Table.users, email)), self.storage.transaction():
+			if self.storage.find_one(Table.users, email=email) is not None:
+				raise UserAlreadyExists()
+			self.storage.insert(Table.users, {"first_name": first_name, "last_name": last_name, "email": email, "password": password, "address_ids": []})
 
 	def new_shop(self, name: str, address_id: int) -> int:
-		table = self.get_table(Table.shops)
-		return table.insert({"name": name, "address_id": address_id, "items": []})
+		# the address may have been added by another worker, index it before the shop row exists
+		self.pincode_index.add_address(self.get_address(address_id))
+		shop_id = self.storage.insert(Table.shops, {"name": name, "address_id": address_id, "items": []})
+		self.pincode_index.add_shop(shop_id, address_id)
+		self.bump_catalog()
+		self.publish("shop", shop_id)
+		return shop_id
 
 	def add_item_to_shop(self, shop_id: int, item_id: int):
-		table = self.get_table(Table.shops)
-		shop = table.get(doc_id=shop_id)
-		table.update({"items": shop["items"] + [item_id]}, doc_ids=[shop_id])
+		self.storage.append(Table.shops, shop_id, "items", item_id)
+		self.index_shop_items(shop_id, [item_id])
+		self.bump_catalog()
+		self.publish("catalog", shop_id)
 
 	def new_item(self, name: str, price: float, image_name: str) -> int:
-		table = self.get_table(Table.items)
-		return table.insert({"name": name, "price": price, "image_name": image_name})
+		item_id = self.storage.insert(Table.items, {"name": name, "price": price, "image_name": image_name})
+		self.search_index.add_item(self.doc_to_item(Document({"name": name, "price": price, "image_name": image_name}, item_id)))
+		self.bump_catalog()
+		self.publish("item", item_id)
+		return item_id
 
 	def insert_item(self, name: str, price: float) -> int:
-		table = self.get_table(Table.items)
-		return table.insert({"name": name, "price": price})
+		return self.storage.insert(Table.items, {"name": name, "price": price})
 
 	def get_user(self, email: str, password: str) -> Optional[User]:
-		table = self.get_table(Table.users)
-		UserQuery = Query()
-		user = table.get(UserQuery.email == email)
+		user = self.storage.find_one(Table.users, email=email)
 		if user is None:
 			return None
-		addresses = [self.get_address(a) for a in user['address_ids']]
-		user = User.from_doc(user, addresses)
+		user = self.doc_to_user(user)
 		if user.password == password: return user
 
-	def get_user_orders(self, user_id: int) -> List[Order]:
-		table = self.get_table(Table.orders)
-		OrderQuery = Query()
-		orders = table.search(OrderQuery.user_id == user_id)
-		address = [self.get_address(o['address_id']) if o['address_id'] is not None else None for o in orders]
-		return [Order.from_doc(o, a) for o, a in zip(orders, address)]
-
-	def get_price(self, order: Order) -> float:
-		item = self.get_item(order.item_id)
-		return item.price * order.quantity
+	def doc_to_user(self, doc: Document) -> User:
+		addresses = self.get_addresses_by_ids(doc['address_ids'])
+		return User.from_doc(doc, [addresses[a] for a in doc['address_ids']])
+
+	def get_order_page(self, user_id: int, statuses: Iterable[OrderStatus] = HISTORY_STATUSES,
+			cursor: Optional[str] = None, page_size: int = ORDERS_PER_PAGE) -> OrderPage:
+		return self.order_page("updated_at", statuses, cursor, page_size, user_id=user_id)
+
+	def get_shop_order_page(self, shop_id: int, statuses: Iterable[OrderStatus] = (OrderStatus.Placed,),
+			cursor: Optional[str] = None, page_size: int = SHOP_ORDERS_PER_PAGE,
+			since: Optional[str] = None, until: Optional[str] = None) -> OrderPage:
+		# newest placed first, optionally only those placed in [since, until) (isoformat UTC timestamps)
+		return self.order_page("placed_at", statuses, cursor, page_size, since, until, shop_id=shop_id)
+
+	def order_page(self, order_by: str, statuses: Iterable[OrderStatus], cursor: Optional[str], page_size: int,
+			since: Optional[str] = None, until: Optional[str] = None, **fields: Any) -> OrderPage:
+		# one (fields..., status) index range per status, merged, so a page costs the same for any history length
+		before = decode_cursor(cursor) if cursor is not None else (until, 0) if until is not None else None
+		ranges = [
+			self.storage.search_sorted(Table.orders, order_by, page_size + 1, before, status=status.name, **fields)
+			for status in set(statuses)
+		]
+		merged = heapq.merge(*ranges, key=lambda d: (d[order_by], d.doc_id), reverse=True)
+		if since is not None:
+			merged = itertools.takewhile(lambda d: d[order_by] >= since, merged)
+		docs = list(itertools.islice(merged, page_size + 1))
+		next_cursor = encode_cursor(docs[page_size - 1][order_by], docs[page_size - 1].doc_id) if len(docs) > page_size else None
+		docs = docs[:page_size]
+		addresses = self.get_addresses_by_ids(d['address_id'] for d in docs if d['address_id'] is not None)
+		return OrderPage([Order.from_doc(d, addresses.get(d['address_id'])) for d in docs], next_cursor)
 
 	def get_order(self, user_id: int, item_id: int, shop_id: int, status: OrderStatus) -> Optional[Order]:
-		table = self.get_table(Table.orders)
-		OrderQuery = Query()
-		order = table.get((OrderQuery.user_id == user_id) & (OrderQuery.item_id == item_id) & (OrderQuery.shop_id == shop_id)
-							& (OrderQuery.status == status.name))
+		order = self.storage.find_one(Table.orders, user_id=user_id, item_id=item_id, shop_id=shop_id, status=status.name)
 		if order is None:
 			return None
 		address = self.get_address(order['address_id']) if order['address_id'] is not None else None
 		return Order.from_doc(order, address)
 
-	def new_order(self, user_id: int, item_id: int, shop_id: int) -> int:
-		table = self.get_table(Table.orders)
-		now = arrow.now("UTC")
-		now_str = now.isoformat()
+	def get_cart(self, user_id: int) -> Cart:
+		doc = self.storage.get(Table.carts, user_id)
+		if doc is None:
+			return self.rebuild_cart(user_id)
+		return Cart.from_doc(doc)
+
+	def rebuild_cart(self, user_id: int) -> Cart:
+		# carts written before the aggregate existed are built once from the orders
+		with self.storage.transaction():
+			doc = self.storage.get(Table.carts, user_id)
+			if doc is not None:
+				return Cart.from_doc(doc)
+			cart = Cart.empty(user_id)
+			orders = self.storage.search(Table.orders, user_id=user_id, status=OrderStatus.Cart.name)
+			items = self.get_items_by_ids(o['item_id'] for o in orders)
+			for o in orders:
+				pincode = self.get_shop(o['shop_id']).address.pincode # type: ignore
+				cart = cart.changed(o['shop_id'], o['item_id'], o['quantity'], items[o['item_id']].price, pincode)
+			self.save_cart(cart)
+			return cart
+
+	def save_cart(self, cart: Cart):
+		with self.storage.transaction():
+			if self.storage.get(Table.carts, cart.user_id) is None:
+				self.storage.insert_documents(Table.carts, [Document(cart.to_doc(), cart.user_id)])
+			else:
+				self.storage.update(Table.carts, cart.to_doc(), doc_ids=[cart.user_id])
 
-		order = self.get_order(user_id, item_id, shop_id, OrderStatus.Cart)
-		if order is None:
-			table.insert({
-				"placed_at": now_str,
-				"updated_at": now_str,
-				"address_id": None,
-				"user_id": user_id,
-				"item_id": item_id,
-				"shop_id": shop_id,
-				"quantity": 1,
-				"status": OrderStatus.Cart.name
-			})
-			return 1
-		else:
-			table.update({"updated_at": now_str, "quantity": order.quantity + 1}, doc_ids=[order.id])
-			return order.quantity + 1
+	def new_order(self, user_id: int, item_id: int, shop_id: int) -> int:
+		return self.change_cart(user_id, [(shop_id, item_id, 1)])[(shop_id, item_id)]
 
 	def decrease_order_quantity(self, user_id: int, item_id: int, shop_id: int) -> int:
-		table = self.get_table(Table.orders)
-		now = arrow.now("UTC")
-		now_str = now.isoformat()
-
-		order = self.get_order(user_id, item_id, shop_id, OrderStatus.Cart)
-		if order is None:
-			return 0
-		else:
-			if order.quantity == 1:
-				table.remove(doc_ids=[order.id])
-				return 0
-			table.update({"updated_at": now_str, "quantity": order.quantity - 1}, doc_ids=[order.id])
-			return order.quantity - 1
+		return self.change_cart(user_id, [(shop_id, item_id, -1)])[(shop_id, item_id)]
+
+	def change_cart(self, user_id: int, changes: Iterable[Tuple[int, int, int]]) -> Dict[Tuple[int, int], int]:
+		# applies (shop_id, item_id, delta) changes to the cart in one transaction, all or none of them
+		# -> (shop_id, item_id) -> resulting quantity
+		deltas: Dict[Tuple[int, int], int] = {}
+		for shop_id, item_id, delta in changes:
+			deltas[(shop_id, item_id)] = deltas.get((shop_id, item_id), 0) + delta
+		now_str = arrow.now("UTC").isoformat()
+
+		with self.locks.hold((Table.carts, user_id)), self.storage.transaction():
+			cart = self.get_cart(user_id)
+			shops = self.get_shops_by_ids(shop_id for shop_id, _ in deltas)
+			items = self.get_items_by_ids(item_id for _, item_id in deltas)
+			# everything is checked before the first write: tinydb transactions can't roll back
+			for shop_id, item_id in deltas:
+				if shop_id not in shops:
+					raise ValueError(f"no shop {shop_id}")
+				if item_id not in items:
+					raise ValueError(f"no item {item_id}")
+			# removals first, so emptying the cart and filling it from another pincode is one batch
+			for (shop_id, item_id), delta in sorted(deltas.items(), key=lambda kv: kv[1]):
+				pincode = shops[shop_id].address.pincode
+				if delta <= 0 and cart.quantity(shop_id, item_id) == 0:
+					continue # nothing to take out, and no reason to look at the shop's pincode
+				if delta > 0 and cart.pincode is not None and cart.pincode != pincode:
+					raise CartPincodeMismatch(pincode)
+				cart = cart.changed(shop_id, item_id, delta, items[item_id].price, pincode)
+				if cart.quantity(shop_id, item_id) > MAX_LINE_QUANTITY:
+					raise ValueError(f"at most {MAX_LINE_QUANTITY} of an item from one shop")
+
+			events = []
+			for shop_id, item_id in deltas:
+				quantity = cart.quantity(shop_id, item_id)
+				order = self.get_order(user_id, item_id, shop_id, OrderStatus.Cart)
+				previous = order.quantity if order is not None else 0
+				order_id = order.id if order is not None else None
+				if order is None and quantity > 0:
+					order_id = self.storage.insert(Table.orders, {
+						"placed_at": now_str,
+						"updated_at": now_str,
+						"address_id": None,
+						"user_id": user_id,
+						"item_id": item_id,
+						"shop_id": shop_id,
+						"quantity": quantity,
+						"status": OrderStatus.Cart.name
+					})
+				elif order is not None and quantity == 0:
+					self.storage.remove(Table.orders, doc_ids=[order.id])
+				elif order is not None and quantity != order.quantity:
+					self.storage.update(Table.orders, {"quantity": quantity, "updated_at": now_str}, doc_ids=[order.id])
+				if quantity != previous:
+					kind = reports.CART_ADD if quantity > previous else reports.CART_REMOVE
+					events.append(reports.event(kind, now_str, order_id, user_id, shop_id, item_id, # type: ignore
+						shops[shop_id].address.pincode, abs(quantity - previous), items[item_id].price))
+			self.save_cart(cart)
+			self.record_order_events(events)
+			return {key: cart.quantity(*key) for key in deltas}
 
 	def place_orders(self, user_id: int, address_id: int):
-		table = self.get_table(Table.orders)
 		now = arrow.now("UTC")
 		now_str = now.isoformat()
 
-		OrderQuery = Query()
-		table.update({
-			"address_id": address_id,
-			"status": OrderStatus.Placed.name,
-			"updated_at": now_str
-		}, (OrderQuery.status == OrderStatus.Cart.name) & (OrderQuery.user_id == user_id))
-
-	def get_shops(self, pincode: int) -> List[Shop]:
-		table = self.get_table(Table.shops)
-		ShopQuery = Query()
-		shops = table.all()
-		address_id_to_shop = {shop['address_id']: shop for shop in shops}
-		rv = []
-		for add_id, shop in address_id_to_shop.items():
-			address = self.get_address(add_id)
-			if address.pincode == pincode:
-				rv.append(Shop.from_doc(shop, address))
-		return sorted(rv, key=lambda s: -s.id)
+		with self.locks.hold((Table.carts, user_id)), self.storage.transaction():
+			cart = self.get_cart(user_id)
+			orders = self.storage.search(Table.orders, user_id=user_id, status=OrderStatus.Cart.name)
+			if orders:
+				self.storage.update(Table.orders, {
+					"address_id": address_id,
+					"status": OrderStatus.Placed.name,
+					"placed_at": now_str, # until now the time the item went into the cart
+					"updated_at": now_str
+				}, doc_ids=[o.doc_id for o in orders])
+			shops = self.get_shops_by_ids(o['shop_id'] for o in orders)
+			items = self.get_items_by_ids(o['item_id'] for o in orders)
+			# sold at the price the cart showed
+			price = lambda o: cart.lines[(o['shop_id'], o['item_id'])].price if (o['shop_id'], o['item_id']) in cart.lines else items[o['item_id']].price
+			self.record_order_events([
+				reports.event(reports.PLACED, now_str, o.doc_id, user_id, o['shop_id'], o['item_id'],
+					shops[o['shop_id']].address.pincode, o['quantity'], price(o))
+				for o in orders
+			])
+			self.save_cart(Cart.empty(user_id))
+
+	def deliver_orders(self, shop_id: int, order_ids: Iterable[int]) -> List[int]:
+		# marks the shop's placed orders among `order_ids` delivered, in one transaction
+		# -> the ids that changed; others (another shop's, not placed, unknown) are left alone
+		order_ids = list(order_ids)
+		if len(order_ids) > MAX_DELIVERIES:
+			raise ValueError(f"at most {MAX_DELIVERIES} orders at once")
+		now_str = arrow.now("UTC").isoformat()
+		deliverable = lambda d: d['shop_id'] == shop_id and d['status'] == OrderStatus.Placed.name
+		# looked up first and checked again inside the transaction, which then only touches the shop's
+		# orders (and so, with a `ShardedStorage`, only the shop's shard)
+		candidates = [d for d in self.storage.get_many(Table.orders, order_ids) if deliverable(d)]
+		if not candidates:
+			return []
+		items = self.get_items_by_ids(d['item_id'] for d in candidates)
+		with self.storage.transaction():
+			delivered = [d for d in self.storage.get_many(Table.orders, [d.doc_id for d in candidates]) if deliverable(d)]
+			if delivered:
+				self.storage.update(Table.orders, {"status": OrderStatus.Delivered.name, "updated_at": now_str}, doc_ids=[d.doc_id for d in delivered])
+			self.record_order_events([self.lifecycle_event(reports.DELIVERED, now_str, d, items) for d in delivered])
+			return [d.doc_id for d in delivered]
+
+	def lifecycle_event(self, kind: str, at: str, order: Document, items: Dict[int, Item]) -> Dict[str, Any]:
+		# priced like the order's placed event, or at today's price (from `items`) for orders placed before the log existed
+		placed = self.storage.find_one(Table.order_events, order_id=order.doc_id, kind=reports.PLACED)
+		if placed is not None:
+			price, pincode = placed['price'], placed['pincode']
+		else:
+			price, pincode = items[order['item_id']].price, self.get_shop(order['shop_id']).address.pincode # type: ignore
+		return reports.event(kind, at, order.doc_id, order['user_id'], order['shop_id'], order['item_id'], pincode, order['quantity'], price)
+
+	def record_order_events(self, events: List[Dict[str, Any]]):
+		# appends to the order event log and folds the events into the rollups, in the same transaction
+		if not events:
+			return
+		with self.storage.transaction():
+			for e in events:
+				self.storage.insert(Table.order_events, e)
+			self.bump_rollups(reports.fold(events))
+
+	def bump_rollups(self, deltas: Dict[Tuple[str, int, int], Dict[str, Any]]):
+		for (day, shop_id, item_id), counters in deltas.items():
+			doc = self.storage.find_one(Table.rollups, day=day, shop_id=shop_id, item_id=item_id)
+			if doc is None:
+				self.storage.insert(Table.rollups, {
+					"day": day, "shop_id": shop_id, "item_id": item_id, "pincode": counters["pincode"],
+					**{name: counters.get(name, 0) for name in reports.COUNTERS},
+				})
+			else:
+				self.storage.update(Table.rollups, {name: doc[name] + counters[name] for name in reports.COUNTERS if name in counters},
+					doc_ids=[doc.doc_id])
+
+	def rebuild_rollups(self) -> int:
+		# replays the whole event log, -> rollup rows; one transaction per pincode, so a `ShardedStorage`
+		# locks one shard at a time
+		pincodes = {e['pincode'] for e in self.storage.all(Table.order_events)} | {r['pincode'] for r in self.storage.all(Table.rollups)}
+		for pincode in sorted(pincodes):
+			with self.storage.transaction():
+				stale = [d.doc_id for d in self.storage.search(Table.rollups, pincode=pincode)]
+				if stale:
+					self.storage.remove(Table.rollups, stale)
+				self.bump_rollups(reports.fold(self.storage.search(Table.order_events, pincode=pincode)))
+		return self.storage.count(Table.rollups)
+
+	def backfill_order_events(self) -> int:
+		# logs placed (and delivered) events for the orders placed before the event log existed, -> events logged;
+		# one transaction per shop, each checking again that no placed event was logged meanwhile
+		logged = {e['order_id'] for e in self.storage.all(Table.order_events) if e['kind'] == reports.PLACED}
+		orders = [o for o in self.storage.all(Table.orders) if o['status'] != OrderStatus.Cart.name and o.doc_id not in logged]
+		items = self.get_items_by_ids(o['item_id'] for o in orders)
+		by_shop: Dict[int, List[Document]] = {}
+		for order in orders:
+			by_shop.setdefault(order['shop_id'], []).append(order)
+		count = 0
+		for shop_orders in by_shop.values():
+			with self.storage.transaction():
+				events = []
+				for order in shop_orders:
+					if self.storage.find_one(Table.order_events, order_id=order.doc_id, kind=reports.PLACED) is not None:
+						continue
+					events.append(self.lifecycle_event(reports.PLACED, order['placed_at'], order, items))
+					if order['status'] == OrderStatus.Delivered.name:
+						events.append(self.lifecycle_event(reports.DELIVERED, order['updated_at'], order, items))
+				self.record_order_events(events)
+				count += len(events)
+		return count
+
+	def sales_report(self, group_by: List[str], since: Optional[str] = None, until: Optional[str] = None,
+			shop_id: Optional[int] = None, item_id: Optional[int] = None, pincode: Optional[int] = None) -> SalesReport:
+		# sums the rollups of [since, until) ("YYYY-MM-DD" days) per `group_by` (keys of `reports.GROUPS`)
+		filters = {f: v for f, v in (("shop_id", shop_id), ("item_id", item_id), ("pincode", pincode)) if v is not None}
+		if filters:
+			field, value = next(iter(filters.items()))
+			rows = self.storage.search(Table.rollups, **{field: value})
+		elif since is not None and until is not None and len(reports.days(since, until)) <= reports.MAX_REPORT_DAYS:
+			rows = [r for day in reports.days(since, until) for r in self.storage.search(Table.rollups, day=day)]
+		else:
+			rows = self.storage.all(Table.rollups)
+		rows = [
+			r for r in rows
+			if all(r[f] == v for f, v in filters.items()) and (since is None or r['day'] >= since) and (until is None or r['day'] < until)
+		]
+		return SalesReport(*reports.aggregate(rows, group_by))
+
+	def get_shops(self, pincode: int, page_no: int = 0, page_size: int = SHOPS_PER_PAGE) -> List[Shop]:
+		self.sync()
+		shop_ids = self.pincode_index.page(pincode, page_no * page_size, page_size)
+		shops = {s.doc_id: s for s in self.storage.get_many(Table.shops, shop_ids)}
+		return [Shop.from_doc(shops[i], self.pincode_index.address_of(i)) for i in shop_ids if i in shops]
+
+	def count_shops(self, pincode: int) -> int:
+		self.sync()
+		return self.pincode_index.count(pincode)
 
 	def get_shop(self, shop_id: int) -> Optional[Shop]:
-		table = self.get_table(Table.shops)
-		shop = table.get(doc_id=shop_id)
+		shop = self.storage.get(Table.shops, shop_id)
 		if shop is None:
 			return None
 		address = self.get_address(shop['address_id'])
 		return Shop.from_doc(shop, address=address)
 
+	def get_shops_by_ids(self, shop_ids: Iterable[int]) -> Dict[int, Shop]:
+		shops = self.storage.get_many(Table.shops, shop_ids)
+		addresses = self.get_addresses_by_ids(s['address_id'] for s in shops)
+		return {s.doc_id: Shop.from_doc(s, addresses[s['address_id']]) for s in shops}
+
 	def get_items(self, shop: Shop) -> List[Item]:
-		return [self.get_item(i) for i in shop.items]
+		items = self.get_items_by_ids(shop.items)
+		return [items[i] for i in shop.items]
+
+	def search_items(self, query: str, pincode: Optional[int] = None, shop_id: Optional[int] = None,
+			min_price: Optional[float] = None, max_price: Optional[float] = None,
+			page_no: int = 0, page_size: int = SEARCH_PER_PAGE, max_shops: int = SEARCH_SHOPS_PER_ITEM) -> SearchPage:
+		self.sync()
+		hits, total = self.search_index.search(query, pincode, shop_id, min_price, max_price, page_no * page_size, page_size, max_shops)
+		items = self.get_items_by_ids(item_id for item_id, _, _ in hits)
+		return SearchPage([items[i] for i, _, _ in hits if i in items], {i: s for i, s, _ in hits}, {i: n for i, _, n in hits}, total)
+
+	def get_items_by_ids(self, item_ids: Iterable[int]) -> Dict[int, Item]:
+		items = {}
+		missing = []
+		for item_id in set(item_ids):
+			item = self.item_map.get(item_id)
+			if item is None:
+				missing.append(item_id)
+			else:
+				items[item_id] = item
+		if missing:
+			items.update((i.doc_id, self.doc_to_item(i)) for i in self.storage.get_many(Table.items, missing))
+		return items
 
 	def get_item(self, item_id: int) -> Item:
-		table = self.get_table(Table.items)
-		item = table.get(doc_id=item_id)
+		cached = self.item_map.get(item_id)
+		if cached is not None:
+			return cached
+		item = self.storage.get(Table.items, item_id)
 		if item is None:
 			raise Exception
 		return self.doc_to_item(item)
 
 	def create_session(self, user_id: int) -> Session:
-		table = self.get_table(Table.sessions)
-		now = arrow.now("UTC")
-		now_str = now.isoformat()
-		token = uuid.uuid4().hex
-		id = table.insert({"created_at": now_str, "user_id": user_id, "token": token})
-		return self.doc_to_session(table.get(doc_id=id)) # type: ignore
+		return self.sessions.create(user_id)
 
 	def get_session(self, token: str) -> Optional[Session]:
-		table = self.get_table(Table.sessions)
-		query = Query()
-		session = table.get(query.token == token)
-		if session is None:
-			return None
-		return self.doc_to_session(session)
+		return self.sessions.get(token)
+
+	def session_seconds_left(self, session: Session) -> float:
+		return self.sessions.seconds_left(session)
 
 	def get_logged_in_user(self, token: str) -> Optional[User]:
+		self.sync()
+		user = self.user_cache.get(token)
+		if user is not None:
+			return user
 		session = self.get_session(token)
 		if session is None:
 			return None
-		user_table = self.get_table(Table.users)
 
-		user = user_table.get(doc_id=session.user_id)
+		user = self.storage.get(Table.users, session.user_id)
 		if user is None:
 			return None
-		return self.get_user(user['email'], user['password'])
+		user = self.doc_to_user(user)
+		self.user_cache.set(token, user, ttl=self.session_seconds_left(session))
+		return user
 
 	def logout_session(self, token: str):
-		session = self.get_session(token)
-		table = self.get_table(Table.sessions)
-		table.remove(doc_ids=[session.id])
+		self.user_cache.pop(token)
+		self.sessions.remove(token)
+		self.publish("session", token)
 
 	def get_addreses(self, user_id: int) -> List[Address]:
-		table = self.get_table(Table.addresses)
-		AddressQuery = Query()
-		addresses = table.search(AddressQuery.user_id == user_id)
-		return [Address.from_doc(a) for a in addresses]
+		addresses = self.storage.search(Table.addresses, user_id=user_id)
+		return [self.doc_to_address(a) for a in addresses]
 	
 	def add_address_to_user(self, address_id: int, user_id: int):
-		table = self.get_table(Table.users)
-		user = table.get(doc_id=user_id)
-		assert user is not None
-		table.update({"address_ids": user["address_ids"] + [address_id]}, doc_ids=[user_id])
+		self.storage.append(Table.users, user_id, "address_ids", address_id)
+		self.user_cache.pop_where(lambda u: u.id == user_id)
+		self.publish("user", user_id)
 
 
 	def add_address(self, person_name: str, pincode: int, building: str, city: str,
 		district: str, state: str, landmark: Optional[str]=None, street: Optional[str]=None,) -> int:
-		table = self.get_table(Table.addresses)
-		return table.insert({
+		doc = {
 			"person_name": person_name,
 			"pincode": pincode,
 			"building": building,
@@ -223,75 +562,48 @@ class Database:
 			"state": state,
 			"landmark": landmark,
 			"street": street,
-		})
+		}
+		address_id = self.storage.insert(Table.addresses, doc)
+		self.pincode_index.add_address(self.doc_to_address(Document(doc, address_id)))
+		return address_id
+
+	def get_addresses_by_ids(self, address_ids: Iterable[int]) -> Dict[int, Address]:
+		addresses = {}
+		missing = []
+		for address_id in set(address_ids):
+			address = self.address_map.get(address_id)
+			if address is None:
+				missing.append(address_id)
+			else:
+				addresses[address_id] = address
+		if missing:
+			addresses.update((a.doc_id, self.doc_to_address(a)) for a in self.storage.get_many(Table.addresses, missing))
+		return addresses
 
 	def get_address(self, address_id: int) -> 'Address':
-		table = self.get_table(Table.addresses)
-		address = table.get(doc_id=address_id)
+		cached = self.address_map.get(address_id)
+		if cached is not None:
+			return cached
+		address = self.storage.get(Table.addresses, address_id)
 		if address is None:
 			raise Exception
-		return Address.from_doc(address)
+		return self.doc_to_address(address)
 
 
-	@classmethod
-	def doc_to_session(cls, doc: Document) -> Session:
-		return Session(doc.doc_id, doc['user_id'], arrow.get(doc['created_at']), doc['token'])
+	def doc_to_item(self, doc: Document) -> Item:
+		return self.item_map.intern(doc.doc_id, Item.from_doc(doc))
 
-	@classmethod
-	def doc_to_item(cls, doc: Document) -> Item:
-		return Item(doc.doc_id, doc['name'], doc['price'], doc['image_name'])
+	def doc_to_address(self, doc: Document) -> Address:
+		return self.address_map.intern(doc.doc_id, Address.from_doc(doc))
 
 
 if __name__ == "__main__": # testing
 	import os
-	from faker import Faker
-	import httpx
-	from pathlib import Path
-	from tqdm import tqdm
-	from tqdm.asyncio import tqdm_asyncio
-	import asyncio as aio
-	res = httpx.get('https://fakestoreapi.com/products')
-	items = res.json()
-	image_dir = Path("static")
-	image_dir.mkdir(exist_ok=True, parents=True)
-	fake = Faker("en_IN")
+	from .seed import seed_demo
+	from .importer import open_import_storage
 	if os.path.exists("rental.json"):
 		os.remove("rental.json")
-	db = Database("rental.json")
-	item_ids = []
-	pincodes = [(332404, "Reengus"), (332001, "Mumbai")] + [(int(fake.postcode()), fake.city()) for i in range(0)]
-	shop_ids = []
-
-	async def get_image(item):
-		async with httpx.AsyncClient() as conn:
-			a = await conn.get(item['image'])
-		image_name: str = item['image'].split("/")[-1]
-		(image_dir / image_name).write_bytes(a.content)
-
-		item_ids.append(db.new_item(item['title'], item['price'] * 70, image_name))
-
-	async def get_images():
-		await tqdm_asyncio.gather([get_image(item) for item in items])
-
-
-	aio.run(get_images())
-
-	print("items done")
-	# add new user like this
-	db.new_user("ankit", "saini", "ankit@nkit.dev", "some")
-	user = db.get_user("ankit@nkit.dev", "some")
-	assert user is not None
-	for i in range(2):
-		for (code, city) in pincodes:
-			address_id = db.add_address(fake.first_name(), code, fake.building_number(), city, "Dist" or fake.district(), fake.state(), street=fake.street_name())
-			db.add_address_to_user(address_id, user.id)
-
-	# add new shop like this
-	for i in tqdm(range(30)):
-		for (code, city) in tqdm(pincodes):
-			address_id = db.add_address(fake.first_name(), code, fake.building_number(), city, "Dist" or fake.district(), fake.state(), street=fake.street_name())
-			shop_ids.append(db.new_shop(fake.first_name() + " Store", address_id))
-
-	for it_id in tqdm(item_ids):
-		for sh_id in tqdm(shop_ids):
-			db.add_item_to_shop(sh_id, it_id)
+	# built in memory and written out once on close, see `app.importer` for loading real data
+	db = Database("rental.json", storage=open_import_storage("rental.json"))
+	seed_demo(db)
+	db.close()
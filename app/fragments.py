@@ -0,0 +1,72 @@
+import threading
+import uuid
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Any, Dict, Hashable, Mapping, Optional, Tuple
+
+import jinja2
+from markupsafe import Markup
+
+
+class CountSlots:
+	# stands in for the per-user `counts` while a fragment is rendered for the cache,
+	# every `counts[item_id]` becomes a slot, delimited by a marker no data can contain
+	def __init__(self) -> None:
+		self.marker = f"<!--{uuid.uuid4().hex}-->"
+
+	def __getitem__(self, item_id: int) -> Markup:
+		return Markup(f"{self.marker}{item_id}{self.marker}")
+
+
+@dataclass(frozen=True)
+class Fragment:
+	parts: Tuple[str, ...] # literal html at even indexes, item ids of count slots at odd ones
+
+	def fill(self, counts: Optional[Mapping[int, int]] = None) -> Markup:
+		counts = counts or {}
+		return Markup("".join(p if i % 2 == 0 else str(counts.get(int(p), 0)) for i, p in enumerate(self.parts)))
+
+
+class FragmentCache:
+	# rendered catalog fragments, valid until the catalog version they were rendered at changes
+	def __init__(self, env: jinja2.Environment, maxsize: int = 1024) -> None:
+		self.env = env
+		self.maxsize = maxsize
+		self.entries: "OrderedDict[Hashable, Tuple[Any, Fragment]]" = OrderedDict()
+		self.lock = threading.Lock()
+
+	def get(self, key: Hashable, version: Any) -> Optional[Fragment]:
+		with self.lock:
+			entry = self.entries.get(key)
+			if entry is None or entry[0] != version:
+				return None
+			self.entries.move_to_end(key)
+			return entry[1]
+
+	def render(self, template_name: str, key: Hashable, version: Any, context: Dict[str, Any]) -> Fragment:
+		# `version` must be read before the data in `context` was fetched, so a concurrent catalog
+		# change can only make the entry look older than it is, never newer
+		slots = CountSlots()
+		html = self.env.get_template(template_name).render(counts=slots, **context)
+		fragment = Fragment(tuple(html.split(slots.marker)))
+		with self.lock:
+			self.entries[key] = (version, fragment)
+			self.entries.move_to_end(key)
+			while len(self.entries) > self.maxsize:
+				self.entries.popitem(last=False)
+		return fragment
+
+	def clear(self):
+		with self.lock:
+			self.entries.clear()
+
+	def __len__(self) -> int:
+		return len(self.entries)
+
+
+def precompile(env: jinja2.Environment) -> int:
+	# compiles every template up front (and fills the bytecode cache) instead of on the first hits
+	names = env.list_templates(extensions=["html"])
+	for name in names:
+		env.get_template(name)
+	return len(names)
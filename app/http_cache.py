@@ -0,0 +1,168 @@
+import gzip
+import hashlib
+import mimetypes
+import os
+import threading
+from dataclasses import dataclass, field
+from typing import Any, Dict, Iterable, List, Mapping, Optional, Tuple
+
+from starlette.requests import Request
+from starlette.responses import FileResponse, PlainTextResponse, Response
+from starlette.types import Receive, Scope, Send
+
+try:
+	import brotli
+except ImportError: # optional, gzip only without it
+	brotli = None
+
+DIGEST_LENGTH = 12
+IMMUTABLE = "public, max-age=31536000, immutable"
+REVALIDATE = "public, max-age=3600" # unversioned asset urls
+PAGE_PUBLIC = "public, no-cache" # catalog pages: always revalidate, the ETag makes that a 304
+PAGE_PRIVATE = "private, no-cache"
+TEXT_SUFFIXES = (".css", ".js", ".map", ".html", ".svg", ".json", ".txt")
+MIN_COMPRESS_SIZE = 1024
+# catalog versions are counted per process, so page validators from another process (or an
+# earlier run) must never match
+PROCESS_TAG = os.urandom(8).hex()
+
+
+def page_etag(*parts: Any) -> str:
+	# strong validator for a rendered page, from everything the page's bytes depend on
+	digest = hashlib.sha256(repr((PROCESS_TAG, parts)).encode()).hexdigest()[:2 * DIGEST_LENGTH]
+	return f'"{digest}"'
+
+
+def etag_matches(request: Request, etag: str) -> bool:
+	header = request.headers.get("if-none-match")
+	if header is None:
+		return False
+	return header.strip() == "*" or etag in [t.strip() for t in header.split(",")]
+
+
+def not_modified(etag: str, cache_control: str) -> Response:
+	return Response(status_code=304, headers={"ETag": etag, "Cache-Control": cache_control})
+
+
+def with_validators(response: Response, etag: str, cache_control: str) -> Response:
+	response.headers["ETag"] = etag
+	response.headers["Cache-Control"] = cache_control
+	return response
+
+
+def accepted_encodings(request_headers: Mapping[str, str]) -> List[str]:
+	rv = []
+	for token in request_headers.get("accept-encoding", "").split(","):
+		name, _, params = token.strip().partition(";")
+		if params.replace(" ", "") in ("q=0", "q=0.0", "q=0.00", "q=0.000"):
+			continue
+		rv.append(name.strip().lower())
+	return rv
+
+
+@dataclass
+class Asset:
+	name: str # path relative to its directory, as used in urls
+	path: str
+	digest: str
+	size: int
+	media_type: str
+	variants: Dict[str, bytes] = field(default_factory=dict) # content-encoding -> compressed body
+
+	@property
+	def compressible(self) -> bool:
+		return self.name.endswith(TEXT_SUFFIXES) and self.size >= MIN_COMPRESS_SIZE
+
+
+class AssetStore:
+	# files under `directories` (earlier ones win on a name clash), addressed by content hash:
+	# `/static/<digest>/<name>` never changes meaning, so it is served as immutable
+	def __init__(self, directories: Iterable[str], prefix: str = "/static") -> None:
+		self.directories = list(directories)
+		self.prefix = prefix
+		self.assets: Dict[str, Asset] = {}
+		self.lock = threading.Lock()
+		self.scan()
+
+	def scan(self):
+		assets = {}
+		for directory in reversed(self.directories):
+			if not os.path.isdir(directory):
+				continue
+			for root, _, files in os.walk(directory):
+				for filename in files:
+					path = os.path.join(root, filename)
+					name = os.path.relpath(path, directory).replace(os.sep, "/")
+					media_type = mimetypes.guess_type(filename)[0] or "application/octet-stream"
+					assets[name] = Asset(name, path, self.file_digest(path), os.path.getsize(path), media_type)
+		with self.lock:
+			self.assets = assets
+
+	@staticmethod
+	def file_digest(path: str) -> str:
+		h = hashlib.sha256()
+		with open(path, "rb") as f:
+			for chunk in iter(lambda: f.read(1 << 16), b""):
+				h.update(chunk)
+		return h.hexdigest()[:DIGEST_LENGTH]
+
+	def url(self, name: str) -> str:
+		asset = self.assets.get(name)
+		if asset is None:
+			return f"{self.prefix}/{name}"
+		return f"{self.prefix}/{asset.digest}/{name}"
+
+	def precompress(self) -> int:
+		count = 0
+		for asset in list(self.assets.values()):
+			if asset.compressible:
+				self.variant(asset, "gzip")
+				if brotli is not None:
+					self.variant(asset, "br")
+				count += 1
+		return count
+
+	def variant(self, asset: Asset, encoding: str) -> bytes:
+		body = asset.variants.get(encoding)
+		if body is None:
+			with open(asset.path, "rb") as f:
+				raw = f.read()
+			body = brotli.compress(raw) if encoding == "br" else gzip.compress(raw, compresslevel=9, mtime=0)
+			asset.variants[encoding] = body
+		return body
+
+	def resolve(self, path: str) -> Tuple[Optional[Asset], bool]:
+		# -> (asset, whether the url carried its current digest)
+		digest, _, rest = path.partition("/")
+		if rest and len(digest) == DIGEST_LENGTH:
+			asset = self.assets.get(rest)
+			if asset is not None:
+				return asset, asset.digest == digest
+		return self.assets.get(path), False
+
+	async def __call__(self, scope: Scope, receive: Receive, send: Send):
+		request = Request(scope)
+		path, root_path = scope["path"], scope.get("root_path", "")
+		if root_path and path.startswith(root_path): # newer starlette keeps the full path under a Mount
+			path = path[len(root_path):]
+		asset, versioned = self.resolve(path.lstrip("/"))
+		if asset is None or request.method not in ("GET", "HEAD"):
+			await PlainTextResponse("Not Found", status_code=404)(scope, receive, send)
+			return
+		cache_control = IMMUTABLE if versioned else REVALIDATE
+		encoding = None
+		if asset.compressible:
+			accepted = accepted_encodings(request.headers)
+			encoding = next((e for e in ("br", "gzip") if e in accepted and (e != "br" or brotli is not None)), None)
+		etag = f'"{asset.digest}-{encoding}"' if encoding else f'"{asset.digest}"'
+		headers = {"ETag": etag, "Cache-Control": cache_control}
+		if asset.compressible:
+			headers["Vary"] = "Accept-Encoding"
+		if etag_matches(request, etag):
+			response: Response = Response(status_code=304, headers=headers)
+		elif encoding is not None:
+			headers["Content-Encoding"] = encoding
+			response = Response(self.variant(asset, encoding), media_type=asset.media_type, headers=headers)
+		else:
+			response = FileResponse(asset.path, media_type=asset.media_type, headers=headers)
+		await response(scope, receive, send)
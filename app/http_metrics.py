@@ -0,0 +1,53 @@
+import threading
+import time
+from typing import Any, Optional
+
+import jinja2
+from starlette.datastructures import MutableHeaders
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from .metrics import REGISTRY, RequestStats, SamplingProfiler, current, timer
+
+
+class TimedTemplate(jinja2.Template):
+	# `env.template_class`, so every page and fragment render is timed
+	def render(self, *args: Any, **kwargs: Any) -> str:
+		with timer("jinja"):
+			return super().render(*args, **kwargs)
+
+
+class MetricsMiddleware:
+	# collects `RequestStats` for every http request, adds a `Server-Timing` header and feeds `REGISTRY`
+	# (and the profiler, when one is given)
+	def __init__(self, app: ASGIApp, profiler: Optional[SamplingProfiler] = None) -> None:
+		self.app = app
+		self.profiler = profiler
+
+	async def __call__(self, scope: Scope, receive: Receive, send: Send):
+		if scope["type"] != "http":
+			await self.app(scope, receive, send)
+			return
+		stats = RequestStats()
+		stats.threads.add(threading.get_ident())
+		token = current.set(stats)
+		status = 500
+
+		async def send_with_timing(message: Message):
+			nonlocal status
+			if message["type"] == "http.response.start":
+				status = message["status"]
+				headers = MutableHeaders(scope=message)
+				headers.append("Server-Timing", stats.server_timing(time.perf_counter() - stats.started))
+			await send(message)
+
+		if self.profiler is not None:
+			self.profiler.begin()
+		try:
+			await self.app(scope, receive, send_with_timing)
+		finally:
+			current.reset(token)
+			seconds = time.perf_counter() - stats.started
+			route = getattr(scope.get("route"), "path", "<unmatched>")
+			REGISTRY.observe(route, scope["method"], status, seconds, stats)
+			if self.profiler is not None:
+				self.profiler.finish(stats, f"{scope['method']} {scope['path']}", seconds)
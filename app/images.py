@@ -0,0 +1,126 @@
+import argparse
+import os
+import tempfile
+from typing import List, Optional, Tuple
+
+from .http_cache import AssetStore
+from .locks import KeyedLocks
+
+try:
+	from PIL import Image, features
+except ImportError: # optional: without Pillow the original images are served as they are
+	Image = None
+	features = None
+
+WIDTHS = (100, 200, 400, 800) # 100 is the thumbnail, the rest cover a ~200px card at 1x-4x
+DEFAULT_WIDTH = 200
+CACHE_DIR = ".image_cache"
+SAVE_OPTIONS = {
+	"avif": {"quality": 50},
+	"webp": {"quality": 80, "method": 4},
+	"jpeg": {"quality": 82, "optimize": True, "progressive": True},
+	"png": {"optimize": True},
+}
+MEDIA_TYPES = {"avif": "image/avif", "webp": "image/webp", "jpeg": "image/jpeg", "png": "image/png"}
+IMAGE_SUFFIXES = (".jpg", ".jpeg", ".png", ".webp")
+
+
+class ImagePipeline:
+	# resized/re-encoded variants of the images in `assets`, generated on first use and kept on disk
+	# under `cache_dir/<source digest>/`, so a changed source image never serves a stale variant
+	def __init__(self, assets: AssetStore, cache_dir: str = CACHE_DIR) -> None:
+		self.assets = assets
+		self.cache_dir = cache_dir
+		self.locks = KeyedLocks()
+		self.formats = [f for f in ("avif", "webp") if Image is not None and features.check(f)] # type: ignore
+
+	@property
+	def available(self) -> bool:
+		return Image is not None
+
+	def is_image(self, name: str) -> bool:
+		return name.lower().endswith(IMAGE_SUFFIXES) and name in self.assets.assets
+
+	def snap_width(self, width: int) -> int:
+		return next((w for w in WIDTHS if w >= width), WIDTHS[-1])
+
+	def pick_format(self, name: str, accept: str) -> str:
+		for fmt in self.formats:
+			if MEDIA_TYPES[fmt] in accept:
+				return fmt
+		return "png" if name.lower().endswith(".png") else "jpeg"
+
+	def url(self, name: str, width: int = DEFAULT_WIDTH) -> str:
+		if not self.available or not self.is_image(name):
+			return self.assets.url(name)
+		return f"/images/{self.assets.assets[name].digest}/{self.snap_width(width)}/{name}"
+
+	def srcset(self, name: str) -> str:
+		if not self.available or not self.is_image(name):
+			return ""
+		return ", ".join(f"{self.url(name, w)} {w}w" for w in WIDTHS)
+
+	def variant_path(self, name: str, width: int, fmt: str) -> str:
+		asset = self.assets.assets[name]
+		stem = os.path.splitext(name)[0]
+		return os.path.join(self.cache_dir, asset.digest, f"{stem}-{width}.{fmt}")
+
+	def variant(self, name: str, width: int, fmt: str) -> str:
+		# blocking (Pillow), call it off the event loop
+		path = self.variant_path(name, width, fmt)
+		if os.path.exists(path):
+			return path
+		with self.locks.hold(path):
+			if not os.path.exists(path):
+				self.generate(self.assets.assets[name].path, path, width, fmt)
+		return path
+
+	def generate(self, source: str, target: str, width: int, fmt: str):
+		os.makedirs(os.path.dirname(target), exist_ok=True)
+		with Image.open(source) as img: # type: ignore
+			img.thumbnail((width, width * 4)) # keeps the aspect ratio and never upscales
+			if fmt == "jpeg" and img.mode not in ("RGB", "L"):
+				img = img.convert("RGB")
+			fd, tmp = tempfile.mkstemp(dir=os.path.dirname(target), suffix=".tmp")
+			try:
+				with os.fdopen(fd, "wb") as f:
+					img.save(f, fmt.upper(), **SAVE_OPTIONS[fmt])
+				os.replace(tmp, target)
+			except BaseException:
+				os.unlink(tmp)
+				raise
+
+	def warm(self, names: Optional[List[str]] = None) -> int:
+		# pre-generates every variant, e.g. right after an import
+		count = 0
+		names = names if names is not None else [n for n in self.assets.assets if self.is_image(n)]
+		fallback = lambda name: "png" if name.lower().endswith(".png") else "jpeg"
+		for name in names:
+			if not self.is_image(name):
+				continue
+			for width in WIDTHS:
+				for fmt in self.formats + [fallback(name)]:
+					self.variant(name, width, fmt)
+					count += 1
+		return count
+
+	def resolve(self, digest: str, name: str) -> Tuple[bool, bool]:
+		# -> (known image, whether `digest` is its current one)
+		if not self.is_image(name):
+			return False, False
+		return True, self.assets.assets[name].digest == digest
+
+
+def main():
+	parser = argparse.ArgumentParser(description="pre-generate the resized/webp/avif variants of the item images")
+	parser.add_argument("--images", nargs="*", default=["rental", "static"], help="image directories, as served under /static")
+	parser.add_argument("--cache-dir", default=CACHE_DIR)
+	args = parser.parse_args()
+	pipeline = ImagePipeline(AssetStore(args.images), args.cache_dir)
+	if not pipeline.available:
+		parser.error("Pillow is not installed: pip install Pillow")
+	print(f"{pipeline.warm()} variants in {args.cache_dir}/ ({', '.join(pipeline.formats + ['jpeg/png'])})")
+
+
+if __name__ == "__main__":
+	main()
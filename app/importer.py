@@ -0,0 +1,196 @@
+import argparse
+import csv
+import json
+import os
+import shutil
+from collections import defaultdict
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Optional, Set
+
+from tinydb.table import Document
+
+from .http_cache import AssetStore
+from .images import ImagePipeline
+from .storage import SQLiteStorage, Storage, Table, TinyDBStorage, SQLITE_SUFFIXES
+from .write_behind import WriteBehindConfig
+
+BATCH_SIZE = 10_000
+
+
+def read_rows(path: str) -> Iterator[Dict[str, Any]]:
+	# .csv or .jsonl, one record per row/line, streamed
+	with open(path, newline="", encoding="utf-8") as f:
+		if path.endswith(".csv"):
+			yield from csv.DictReader(f)
+		else:
+			for line in f:
+				if line.strip():
+					yield json.loads(line)
+
+
+def with_ids(rows: Iterator[Dict[str, Any]]) -> Iterator[Dict[str, Any]]:
+	# rows without an `id` get their 1-based position, which is what the other files refer to
+	for n, row in enumerate(rows, start=1):
+		row["id"] = int(row.get("id") or n)
+		yield row
+
+
+def optional(value: Any) -> Optional[str]:
+	return value if value not in (None, "") else None
+
+
+def batched(docs: Iterator[Document], size: int = BATCH_SIZE) -> Iterator[List[Document]]:
+	batch = []
+	for doc in docs:
+		batch.append(doc)
+		if len(batch) == size:
+			yield batch
+			batch = []
+	if batch:
+		yield batch
+
+
+class Importer:
+	def __init__(self, storage: Storage, image_dir: str = "rental") -> None:
+		self.storage = storage
+		self.image_dir = Path(image_dir)
+		self.counts: Dict[str, int] = defaultdict(int)
+		# the doc ids inserted so far, the later files' references are checked against them
+		self.ids: Dict[Table, Set[int]] = defaultdict(set)
+		self.missing_images: List[str] = []
+
+	def insert(self, table: Table, docs: Iterator[Document]):
+		for batch in batched(docs):
+			self.storage.insert_documents(table, batch)
+			self.counts[table.name] += len(batch)
+			self.ids[table].update(doc.doc_id for doc in batch)
+
+	def image_name(self, image: str) -> str:
+		# a bare name must already be in `image_dir`, a local path is copied into it
+		path = Path(image)
+		if path.parent != Path(".") and path.exists():
+			target = self.image_dir / path.name
+			if not target.exists():
+				shutil.copyfile(path, target)
+			return path.name
+		if not (self.image_dir / path.name).exists():
+			self.missing_images.append(path.name)
+		return path.name
+
+	def items(self, path: str):
+		self.insert(Table.items, (
+			Document({"name": row["name"], "price": float(row["price"]), "image_name": self.image_name(row["image"])}, row["id"])
+			for row in with_ids(read_rows(path))
+		))
+
+	def addresses(self, path: str) -> Dict[int, List[int]]:
+		user_addresses: Dict[int, List[int]] = defaultdict(list)
+
+		def docs():
+			for row in with_ids(read_rows(path)):
+				if optional(row.get("user_id")):
+					user_addresses[int(row["user_id"])].append(row["id"])
+				yield Document({
+					"person_name": row["person_name"],
+					"pincode": int(row["pincode"]),
+					"building": row["building"],
+					"city": row["city"],
+					"district": row["district"],
+					"state": row["state"],
+					"landmark": optional(row.get("landmark")),
+					"street": optional(row.get("street")),
+				}, row["id"])
+
+		self.insert(Table.addresses, docs())
+		return user_addresses
+
+	def users(self, path: str, user_addresses: Dict[int, List[int]]):
+		self.insert(Table.users, (
+			Document({
+				"first_name": row["first_name"],
+				"last_name": row["last_name"],
+				"email": row["email"],
+				"password": row["password"],
+				"address_ids": user_addresses.get(row["id"], []),
+			}, row["id"])
+			for row in with_ids(read_rows(path))
+		))
+
+	def shops(self, path: str, shop_items_path: Optional[str]):
+		# shops are held in memory while the (much larger) assignment file is streamed onto them
+		shops: Dict[int, Dict[str, Any]] = {}
+		for n, row in enumerate(with_ids(read_rows(path)), start=1):
+			address_id = int(row["address_id"])
+			if address_id not in self.ids[Table.addresses]:
+				raise ValueError(f"{path}, row {n}: address {address_id} doesn't exist")
+			shops[row["id"]] = {"name": row["name"], "address_id": address_id, "items": []}
+		if shop_items_path is not None:
+			for n, row in enumerate(read_rows(shop_items_path), start=1):
+				shop_id, item_id = int(row["shop_id"]), int(row["item_id"])
+				if shop_id not in shops:
+					raise ValueError(f"{shop_items_path}, row {n}: shop {shop_id} doesn't exist")
+				if item_id not in self.ids[Table.items]:
+					raise ValueError(f"{shop_items_path}, row {n}: item {item_id} doesn't exist")
+				shops[shop_id]["items"].append(item_id)
+		self.insert(Table.shops, (Document(doc, shop_id) for shop_id, doc in shops.items()))
+
+	def run(self, items: Optional[str] = None, addresses: Optional[str] = None, users: Optional[str] = None,
+			shops: Optional[str] = None, shop_items: Optional[str] = None) -> Dict[str, int]:
+		with self.storage.transaction():
+			if items is not None:
+				self.items(items)
+			user_addresses = self.addresses(addresses) if addresses is not None else {}
+			if users is not None:
+				self.users(users, user_addresses)
+			if shops is not None:
+				self.shops(shops, shop_items)
+		return dict(self.counts)
+
+
+def open_import_storage(db_path: str) -> Storage:
+	if db_path.endswith(SQLITE_SUFFIXES):
+		return SQLiteStorage(db_path)
+	# everything stays in memory and is written out once, atomically, on close
+	return TinyDBStorage(db_path, write_behind=WriteBehindConfig(flush_interval=3600, flush_bytes=1 << 40, journal=False))
+
+
+def main():
+	parser = argparse.ArgumentParser(description="build a rental database from csv/jsonl files in a single commit")
+	parser.add_argument("db", help="new database file, rental.json or *.sqlite3")
+	parser.add_argument("--items", help="name, price, image (file in --images or a local path to copy there)")
+	parser.add_argument("--addresses", help="person_name, pincode, building, city, district, state, landmark, street, [user_id]")
+	parser.add_argument("--users", help="first_name, last_name, email, password")
+	parser.add_argument("--shops", help="name, address_id")
+	parser.add_argument("--shop-items", help="shop_id, item_id")
+	parser.add_argument("--images", default="rental", help="directory the item images are served from")
+	parser.add_argument("--image-variants", action="store_true", help="also pre-generate the resized/webp/avif images (needs Pillow)")
+	args = parser.parse_args()
+
+	if os.path.exists(args.db) and os.path.getsize(args.db) > 0:
+		parser.error(f"{args.db} already exists")
+	storage = open_import_storage(args.db)
+	importer = Importer(storage, args.images)
+	failed = None
+	try:
+		counts = importer.run(args.items, args.addresses, args.users, args.shops, args.shop_items)
+	except ValueError as e:
+		failed = e
+	finally:
+		storage.close()
+	if failed is not None:
+		# a dangling reference: don't leave a half imported database behind
+		os.remove(args.db)
+		parser.error(str(failed))
+	for name, count in counts.items():
+		print(f"{name}: {count}")
+	if importer.missing_images:
+		print(f"{len(importer.missing_images)} items refer to images missing from {args.images}/, e.g. {importer.missing_images[0]}")
+	if args.image_variants:
+		pipeline = ImagePipeline(AssetStore([args.images]))
+		if not pipeline.available:
+			parser.error("--image-variants needs Pillow: pip install Pillow")
+		print(f"image variants: {pipeline.warm()}")
+
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,173 @@
+import bisect
+import operator
+from collections import defaultdict
+from typing import Any, Dict, Iterable, List, Optional, Set, Tuple
+
+from tinydb.table import Document
+
+from .models import Address
+
+
+class HashIndex:
+	def __init__(self, fields: Iterable[str]) -> None:
+		self.fields: Tuple[str, ...] = tuple(fields)
+		self.entries: Dict[tuple, Set[int]] = defaultdict(set)
+		self.getter = operator.itemgetter(*self.fields)
+
+	def key(self, doc: Dict[str, Any]) -> Optional[tuple]:
+		try:
+			key = self.getter(doc)
+			hash(key)
+		except (KeyError, TypeError): # missing or unhashable field, never matched by equality anyway
+			return None
+		return key if len(self.fields) > 1 else (key,)
+
+	def add(self, doc_id: int, doc: Dict[str, Any]):
+		key = self.key(doc)
+		if key is not None:
+			self.entries[key].add(doc_id)
+
+	def discard(self, doc_id: int, doc: Dict[str, Any]):
+		key = self.key(doc)
+		if key is None or key not in self.entries:
+			return
+		ids = self.entries[key]
+		ids.discard(doc_id)
+		if not ids:
+			del self.entries[key]
+
+	def lookup(self, cond: Dict[str, Any]) -> Set[int]:
+		key = self.key(cond)
+		if key is None:
+			return set()
+		return self.entries.get(key, set())
+
+	def clear(self):
+		self.entries.clear()
+
+	def rebuild(self, docs: Iterable[Tuple[int, Dict[str, Any]]]):
+		self.clear()
+		for doc_id, doc in docs:
+			self.add(doc_id, doc)
+
+
+class SortedIndex(HashIndex):
+	# per key, (order_by value, doc_id) pairs in ascending order, so a page is a bisect and a slice
+	def __init__(self, fields: Iterable[str], order_by: str) -> None:
+		super().__init__(fields)
+		self.order_by = order_by
+		self.sorted: Dict[tuple, List[Tuple[Any, int]]] = defaultdict(list)
+
+	def add(self, doc_id: int, doc: Dict[str, Any]):
+		key = self.key(doc)
+		if key is not None and doc.get(self.order_by) is not None:
+			bisect.insort(self.sorted[key], (doc[self.order_by], doc_id))
+
+	def discard(self, doc_id: int, doc: Dict[str, Any]):
+		key = self.key(doc)
+		if key is None or key not in self.sorted:
+			return
+		entries = self.sorted[key]
+		i = bisect.bisect_left(entries, (doc.get(self.order_by), doc_id))
+		if i < len(entries) and entries[i] == (doc.get(self.order_by), doc_id):
+			del entries[i]
+		if not entries:
+			del self.sorted[key]
+
+	def lookup(self, cond: Dict[str, Any]) -> Set[int]:
+		key = self.key(cond)
+		return {doc_id for _, doc_id in self.sorted.get(key, ())} if key is not None else set()
+
+	def page(self, cond: Dict[str, Any], limit: int, before: Optional[Tuple[Any, int]] = None) -> List[int]:
+		# newest first, only entries strictly below `before`
+		key = self.key(cond)
+		entries = self.sorted.get(key, []) if key is not None else []
+		end = bisect.bisect_left(entries, before) if before is not None else len(entries)
+		return [doc_id for _, doc_id in reversed(entries[max(end - limit, 0):end])]
+
+	def clear(self):
+		self.sorted.clear()
+
+	def rebuild(self, docs: Iterable[Tuple[int, Dict[str, Any]]]):
+		# one sort per key instead of an insort per document
+		self.clear()
+		for doc_id, doc in docs:
+			key = self.key(doc)
+			if key is not None and doc.get(self.order_by) is not None:
+				self.sorted[key].append((doc[self.order_by], doc_id))
+		for entries in self.sorted.values():
+			entries.sort()
+
+
+class TableIndexes:
+	def __init__(self, field_sets: Iterable[Iterable[str]], sorted_field_sets: Iterable[Tuple[Iterable[str], str]] = ()) -> None:
+		self.indexes: List[HashIndex] = [HashIndex(fields) for fields in field_sets]
+		self.sorted_indexes = [SortedIndex(fields, order_by) for fields, order_by in sorted_field_sets]
+		self.indexes.extend(self.sorted_indexes)
+
+	def find(self, fields: Iterable[str]) -> Optional[HashIndex]:
+		wanted = set(fields)
+		for index in self.indexes:
+			if set(index.fields) == wanted:
+				return index
+		return None
+
+	def find_sorted(self, fields: Iterable[str], order_by: str) -> Optional[SortedIndex]:
+		wanted = set(fields)
+		for index in self.sorted_indexes:
+			if set(index.fields) == wanted and index.order_by == order_by:
+				return index
+		return None
+
+	def add(self, docs: Iterable[Document]):
+		for doc in docs:
+			for index in self.indexes:
+				index.add(doc.doc_id, doc)
+
+	def discard(self, docs: Iterable[Document]):
+		for doc in docs:
+			for index in self.indexes:
+				index.discard(doc.doc_id, doc)
+
+	def rebuild(self, docs: Dict[str, Dict[str, Any]]):
+		# `docs` is the table as stored: str(doc_id) -> document
+		pairs = [(int(doc_id), doc) for doc_id, doc in docs.items()]
+		for index in self.indexes:
+			index.rebuild(pairs)
+
+
+class PincodeIndex:
+	def __init__(self) -> None:
+		self.shop_ids: Dict[int, List[int]] = defaultdict(list) # pincode -> shop ids, ascending
+		self.shop_addresses: Dict[int, int] = {} # shop id -> address id
+		self.addresses: Dict[int, Address] = {}
+
+	def add_address(self, address: Address):
+		self.addresses[address.id] = address
+
+	def add_shop(self, shop_id: int, address_id: int):
+		if shop_id in self.shop_addresses:
+			return
+		self.shop_addresses[shop_id] = address_id
+		bisect.insort(self.shop_ids[self.addresses[address_id].pincode], shop_id)
+
+	def rebuild(self, shops: Iterable[Document], addresses: Iterable[Address]):
+		self.shop_ids.clear()
+		self.shop_addresses.clear()
+		self.addresses.clear()
+		for address in addresses:
+			self.add_address(address)
+		for shop in shops:
+			self.add_shop(shop.doc_id, shop['address_id'])
+
+	def count(self, pincode: int) -> int:
+		return len(self.shop_ids.get(pincode, ()))
+
+	def page(self, pincode: int, offset: int, limit: int) -> List[int]:
+		# newest shops first
+		ids = self.shop_ids.get(pincode, [])
+		end = len(ids) - offset
+		return ids[max(end - limit, 0):max(end, 0)][::-1]
+
+	def address_of(self, shop_id: int) -> Address:
+		return self.addresses[self.shop_addresses[shop_id]]
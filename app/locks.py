@@ -0,0 +1,73 @@
+import contextlib
+import os
+import threading
+from typing import Dict, Hashable, Iterator, Tuple
+
+try:
+	import fcntl
+except ImportError: # windows
+	fcntl = None # type: ignore
+
+
+class KeyedLocks:
+	# one lock per key (e.g. a document), created on demand and dropped once nobody holds it
+	def __init__(self) -> None:
+		self.guard = threading.Lock()
+		self.locks: Dict[Hashable, Tuple[threading.Lock, int]] = {}
+
+	@contextlib.contextmanager
+	def hold(self, key: Hashable) -> Iterator[None]:
+		with self.guard:
+			lock, users = self.locks.get(key, (None, 0))
+			if lock is None:
+				lock = threading.Lock()
+			self.locks[key] = (lock, users + 1)
+		try:
+			with lock:
+				yield
+		finally:
+			with self.guard:
+				lock, users = self.locks[key]
+				if users == 1:
+					del self.locks[key]
+				else:
+					self.locks[key] = (lock, users - 1)
+
+
+class FileLock:
+	# advisory lock shared by every process opening the same database file
+	def __init__(self, path: str) -> None:
+		if fcntl is None:
+			raise RuntimeError("cross-process locking needs fcntl (not available on this platform)")
+		self.path = path
+		self.fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+
+	@contextlib.contextmanager
+	def shared(self) -> Iterator[None]:
+		fcntl.flock(self.fd, fcntl.LOCK_SH)
+		try:
+			yield
+		finally:
+			fcntl.flock(self.fd, fcntl.LOCK_UN)
+
+	@contextlib.contextmanager
+	def exclusive(self) -> Iterator[None]:
+		fcntl.flock(self.fd, fcntl.LOCK_EX)
+		try:
+			yield
+		finally:
+			fcntl.flock(self.fd, fcntl.LOCK_UN)
+
+	def generation(self) -> int:
+		# a write counter kept in the lock file itself, see `bump`
+		raw = os.pread(self.fd, 8, 0)
+		return int.from_bytes(raw, "little") if len(raw) == 8 else 0
+
+	def bump(self) -> int:
+		# under the exclusive lock, before every write of the database file
+		value = self.generation() + 1
+		os.pwrite(self.fd, value.to_bytes(8, "little"), 0)
+		return value
+
+	def close(self):
+		os.close(self.fd)
@@ -0,0 +1,268 @@
+import collections
+import contextlib
+import contextvars
+import os
+import sys
+import threading
+import time
+from dataclasses import dataclass, field
+from typing import Any, Callable, Deque, Dict, Iterable, Iterator, List, Optional, Set, Tuple
+
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+TIMERS = ("storage", "arrow", "jinja") # storage calls, timestamp parsing, template rendering
+
+
+@dataclass
+class RequestStats:
+	started: float = field(default_factory=time.perf_counter)
+	scans: int = 0 # full table scans (no index could answer the query)
+	fetches: int = 0 # documents handed from the storage to `Database`
+	bytes_written: int = 0
+	seconds: Dict[str, float] = field(default_factory=lambda: dict.fromkeys(TIMERS, 0.0))
+	threads: Set[int] = field(default_factory=set) # threads that worked on the request, for the profiler
+
+	def server_timing(self, total: float) -> str:
+		ms = lambda s: f"{s * 1000:.2f}"
+		return ", ".join([
+			f"app;dur={ms(total)}",
+			f'storage;dur={ms(self.seconds["storage"])};desc="{self.scans} scans, {self.fetches} docs, {self.bytes_written} B written"',
+			f"arrow;dur={ms(self.seconds['arrow'])}",
+			f"jinja;dur={ms(self.seconds['jinja'])}",
+		])
+
+
+# the stats of the request being served; `AsyncDatabase.run` copies the context into its executor
+current: contextvars.ContextVar[Optional[RequestStats]] = contextvars.ContextVar("request_stats", default=None)
+depths = threading.local() # nested timers of the same kind (a storage call inside a storage call) count once
+
+
+def count(scans: int = 0, fetches: int = 0, bytes_written: int = 0):
+	if bytes_written:
+		REGISTRY.add_bytes_written(bytes_written) # also counts background flushes, outside any request
+	stats = current.get()
+	if stats is None:
+		return
+	stats.scans += scans
+	stats.fetches += fetches
+	stats.bytes_written += bytes_written
+	stats.threads.add(threading.get_ident())
+
+
+@contextlib.contextmanager
+def timer(kind: str) -> Iterator[None]:
+	stats = current.get()
+	depth = getattr(depths, kind, 0)
+	if stats is None or depth:
+		yield
+		return
+	setattr(depths, kind, 1)
+	stats.threads.add(threading.get_ident())
+	start = time.perf_counter()
+	try:
+		yield
+	finally:
+		stats.seconds[kind] += time.perf_counter() - start
+		setattr(depths, kind, 0)
+
+
+def fetched(result: Any) -> Any:
+	# counts the documents in a storage call's result
+	if isinstance(result, dict): # a tinydb `Document`
+		count(fetches=1)
+	elif isinstance(result, list):
+		count(fetches=len(result))
+	return result
+
+
+class InstrumentedStorage:
+	# wraps a `Storage` for `Database`: times every call and counts the documents it returns
+	def __init__(self, storage: Any) -> None:
+		self.storage = storage
+
+	def __getattr__(self, name: str):
+		attr = getattr(self.storage, name)
+		if not callable(attr) or name.startswith("_"):
+			return attr
+		if name in ("transaction", "locked"):
+			return lambda *args, **kwargs: self.timed_context(attr(*args, **kwargs))
+
+		def call(*args, **kwargs):
+			with timer("storage"):
+				return fetched(attr(*args, **kwargs))
+
+		return call
+
+	@contextlib.contextmanager
+	def timed_context(self, context: Any) -> Iterator[None]:
+		# times taking the lock / BEGIN and the COMMIT, the calls made inside are timed on their own
+		with timer("storage"):
+			context.__enter__()
+		try:
+			yield
+		except BaseException:
+			with timer("storage"):
+				if not context.__exit__(*sys.exc_info()):
+					raise
+		else:
+			with timer("storage"):
+				context.__exit__(None, None, None)
+
+
+def escape_label(value: str) -> str:
+	return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+@dataclass
+class RouteStats:
+	requests: Dict[Tuple[str, int], int] = field(default_factory=dict) # (method, status) -> count
+	buckets: List[int] = field(default_factory=lambda: [0] * len(DURATION_BUCKETS))
+	count: int = 0
+	seconds: float = 0.0
+	scans: int = 0
+	fetches: int = 0
+	bytes_written: int = 0
+	timers: Dict[str, float] = field(default_factory=lambda: dict.fromkeys(TIMERS, 0.0))
+
+
+class Registry:
+	# per-route totals, rendered in the Prometheus text format by `exposition`
+	def __init__(self) -> None:
+		self.lock = threading.Lock()
+		self.routes: Dict[str, RouteStats] = collections.defaultdict(RouteStats)
+		self.bytes_written = 0
+		self.gauges: List[Callable[[], Iterable[Tuple[str, str, float]]]] = [] # -> (name, help, value)
+
+	def add_bytes_written(self, n: int):
+		with self.lock:
+			self.bytes_written += n
+
+	def observe(self, route: str, method: str, status: int, seconds: float, stats: RequestStats):
+		with self.lock:
+			r = self.routes[route]
+			r.requests[(method, status)] = r.requests.get((method, status), 0) + 1
+			for i, bound in enumerate(DURATION_BUCKETS):
+				if seconds <= bound:
+					r.buckets[i] += 1
+			r.count += 1
+			r.seconds += seconds
+			r.scans += stats.scans
+			r.fetches += stats.fetches
+			r.bytes_written += stats.bytes_written
+			for kind, value in stats.seconds.items():
+				r.timers[kind] += value
+
+	def exposition(self) -> str:
+		lines: List[str] = []
+
+		def metric(name: str, kind: str, help: str, samples: Iterable[Tuple[str, float]]):
+			lines.append(f"# HELP {name} {help}")
+			lines.append(f"# TYPE {name} {kind}")
+			lines.extend(f"{name}{labels} {value:g}" if isinstance(value, float) else f"{name}{labels} {value}" for labels, value in samples)
+
+		with self.lock:
+			routes = sorted((route, r) for route, r in self.routes.items())
+			label = lambda route, extra="": f'{{route="{escape_label(route)}"{extra}}}'
+			metric("rental_requests_total", "counter", "Requests served.", [
+				(label(route, f',method="{method}",status="{status}"'), n)
+				for route, r in routes for (method, status), n in sorted(r.requests.items())
+			])
+			duration = []
+			for route, r in routes:
+				duration += [(label(route, f',le="{bound}"'), n) for bound, n in zip(DURATION_BUCKETS, r.buckets)]
+				duration += [(label(route, ',le="+Inf"'), r.count)]
+			lines.append("# HELP rental_request_duration_seconds Time from the request to the end of the response.")
+			lines.append("# TYPE rental_request_duration_seconds histogram")
+			lines.extend(f"rental_request_duration_seconds_bucket{labels} {n}" for labels, n in duration)
+			for route, r in routes:
+				lines.append(f"rental_request_duration_seconds_sum{label(route)} {r.seconds:g}")
+				lines.append(f"rental_request_duration_seconds_count{label(route)} {r.count}")
+			for kind, help in (("storage", "in storage calls"), ("arrow", "parsing timestamps"), ("jinja", "rendering templates")):
+				metric(f"rental_{kind}_seconds_total", "counter", f"Time spent {help}.", [(label(route), r.timers[kind]) for route, r in routes])
+			metric("rental_table_scans_total", "counter", "Full table scans.", [(label(route), r.scans) for route, r in routes])
+			metric("rental_document_fetches_total", "counter", "Documents read from the storage.", [(label(route), r.fetches) for route, r in routes])
+			metric("rental_request_bytes_written_total", "counter", "Bytes written to disk while serving requests.",
+				[(label(route), r.bytes_written) for route, r in routes])
+			metric("rental_bytes_written_total", "counter", "Bytes written to disk, including background flushes.", [("", self.bytes_written)])
+			gauges = list(self.gauges)
+		for gauge in gauges:
+			for name, help, value in gauge():
+				metric(name, "gauge", help, [("", value)])
+		return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+
+class SamplingProfiler:
+	# samples every thread's stack each `interval` while requests are in flight; a request slower than
+	# `threshold` gets the samples of the threads that worked on it written to `directory` as folded
+	# stacks (`flamegraph.pl`, speedscope, inferno all read them)
+	def __init__(self, threshold: float, directory: str = "profiles", interval: float = 0.005, keep: float = 30.0) -> None:
+		self.threshold = threshold
+		self.directory = directory
+		self.interval = interval
+		self.samples: Deque[Tuple[float, int, str]] = collections.deque(maxlen=int(keep / interval) * 8)
+		self.lock = threading.Lock()
+		self.in_flight = 0
+		self.busy = threading.Event()
+		self.stopped = threading.Event()
+		self.thread: Optional[threading.Thread] = None
+
+	def start(self):
+		if self.thread is not None:
+			return
+		self.stopped.clear()
+		self.thread = threading.Thread(target=self.sample_loop, name="sampling-profiler", daemon=True)
+		self.thread.start()
+
+	def stop(self):
+		if self.thread is None:
+			return
+		self.stopped.set()
+		self.busy.set()
+		self.thread.join()
+		self.thread = None
+
+	def sample_loop(self):
+		own = threading.get_ident()
+		while not self.stopped.is_set():
+			self.busy.wait()
+			now = time.perf_counter()
+			for ident, frame in sys._current_frames().items():
+				if ident != own:
+					self.samples.append((now, ident, self.fold(frame)))
+			time.sleep(self.interval)
+
+	@staticmethod
+	def fold(frame: Any) -> str:
+		stack = []
+		while frame is not None:
+			code = frame.f_code
+			stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+			frame = frame.f_back
+		return ";".join(reversed(stack))
+
+	def begin(self):
+		with self.lock:
+			self.in_flight += 1
+			self.busy.set()
+
+	def finish(self, stats: RequestStats, label: str, seconds: float) -> Optional[str]:
+		with self.lock:
+			self.in_flight -= 1
+			if self.in_flight == 0:
+				self.busy.clear()
+		if seconds < self.threshold:
+			return None
+		end = stats.started + seconds
+		folded = collections.Counter(
+			stack for t, ident, stack in list(self.samples) if stats.started <= t <= end and ident in stats.threads
+		)
+		if not folded:
+			return None
+		os.makedirs(self.directory, exist_ok=True)
+		name = "".join(c if c.isalnum() else "_" for c in label).strip("_")
+		path = os.path.join(self.directory, f"{time.strftime('%Y%m%d-%H%M%S')}-{int(seconds * 1000)}ms-{name}.folded")
+		with open(path, "w", encoding="utf-8") as f:
+			f.writelines(f"{stack} {n}\n" for stack, n in folded.most_common())
+		return path
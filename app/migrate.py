@@ -0,0 +1,31 @@
+import os
+import sys
+
+from tinydb import TinyDB
+
+from .storage import SQLiteStorage, Table
+
+
+def migrate_tinydb_to_sqlite(json_path: str, sqlite_path: str) -> dict:
+	if os.path.exists(sqlite_path):
+		raise FileExistsError(sqlite_path)
+	source = TinyDB(json_path)
+	target = SQLiteStorage(sqlite_path)
+	counts = {}
+	try:
+		for table in Table:
+			docs = source.table(table.name).all()
+			target.insert_documents(table, docs)
+			counts[table.name] = len(docs)
+	finally:
+		source.close()
+		target.close()
+	return counts
+
+
+if __name__ == "__main__":
+	if len(sys.argv) != 3:
+		print("usage: python3 -m app.migrate rental.json rental.sqlite3")
+		sys.exit(1)
+	for name, count in migrate_tinydb_to_sqlite(sys.argv[1], sys.argv[2]).items():
+		print(f"{name}: {count}")
@@ -1,13 +1,17 @@
 from dataclasses import dataclass
+from datetime import datetime
+from functools import lru_cache
 import base64
 import enum
 from typing import Set
-from typing import List, Dict, Optional
+from typing import Any, List, Dict, Optional, Tuple
 import arrow
 from tinydb.table import Document
 
+from . import metrics
 
-@dataclass
+
+@dataclass(frozen=True, slots=True)
 class Address: # will be used for both user address and shop address
 	id: int
 	person_name: str
@@ -37,7 +41,7 @@ class Address: # will be used for both user address and shop address
 		return f"{self.building}, {self.city}"
 
 
-@dataclass
+@dataclass(frozen=True, slots=True)
 class User:
 	id: int
 	email: str
@@ -64,11 +68,21 @@ class OrderStatus(enum.Enum):
 	Delivered = enum.auto()
 
 
-@dataclass
+@lru_cache(maxsize=4096)
+def parse_time(value: str) -> arrow.Arrow:
+	# timestamps are written with `isoformat()`, which the stdlib parses far faster than `arrow.get`
+	with metrics.timer("arrow"):
+		try:
+			return arrow.Arrow.fromdatetime(datetime.fromisoformat(value))
+		except ValueError:
+			return arrow.get(value)
+
+
+@dataclass(frozen=True, slots=True)
 class Order:
 	id: int
-	placed_at: arrow.Arrow
-	updated_at: arrow.Arrow
+	placed_at_raw: str
+	updated_at_raw: str
 	user_id: int
 	item_id: int
 	shop_id: int
@@ -76,15 +90,30 @@ class Order:
 	status: OrderStatus
 	address: Optional[Address]
 
+	# parsed only when something actually reads them
+	@property
+	def placed_at(self) -> arrow.Arrow:
+		return parse_time(self.placed_at_raw)
+
+	@property
+	def updated_at(self) -> arrow.Arrow:
+		return parse_time(self.updated_at_raw)
+
 	@classmethod
 	def from_doc(cls, doc: Document, address: Optional[Address]) -> 'Order':
 		return cls(
-			doc.doc_id, arrow.get(doc['placed_at']), arrow.get(doc['updated_at']), doc['user_id'], doc['item_id'],
+			doc.doc_id, doc['placed_at'], doc['updated_at'], doc['user_id'], doc['item_id'],
 			doc['shop_id'], doc['quantity'], OrderStatus[doc['status']], address
 		)
 
 
-@dataclass
+@dataclass(frozen=True, slots=True)
+class OrderPage:
+	orders: List[Order] # newest (by updated_at) first
+	next_cursor: Optional[str] # pass back to get the following page, None on the last one
+
+
+@dataclass(frozen=True, slots=True)
 class Shop:
 	id: int
 	name: str
@@ -96,7 +125,7 @@ class Shop:
 		return cls(doc.doc_id, doc['name'], address, doc['items'])
 
 
-@dataclass
+@dataclass(frozen=True, slots=True)
 class Item:
 	id: int
 	name: str
@@ -108,7 +137,75 @@ class Item:
 		return cls(doc.doc_id, doc['name'], doc['price'], doc['image_name'])
 
 
-@dataclass
+@dataclass(frozen=True, slots=True)
+class SearchPage:
+	items: List[Item] # best matches first
+	shop_ids: Dict[int, List[int]] # item id -> the first few shops selling it (within the pincode/shop filter)
+	shop_counts: Dict[int, int] # item id -> how many shops sell it
+	total: int # matches over all pages
+
+
+@dataclass(frozen=True, slots=True)
+class SalesReport:
+	rows: List[Dict[str, Any]] # group fields + counters, see `reports.COUNTERS`
+	totals: Dict[str, float] # counters summed over every row
+
+
+@dataclass(frozen=True, slots=True)
+class CartLine:
+	shop_id: int
+	item_id: int
+	quantity: int
+	price: float # of one item
+
+
+@dataclass(frozen=True, slots=True)
+class Cart:
+	user_id: int
+	pincode: Optional[int] # every line comes from shops in this pincode, None while empty
+	lines: Dict[Tuple[int, int], CartLine] # (shop_id, item_id) -> line
+	total: float
+
+	@classmethod
+	def empty(cls, user_id: int) -> 'Cart':
+		return cls(user_id, None, {}, 0.0)
+
+	def quantity(self, shop_id: int, item_id: int) -> int:
+		line = self.lines.get((shop_id, item_id))
+		return line.quantity if line is not None else 0
+
+	def shop_counts(self, shop_id: int) -> Dict[int, int]:
+		return {line.item_id: line.quantity for line in self.lines.values() if line.shop_id == shop_id}
+
+	def changed(self, shop_id: int, item_id: int, delta: int, price: float, pincode: int) -> 'Cart':
+		# `pincode` is the shop's, it only becomes the cart's when this change adds the first line
+		lines = dict(self.lines)
+		before = self.quantity(shop_id, item_id)
+		quantity = max(before + delta, 0)
+		if quantity == before:
+			return self # e.g. taking out an item that isn't in the cart
+		if quantity > 0:
+			lines[(shop_id, item_id)] = CartLine(shop_id, item_id, quantity, price)
+		else:
+			lines.pop((shop_id, item_id), None)
+		if not lines:
+			return Cart.empty(self.user_id)
+		return Cart(self.user_id, self.pincode if self.pincode is not None else pincode, lines, self.total + (quantity - before) * price)
+
+	def to_doc(self) -> dict:
+		return {
+			"pincode": self.pincode,
+			"lines": [[l.shop_id, l.item_id, l.quantity, l.price] for l in self.lines.values()],
+			"total": self.total,
+		}
+
+	@classmethod
+	def from_doc(cls, doc: Document) -> 'Cart':
+		lines = {(shop_id, item_id): CartLine(shop_id, item_id, quantity, price) for shop_id, item_id, quantity, price in doc['lines']}
+		return cls(doc.doc_id, doc['pincode'], lines, doc['total'])
+
+
+@dataclass(frozen=True, slots=True)
 class Session:
 	id: int
 	user_id: int
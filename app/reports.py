@@ -0,0 +1,92 @@
+import argparse
+import datetime
+from typing import Any, Dict, Iterable, List, Sequence, Tuple
+
+from .storage import Table
+
+# order lifecycle events, appended to `Table.order_events` and never changed afterwards
+CART_ADD, CART_REMOVE, PLACED, DELIVERED = "cart_add", "cart_remove", "placed", "delivered"
+EVENT_KINDS = (CART_ADD, CART_REMOVE, PLACED, DELIVERED)
+# one `Table.rollups` row per (day, shop_id, item_id) holds these, coarser reports sum the rows
+COUNTERS = ("cart_adds", "cart_removes", "orders_placed", "units_placed", "revenue_placed",
+	"orders_delivered", "units_delivered", "revenue_delivered")
+GROUPS = {"day": "day", "shop": "shop_id", "item": "item_id", "pincode": "pincode"} # report group_by -> rollup field
+MAX_REPORT_DAYS = 366 # a range without shop/item/pincode is read day by day up to this long
+
+
+def event(kind: str, at: str, order_id: int, user_id: int, shop_id: int, item_id: int, pincode: int,
+		quantity: int, price: float) -> Dict[str, Any]:
+	return {"kind": kind, "at": at, "order_id": order_id, "user_id": user_id, "shop_id": shop_id,
+		"item_id": item_id, "pincode": pincode, "quantity": quantity, "price": price}
+
+
+def day_of(at: str) -> str:
+	# events are stamped with isoformat UTC timestamps
+	return at[:10]
+
+
+def rollup_key(e: Dict[str, Any]) -> Tuple[str, int, int]:
+	return day_of(e["at"]), e["shop_id"], e["item_id"]
+
+
+def counter_deltas(e: Dict[str, Any]) -> Dict[str, float]:
+	quantity = e["quantity"]
+	if e["kind"] == CART_ADD:
+		return {"cart_adds": quantity}
+	if e["kind"] == CART_REMOVE:
+		return {"cart_removes": quantity}
+	if e["kind"] == PLACED:
+		return {"orders_placed": 1, "units_placed": quantity, "revenue_placed": quantity * e["price"]}
+	if e["kind"] == DELIVERED:
+		return {"orders_delivered": 1, "units_delivered": quantity, "revenue_delivered": quantity * e["price"]}
+	raise ValueError(f"unknown order event {e['kind']!r}")
+
+
+def fold(events: Iterable[Dict[str, Any]]) -> Dict[Tuple[str, int, int], Dict[str, Any]]:
+	# -> rollup key -> {"pincode": ..., counter: delta}
+	rv: Dict[Tuple[str, int, int], Dict[str, Any]] = {}
+	for e in events:
+		deltas = rv.setdefault(rollup_key(e), {"pincode": e["pincode"]})
+		for name, value in counter_deltas(e).items():
+			deltas[name] = deltas.get(name, 0) + value
+	return rv
+
+
+def days(since: str, until: str) -> List[str]:
+	# "YYYY-MM-DD" days in [since, until)
+	start, end = datetime.date.fromisoformat(since), datetime.date.fromisoformat(until)
+	return [(start + datetime.timedelta(days=i)).isoformat() for i in range((end - start).days)]
+
+
+def aggregate(rows: Iterable[Dict[str, Any]], group_by: Sequence[str]) -> Tuple[List[Dict[str, Any]], Dict[str, float]]:
+	# sums rollup rows per `group_by` (keys of GROUPS) -> (rows sorted by the group, totals)
+	fields = [GROUPS[g] for g in group_by]
+	groups: Dict[tuple, Dict[str, float]] = {}
+	totals = dict.fromkeys(COUNTERS, 0)
+	for row in rows:
+		counters = groups.setdefault(tuple(row[f] for f in fields), dict.fromkeys(COUNTERS, 0))
+		for name in COUNTERS:
+			counters[name] += row[name]
+			totals[name] += row[name]
+	money = lambda counters: {name: round(float(v), 2) if name.startswith("revenue") else v for name, v in counters.items()}
+	return [{**dict(zip(fields, key)), **money(counters)} for key, counters in sorted(groups.items())], money(totals)
+
+
+def main():
+	parser = argparse.ArgumentParser(description="rebuild the sales rollups from the order event log")
+	parser.add_argument("db", help="rental.json, rental.snapshot, a .sqlite3 file or a .shards.json map")
+	parser.add_argument("--backfill", action="store_true",
+		help="first log placed/delivered events for orders from before the event log (at today's item prices)")
+	args = parser.parse_args()
+	from .db import Database # db imports this module
+	db = Database(args.db)
+	try:
+		if args.backfill:
+			print(f"{db.backfill_order_events()} events backfilled")
+		print(f"{db.rebuild_rollups()} rollup rows from {db.storage.count(Table.order_events)} events")
+	finally:
+		db.close()
+
+
+if __name__ == "__main__":
+	main()
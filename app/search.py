@@ -0,0 +1,141 @@
+import bisect
+import heapq
+import re
+import threading
+from collections import defaultdict
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+from .models import Item
+
+TOKEN = re.compile(r"\w+")
+MIN_FUZZY_LENGTH = 4 # shorter terms must match exactly (or as a prefix)
+MAX_PREFIX_EXPANSIONS = 64 # tokens a prefix may stand for, keeps one-letter prefixes cheap
+EXACT, PREFIX, FUZZY = 3, 2, 1 # scores of a term matching a token
+
+
+def tokenize(text: str) -> List[str]:
+	return TOKEN.findall(text.lower())
+
+
+def deletes(token: str) -> Set[str]:
+	return {token[:i] + token[i + 1:] for i in range(len(token))}
+
+
+def within_one_edit(a: str, b: str) -> bool:
+	# one insertion, deletion, substitution or swap of adjacent letters
+	if a == b:
+		return True
+	if abs(len(a) - len(b)) > 1:
+		return False
+	if len(a) == len(b):
+		diff = [i for i in range(len(a)) if a[i] != b[i]]
+		return len(diff) == 1 or (len(diff) == 2 and diff[1] == diff[0] + 1 and a[diff[0]] == b[diff[1]] and a[diff[1]] == b[diff[0]])
+	short, long = (a, b) if len(a) < len(b) else (b, a)
+	i = next((i for i in range(len(short)) if short[i] != long[i]), len(short))
+	return short[i:] == long[i + 1:]
+
+
+class SearchIndex:
+	# inverted index over item names, with the price of every item and the shops (and their pincodes)
+	# selling it for filtering; typos are found through the one-letter deletions of every token
+	def __init__(self) -> None:
+		self.lock = threading.Lock()
+		self.postings: Dict[str, Set[int]] = defaultdict(set) # token -> item ids
+		self.vocabulary: List[str] = [] # sorted, for prefixes
+		self.neighbours: Dict[str, Set[str]] = defaultdict(set) # token or one of its deletions -> tokens
+		self.prices: Dict[int, float] = {}
+		self.item_shops: Dict[int, Set[int]] = defaultdict(set)
+		self.shop_pincodes: Dict[int, int] = {}
+
+	def add_item(self, item: Item):
+		with self.lock:
+			if item.id in self.prices:
+				return
+			self.prices[item.id] = item.price
+			for token in set(tokenize(item.name)):
+				if token not in self.postings:
+					bisect.insort(self.vocabulary, token)
+					self.neighbours[token].add(token)
+					if len(token) >= MIN_FUZZY_LENGTH:
+						for key in deletes(token):
+							self.neighbours[key].add(token)
+				self.postings[token].add(item.id)
+
+	def add_shop_items(self, shop_id: int, pincode: int, item_ids: Iterable[int]):
+		with self.lock:
+			self.shop_pincodes[shop_id] = pincode
+			for item_id in item_ids:
+				self.item_shops[item_id].add(shop_id)
+
+	def rebuild(self, items: Iterable[Item], shops: Iterable[Tuple[int, int, List[int]]]):
+		with self.lock:
+			self.postings.clear()
+			self.vocabulary.clear()
+			self.neighbours.clear()
+			self.prices.clear()
+			self.item_shops.clear()
+			self.shop_pincodes.clear()
+		for item in items:
+			self.add_item(item)
+		for shop_id, pincode, item_ids in shops:
+			self.add_shop_items(shop_id, pincode, item_ids)
+
+	def expand(self, term: str, prefix: bool) -> Dict[str, int]:
+		# -> tokens the term matches, with how well
+		matches = {}
+		if len(term) >= MIN_FUZZY_LENGTH:
+			for key in deletes(term) | {term}:
+				for token in self.neighbours.get(key, ()):
+					if within_one_edit(term, token):
+						matches[token] = FUZZY
+		if prefix:
+			start = bisect.bisect_left(self.vocabulary, term)
+			for token in self.vocabulary[start:start + MAX_PREFIX_EXPANSIONS]:
+				if not token.startswith(term):
+					break
+				matches[token] = PREFIX
+		if term in self.postings:
+			matches[term] = EXACT
+		return matches
+
+	def search(self, query: str, pincode: Optional[int] = None, shop_id: Optional[int] = None,
+			min_price: Optional[float] = None, max_price: Optional[float] = None,
+			offset: int = 0, limit: int = 20, max_shops: int = 5) -> Tuple[List[Tuple[int, List[int], int]], int]:
+		# every term has to match, the last one also as a prefix (search as you type)
+		# -> ([(item id, the first `max_shops` ids of the matching shops selling it, how many there are)], total matches),
+		# best matches first
+		terms = tokenize(query)
+		if not terms:
+			return [], 0
+		with self.lock:
+			scores: Optional[Dict[int, int]] = None
+			for term in set(terms):
+				term_scores: Dict[int, int] = {}
+				for token, score in self.expand(term, prefix=term == terms[-1]).items():
+					for item_id in self.postings[token]:
+						if term_scores.get(item_id, 0) < score:
+							term_scores[item_id] = score
+				if scores is None:
+					scores = term_scores
+				else:
+					scores = {item_id: s + term_scores[item_id] for item_id, s in scores.items() if item_id in term_scores}
+				if not scores:
+					return [], 0
+			hits = []
+			for item_id, score in scores.items(): # type: ignore
+				price = self.prices[item_id]
+				if (min_price is not None and price < min_price) or (max_price is not None and price > max_price):
+					continue
+				shops = self.item_shops.get(item_id, set())
+				if shop_id is not None:
+					shops = shops & {shop_id}
+				if pincode is not None:
+					shops = {s for s in shops if self.shop_pincodes.get(s) == pincode}
+				if (shop_id is not None or pincode is not None) and not shops:
+					continue
+				hits.append((-score, item_id, shops))
+			page = heapq.nsmallest(offset + limit, hits, key=lambda h: (h[0], h[1]))[offset:]
+			return [(item_id, heapq.nsmallest(max_shops, shops), len(shops)) for _, item_id, shops in page], len(hits)
+
+	def __len__(self) -> int:
+		return len(self.prices)
@@ -0,0 +1,94 @@
+import random
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Dict, List, Tuple
+
+from faker import Faker
+
+from .db import Database
+
+IMAGE_SUFFIXES = (".jpg", ".jpeg", ".png", ".webp")
+
+
+def local_images(image_dir: str = "rental") -> List[str]:
+	return sorted(p.name for p in Path(image_dir).iterdir() if p.suffix.lower() in IMAGE_SUFFIXES)
+
+
+def fake_address(db: Database, fake: Faker, code: int, city: str) -> int:
+	return db.add_address(fake.first_name(), code, fake.building_number(), city, "Dist" or fake.district(), fake.state(), street=fake.street_name())
+
+
+@dataclass
+class SeededData:
+	pincodes: List[int] = field(default_factory=list)
+	shop_ids: Dict[int, List[int]] = field(default_factory=dict) # pincode -> shops
+	items: Dict[int, List[int]] = field(default_factory=dict) # shop -> item ids
+	users: List[Tuple[int, str, str]] = field(default_factory=list) # (id, email, password)
+	user_pincodes: Dict[int, int] = field(default_factory=dict) # pincode of the user's cart
+
+
+def seed_synthetic(db: Database, users: int = 20, pincodes: int = 2, shops_per_pincode: int = 30, items_per_shop: int = 20,
+		orders_per_user: int = 10, catalog_size: int = 200, image_dir: str = "rental", seed: int = 0) -> SeededData:
+	# fully offline: item images are picked from the files already in `image_dir`
+	rng = random.Random(seed)
+	fake = Faker("en_IN")
+	fake.seed_instance(seed)
+	images = local_images(image_dir)
+	data = SeededData()
+
+	item_ids = [
+		db.new_item(f"{fake.word().title()} {fake.word()}", round(rng.uniform(50, 5000), 2), rng.choice(images))
+		for _ in range(catalog_size)
+	]
+
+	codes = [(332404, "Reengus"), (332001, "Mumbai")][:pincodes]
+	while len(codes) < pincodes:
+		code = int(fake.postcode())
+		if code not in dict(codes):
+			codes.append((code, fake.city()))
+	for code, city in codes:
+		data.pincodes.append(code)
+		data.shop_ids[code] = []
+		for _ in range(shops_per_pincode):
+			shop_id = db.new_shop(fake.first_name() + " Store", fake_address(db, fake, code, city))
+			for item_id in rng.sample(item_ids, min(items_per_shop, len(item_ids))):
+				db.add_item_to_shop(shop_id, item_id)
+			data.shop_ids[code].append(shop_id)
+			data.items[shop_id] = db.get_shop(shop_id).items # type: ignore
+
+	for i in range(users):
+		email, password = f"user{i}@example.com", f"password{i}"
+		db.new_user(fake.first_name(), fake.last_name(), email, password)
+		user = db.get_user(email, password)
+		assert user is not None
+		code, city = rng.choice(codes)
+		address_id = fake_address(db, fake, code, city)
+		db.add_address_to_user(address_id, user.id)
+		data.users.append((user.id, email, password))
+		data.user_pincodes[user.id] = code
+		for n in range(orders_per_user):
+			shop_id = rng.choice(data.shop_ids[code])
+			db.new_order(user.id, rng.choice(data.items[shop_id]), shop_id)
+			if n < orders_per_user - 2: # keep the last couple in the cart
+				db.place_orders(user.id, address_id)
+	return data
+
+
+def seed_demo(db: Database, image_dir: str = "rental") -> None:
+	# the development dataset: every local image as an item, stocked by 30 shops in each of two pincodes
+	fake = Faker("en_IN")
+	pincodes = [(332404, "Reengus"), (332001, "Mumbai")]
+	item_ids = [db.new_item(Path(name).stem.replace("_", " ").title(), 70.0 * (i + 1), name) for i, name in enumerate(local_images(image_dir))]
+
+	db.new_user("ankit", "saini", "ankit@nkit.dev", "some")
+	user = db.get_user("ankit@nkit.dev", "some")
+	assert user is not None
+	for _ in range(2):
+		for code, city in pincodes:
+			db.add_address_to_user(fake_address(db, fake, code, city), user.id)
+
+	for _ in range(30):
+		for code, city in pincodes:
+			shop_id = db.new_shop(fake.first_name() + " Store", fake_address(db, fake, code, city))
+			for item_id in item_ids:
+				db.add_item_to_shop(shop_id, item_id)
@@ -0,0 +1,30 @@
+import argparse
+import os
+
+import uvicorn
+
+from .settings import Settings
+
+
+def main():
+	defaults = Settings.from_env()
+	parser = argparse.ArgumentParser(description="run rental with several worker processes")
+	parser.add_argument("--workers", type=int, default=defaults.workers if defaults.workers > 1 else os.cpu_count() or 1)
+	parser.add_argument("--db", default=defaults.db_path, help="rental.json or a .sqlite3 file (recommended with several workers)")
+	parser.add_argument("--host", default=defaults.host)
+	parser.add_argument("--port", type=int, default=defaults.port)
+	parser.add_argument("--debug", action="store_true", default=False)
+	parser.add_argument("--profile-slow-ms", type=float, default=defaults.profile_slow_ms,
+		help=f"write sampled stacks of slower requests to {defaults.profile_dir}/ (folded, for flamegraphs)")
+	args = parser.parse_args()
+
+	settings = Settings(db_path=args.db, workers=args.workers, debug=args.debug, host=args.host, port=args.port,
+		session_ttl=defaults.session_ttl, session_sweep_interval=defaults.session_sweep_interval,
+		profile_slow_ms=args.profile_slow_ms, profile_dir=defaults.profile_dir, shop_api_key=defaults.shop_api_key)
+	# the workers import `app.app` on their own and read their configuration from the environment
+	os.environ.update(settings.to_env())
+	uvicorn.run("app.app:app", host=settings.host, port=settings.port, workers=settings.workers, reload=False)
+
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,114 @@
+import threading
+import time
+import uuid
+from dataclasses import dataclass, replace
+from typing import Optional
+
+import arrow
+from tinydb.table import Document
+
+from .models import Session, parse_time
+from .storage import Storage, Table
+
+SESSION_TTL = 30 * 24 * 3600.0 # seconds a login stays valid
+SWEEP_INTERVAL = 600.0 # seconds between two sweeps of expired sessions
+
+
+@dataclass(frozen=True)
+class SessionStats:
+	live: int = 0 # as of the last sweep, plus logins and minus logouts since
+	created: int = 0
+	logged_out: int = 0
+	expired: int = 0 # removed by the sweeper
+	sweeps: int = 0
+	last_sweep_at: Optional[str] = None
+	last_sweep_seconds: float = 0.0
+
+
+class SessionStore:
+	# sessions live in `Table.sessions` (indexed by token), expire `ttl` seconds after login and are
+	# deleted in bulk by a background sweeper; `ttl=None` keeps them until logout
+	def __init__(self, storage: Storage, ttl: Optional[float] = SESSION_TTL) -> None:
+		self.storage = storage
+		self.ttl = ttl
+		self.lock = threading.Lock()
+		self.counters = SessionStats(live=storage.count(Table.sessions))
+		self.wake = threading.Event()
+		self.sweeper: Optional[threading.Thread] = None
+
+	def count(self, **changes: int):
+		with self.lock:
+			self.counters = replace(self.counters, **{k: getattr(self.counters, k) + v for k, v in changes.items()})
+
+	def create(self, user_id: int) -> Session:
+		now_str = arrow.now("UTC").isoformat()
+		token = uuid.uuid4().hex
+		session_id = self.storage.insert(Table.sessions, {"created_at": now_str, "user_id": user_id, "token": token})
+		self.count(created=1, live=1)
+		return self.doc_to_session(Document({"created_at": now_str, "user_id": user_id, "token": token}, session_id))
+
+	def get(self, token: str) -> Optional[Session]:
+		doc = self.storage.find_one(Table.sessions, token=token)
+		if doc is None:
+			return None
+		session = self.doc_to_session(doc)
+		if self.seconds_left(session) <= 0: # the sweeper deletes it later
+			return None
+		return session
+
+	def seconds_left(self, session: Session) -> float:
+		if self.ttl is None:
+			return float("inf")
+		return self.ttl - (arrow.now("UTC") - session.created_at).total_seconds()
+
+	def remove(self, token: str) -> bool:
+		doc = self.storage.find_one(Table.sessions, token=token)
+		if doc is None:
+			return False
+		self.storage.remove(Table.sessions, doc_ids=[doc.doc_id])
+		self.count(logged_out=1, live=-1)
+		return True
+
+	def sweep(self) -> int:
+		if self.ttl is None:
+			return 0
+		start = time.perf_counter()
+		cutoff = arrow.now("UTC").shift(seconds=-self.ttl).isoformat()
+		removed = self.storage.remove_below(Table.sessions, "created_at", cutoff)
+		if removed:
+			self.storage.compact()
+		live = self.storage.count(Table.sessions)
+		with self.lock:
+			self.counters = replace(
+				self.counters, live=live, expired=self.counters.expired + removed, sweeps=self.counters.sweeps + 1,
+				last_sweep_at=arrow.now("UTC").isoformat(), last_sweep_seconds=round(time.perf_counter() - start, 6),
+			)
+		return removed
+
+	def stats(self) -> SessionStats:
+		with self.lock:
+			return self.counters
+
+	def start_sweeper(self, interval: float = SWEEP_INTERVAL):
+		if self.sweeper is not None or self.ttl is None:
+			return
+		self.wake.clear()
+		self.sweeper = threading.Thread(target=self.sweep_loop, args=(interval,), name="session-sweeper", daemon=True)
+		self.sweeper.start()
+
+	def sweep_loop(self, interval: float):
+		while True:
+			self.sweep()
+			if self.wake.wait(interval):
+				return
+
+	def stop_sweeper(self):
+		if self.sweeper is None:
+			return
+		self.wake.set()
+		self.sweeper.join()
+		self.sweeper = None
+
+	@classmethod
+	def doc_to_session(cls, doc: Document) -> Session:
+		return Session(doc.doc_id, doc['user_id'], parse_time(doc['created_at']), doc['token'])
@@ -0,0 +1,60 @@
+import os
+from dataclasses import dataclass
+from typing import Optional
+
+from .sessions import SESSION_TTL, SWEEP_INTERVAL
+
+
+def env_flag(name: str, default: bool) -> bool:
+	value = os.environ.get(name)
+	if value is None:
+		return default
+	return value.strip().lower() in ("1", "true", "yes", "on")
+
+
+@dataclass(frozen=True)
+class Settings:
+	db_path: str = "rental.json"
+	workers: int = 1
+	debug: bool = True
+	host: str = "127.0.0.1"
+	port: int = 8000
+	session_ttl: Optional[float] = SESSION_TTL # None: sessions last until logout
+	session_sweep_interval: float = SWEEP_INTERVAL
+	profile_slow_ms: Optional[float] = None # dump sampled stacks of requests slower than this, see `metrics.SamplingProfiler`
+	profile_dir: str = "profiles"
+	shop_api_key: Optional[str] = None # `X-Shop-Key` of the shop fulfilment endpoints, which are off without it
+
+	@property
+	def shared(self) -> bool:
+		# several worker processes open the same datastore
+		return self.workers > 1
+
+	@classmethod
+	def from_env(cls) -> "Settings":
+		return cls(
+			db_path=os.environ.get("RENTAL_DB", cls.db_path),
+			workers=int(os.environ.get("RENTAL_WORKERS", cls.workers)),
+			debug=env_flag("RENTAL_DEBUG", cls.debug),
+			host=os.environ.get("RENTAL_HOST", cls.host),
+			port=int(os.environ.get("RENTAL_PORT", cls.port)),
+			session_ttl=float(os.environ.get("RENTAL_SESSION_TTL", cls.session_ttl)) or None,
+			session_sweep_interval=float(os.environ.get("RENTAL_SESSION_SWEEP", cls.session_sweep_interval)),
+			profile_slow_ms=float(os.environ.get("RENTAL_PROFILE_SLOW_MS", 0)) or None,
+			profile_dir=os.environ.get("RENTAL_PROFILE_DIR", cls.profile_dir),
+			shop_api_key=os.environ.get("RENTAL_SHOP_API_KEY") or None,
+		)
+
+	def to_env(self) -> dict:
+		return {
+			"RENTAL_DB": self.db_path,
+			"RENTAL_WORKERS": str(self.workers),
+			"RENTAL_DEBUG": "1" if self.debug else "0",
+			"RENTAL_HOST": self.host,
+			"RENTAL_PORT": str(self.port),
+			"RENTAL_SESSION_TTL": str(self.session_ttl or 0),
+			"RENTAL_SESSION_SWEEP": str(self.session_sweep_interval),
+			"RENTAL_PROFILE_SLOW_MS": str(self.profile_slow_ms or 0),
+			"RENTAL_PROFILE_DIR": self.profile_dir,
+			"RENTAL_SHOP_API_KEY": self.shop_api_key or "",
+		}
@@ -0,0 +1,485 @@
+import argparse
+import contextlib
+import heapq
+import itertools
+import json
+import os
+import threading
+from dataclasses import dataclass, field
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Set, Tuple
+
+from tinydb.table import Document
+
+from .storage import SHARD_MAP_SUFFIX, Storage, Table, open_storage
+from .write_behind import WriteBehindConfig
+
+GLOBAL = "global" # the datastore of the tables that aren't sharded
+PINCODE_SPACE = 1_000_000 # ids of sharded documents are `seq * PINCODE_SPACE + pincode`, pincodes have 6 digits
+# fields telling which pincode a document (or a query) of a sharded table belongs to, first match wins:
+# (field, whether it holds the id of a sharded document rather than a pincode)
+SHARD_KEYS: Dict[Table, List[Tuple[str, bool]]] = {
+	Table.addresses: [("pincode", False)],
+	Table.shops: [("address_id", True)],
+	Table.orders: [("shop_id", True)],
+	Table.order_events: [("pincode", False), ("shop_id", True), ("order_id", True)],
+	Table.rollups: [("pincode", False), ("shop_id", True)],
+}
+
+
+def pincode_of(doc_id: int) -> int:
+	return doc_id % PINCODE_SPACE
+
+
+def sharded_id(seq: int, pincode: int) -> int:
+	if not 0 <= pincode < PINCODE_SPACE:
+		raise ValueError(f"pincode {pincode} doesn't fit in a sharded id")
+	return seq * PINCODE_SPACE + pincode
+
+
+def shard_key(table: Table, fields: Dict[str, Any]) -> Optional[int]:
+	# -> the pincode `fields` pin a sharded table's documents to, None when they don't
+	for name, is_id in SHARD_KEYS[table]:
+		value = fields.get(name)
+		if value is not None:
+			return pincode_of(value) if is_id else value
+	return None
+
+
+@dataclass
+class ShardMap:
+	# `<name>.shards.json`: which datastore holds each pincode; paths are relative to the map file
+	path: str
+	global_path: str
+	shards: Dict[str, str] # shard name -> datastore path
+	pincodes: Dict[int, str] = field(default_factory=dict) # pincode -> shard name
+	default: str = "" # shard of the pincodes not in `pincodes`
+
+	@classmethod
+	def load(cls, path: str) -> "ShardMap":
+		with open(path, encoding="utf-8") as f:
+			raw = json.load(f)
+		shard_map = cls(path, raw["global"], raw["shards"], {int(p): s for p, s in raw.get("pincodes", {}).items()}, raw["default"])
+		for name in [shard_map.default, *shard_map.pincodes.values()]:
+			if name not in shard_map.shards:
+				raise ValueError(f"{path}: no shard {name!r}")
+		if any(p.endswith(SHARD_MAP_SUFFIX) for p in [shard_map.global_path, *shard_map.shards.values()]):
+			raise ValueError(f"{path}: shards can't be shard maps themselves")
+		return shard_map
+
+	def save(self):
+		raw = {
+			"global": self.global_path,
+			"shards": self.shards,
+			"default": self.default,
+			"pincodes": {str(p): s for p, s in sorted(self.pincodes.items())},
+		}
+		tmp_path = self.path + ".tmp"
+		with open(tmp_path, "w", encoding="utf-8") as f:
+			json.dump(raw, f, indent="\t")
+			f.flush()
+			os.fsync(f.fileno())
+		os.replace(tmp_path, self.path)
+
+	def resolve(self, path: str) -> str:
+		return os.path.join(os.path.dirname(os.path.abspath(self.path)), path)
+
+	def shard_of(self, pincode: int) -> str:
+		return self.pincodes.get(pincode, self.default)
+
+
+class ShardedStorage(Storage):
+	# users, sessions, carts, items and the invalidation log stay in one global datastore, the tables in
+	# SHARD_KEYS are split by pincode over the shards of a `ShardMap`, each its own file (or sqlite database)
+	# with its own locks. Ids of sharded documents carry their pincode, so every lookup by id goes to one shard.
+	#
+	# Transactions are atomic per datastore. One either starts at the global datastore and may then use
+	# any shard, or stays in the shard it started in: locks are only ever taken global first, so two
+	# transactions never wait on each other. Reads spanning several shards lock none of them.
+	def __init__(self, shard_map: ShardMap, write_behind: Optional[WriteBehindConfig] = None, shared: bool = False) -> None:
+		self.map = shard_map
+		self.backends: Dict[str, Storage] = {GLOBAL: open_storage(shard_map.resolve(shard_map.global_path), write_behind, shared)}
+		for name, path in shard_map.shards.items():
+			self.backends[name] = open_storage(shard_map.resolve(path), write_behind, shared)
+		self.state = threading.local() # the open transaction of each thread
+
+	def held(self) -> Optional[Set[str]]:
+		# datastores locked by this thread's transaction, None outside of one
+		return self.state.held if getattr(self.state, "depth", 0) else None
+
+	def use(self, name: str, write: bool = False) -> Storage:
+		# the datastore `name`, taken into the open transaction
+		held = self.held()
+		backend = self.backends[name]
+		if held is None or name in held:
+			return backend
+		if held and GLOBAL not in held:
+			raise RuntimeError(f"a transaction in shard {next(iter(held))!r} can't also {'write' if write else 'read'} {name!r}")
+		self.state.stack.enter_context(backend.transaction())
+		held.add(name)
+		return backend
+
+	def scatter(self, names: List[str]) -> List[Storage]:
+		# datastores for a read, only the one it needs is taken into the transaction
+		if len(names) == 1:
+			return [self.use(names[0])]
+		held = self.held()
+		if held and GLOBAL not in held and not held.issuperset(names):
+			raise RuntimeError(f"a transaction in shard {next(iter(held))!r} can't read every shard")
+		return [self.backends[name] for name in names]
+
+	def owner(self, table: Table, doc_id: int) -> str:
+		return self.map.shard_of(pincode_of(doc_id)) if table in SHARD_KEYS else GLOBAL
+
+	def owners(self, table: Table, doc_ids: Iterable[int]) -> Dict[str, List[int]]:
+		rv: Dict[str, List[int]] = {}
+		for doc_id in doc_ids:
+			rv.setdefault(self.owner(table, doc_id), []).append(doc_id)
+		return rv
+
+	def places(self, table: Table, fields: Dict[str, Any]) -> List[str]:
+		# datastores that may hold the documents matching `fields`
+		if table not in SHARD_KEYS:
+			return [GLOBAL]
+		pincode = shard_key(table, fields)
+		return [self.map.shard_of(pincode)] if pincode is not None else list(self.map.shards)
+
+	@contextlib.contextmanager
+	def transaction(self) -> Iterator[None]:
+		state = self.state
+		if getattr(state, "depth", 0):
+			state.depth += 1
+			try:
+				yield
+			finally:
+				state.depth -= 1
+			return
+		with contextlib.ExitStack() as stack:
+			state.depth, state.held, state.stack = 1, set(), stack
+			try:
+				yield
+			finally:
+				state.depth, state.held, state.stack = 0, set(), None
+
+	def next_seq(self, backend: Storage, table: Table, pincode: int) -> int:
+		# the counter lives in the shard, so it moves along with the pincode
+		counter = backend.find_one(Table.sequences, name=table.name, pincode=pincode)
+		if counter is None:
+			backend.insert(Table.sequences, {"name": table.name, "pincode": pincode, "next": 2})
+			return 1
+		return backend.increment(Table.sequences, counter.doc_id, "next", 1) - 1 # type: ignore
+
+	def insert(self, table: Table, doc: Dict[str, Any]) -> int:
+		if table not in SHARD_KEYS:
+			return self.use(GLOBAL, write=True).insert(table, doc)
+		pincode = shard_key(table, doc)
+		if pincode is None:
+			raise ValueError(f"can't tell the pincode of a {table.name} document")
+		with self.transaction():
+			backend = self.use(self.map.shard_of(pincode), write=True)
+			doc_id = sharded_id(self.next_seq(backend, table, pincode), pincode)
+			backend.insert_documents(table, [Document(doc, doc_id)])
+			return doc_id
+
+	def insert_documents(self, table: Table, docs: Iterable[Document]):
+		groups: Dict[str, List[Document]] = {}
+		for doc in docs:
+			groups.setdefault(self.owner(table, doc.doc_id), []).append(doc)
+		for name, group in groups.items():
+			self.use(name, write=True).insert_documents(table, group)
+
+	def get(self, table: Table, doc_id: int) -> Optional[Document]:
+		return self.use(self.owner(table, doc_id)).get(table, doc_id)
+
+	def get_many(self, table: Table, doc_ids: Iterable[int]) -> List[Document]:
+		groups = self.owners(table, doc_ids)
+		backends = self.scatter(list(groups))
+		docs = [d for backend, ids in zip(backends, groups.values()) for d in backend.get_many(table, ids)]
+		return sorted(docs, key=lambda d: d.doc_id) if len(groups) > 1 else docs
+
+	def search(self, table: Table, **fields: Any) -> List[Document]:
+		return [d for backend in self.scatter(self.places(table, fields)) for d in backend.search(table, **fields)]
+
+	def all(self, table: Table) -> List[Document]:
+		return [d for backend in self.scatter(self.places(table, {})) for d in backend.all(table)]
+
+	def search_sorted(self, table: Table, order_by: str, limit: int, before: Optional[Tuple[Any, int]] = None,
+			**fields: Any) -> List[Document]:
+		ranges = [b.search_sorted(table, order_by, limit, before, **fields) for b in self.scatter(self.places(table, fields))]
+		if len(ranges) == 1:
+			return ranges[0]
+		return list(itertools.islice(heapq.merge(*ranges, key=lambda d: (d[order_by], d.doc_id), reverse=True), limit))
+
+	def since(self, table: Table, doc_id: int) -> List[Document]:
+		return [d for backend in self.scatter(self.places(table, {})) for d in backend.since(table, doc_id)]
+
+	def generation(self) -> Any:
+		# the invalidation log is global
+		return self.backends[GLOBAL].generation()
+
+	def update(self, table: Table, fields: Dict[str, Any], doc_ids: List[int]):
+		for name, ids in self.owners(table, doc_ids).items():
+			self.use(name, write=True).update(table, fields, ids)
+
+	def update_where(self, table: Table, fields: Dict[str, Any], **cond: Any):
+		for name in self.places(table, cond):
+			self.use(name, write=True).update_where(table, fields, **cond)
+
+	def remove(self, table: Table, doc_ids: List[int]):
+		for name, ids in self.owners(table, doc_ids).items():
+			self.use(name, write=True).remove(table, ids)
+
+	def increment(self, table: Table, doc_id: int, field: str, delta: int, **fields: Any) -> Optional[int]:
+		return self.use(self.owner(table, doc_id), write=True).increment(table, doc_id, field, delta, **fields)
+
+	def append(self, table: Table, doc_id: int, field: str, value: Any):
+		self.use(self.owner(table, doc_id), write=True).append(table, doc_id, field, value)
+
+	def remove_below(self, table: Table, field: str, value: Any) -> int:
+		return sum(self.use(name, write=True).remove_below(table, field, value) for name in self.places(table, {}))
+
+	def count(self, table: Table) -> int:
+		return sum(backend.count(table) for backend in self.scatter(self.places(table, {})))
+
+	def compact(self):
+		for backend in self.backends.values():
+			backend.compact()
+
+	def flush(self):
+		for backend in self.backends.values():
+			backend.flush()
+
+	def close(self):
+		for backend in self.backends.values():
+			backend.close()
+
+
+# the offline tools below rewrite the datastores directly: stop the workers while they run
+
+def path_beside(map_path: str, name: str, suffix: str) -> str:
+	# `rental.shards.json`, "global" -> `rental-global.json`
+	return os.path.basename(map_path)[:-len(SHARD_MAP_SUFFIX)] + f"-{name}{suffix}"
+
+
+def spread(weights: Dict[int, int], names: List[str]) -> Dict[int, str]:
+	# pincode -> shard, heaviest pincodes first, each onto the lightest shard so far
+	loads = [(0, name) for name in names]
+	rv = {}
+	for pincode, weight in sorted(weights.items(), key=lambda kv: (-kv[1], kv[0])):
+		load, name = heapq.heappop(loads)
+		rv[pincode] = name
+		heapq.heappush(loads, (load + weight, name))
+	return rv
+
+
+def split(source: str, map_path: str, shards: int, suffix: str = ".json") -> ShardMap:
+	# copies a single datastore into a global one and `shards` shards, next to `map_path`;
+	# sharded documents get ids carrying their pincode, so every reference to them is rewritten
+	if not map_path.endswith(SHARD_MAP_SUFFIX):
+		raise ValueError(f"the shard map has to be a {SHARD_MAP_SUFFIX} file")
+	if os.path.exists(map_path):
+		raise FileExistsError(map_path)
+	storage = open_storage(source)
+	try:
+		data = {table: storage.all(table) for table in Table}
+	finally:
+		storage.close()
+
+	def ref(ids: Dict[int, int], doc_id: Optional[int], referrer: str, kind: str) -> Optional[int]:
+		# a dangling reference is reported rather than raised as a KeyError
+		if doc_id is None:
+			return None
+		if doc_id not in ids:
+			raise ValueError(f"{source}: {referrer} refers to {kind} {doc_id}, which doesn't exist")
+		return ids[doc_id]
+
+	address_pincodes = {a.doc_id: a["pincode"] for a in data[Table.addresses]}
+	shop_pincodes = {s.doc_id: ref(address_pincodes, s["address_id"], f"shop {s.doc_id}", "address") for s in data[Table.shops]}
+	pincode_by: Dict[Table, Callable[[Document], Optional[int]]] = {
+		Table.addresses: lambda d: d["pincode"],
+		Table.shops: lambda d: shop_pincodes[d.doc_id],
+		Table.orders: lambda d: ref(shop_pincodes, d["shop_id"], f"order {d.doc_id}", "shop"),
+		Table.order_events: lambda d: d["pincode"],
+		Table.rollups: lambda d: d["pincode"],
+	}
+	seqs: Dict[Tuple[Table, int], int] = {} # last seq handed out per (table, pincode)
+	new_ids: Dict[Table, Dict[int, int]] = {table: {} for table in SHARD_KEYS}
+	for table, pincode_of_doc in pincode_by.items():
+		for doc in data[table]:
+			pincode = pincode_of_doc(doc)
+			if not isinstance(pincode, int):
+				raise ValueError(f"{source}: {table.name} {doc.doc_id} has no pincode")
+			seqs[(table, pincode)] = seq = seqs.get((table, pincode), 0) + 1
+			new_ids[table][doc.doc_id] = sharded_id(seq, pincode)
+	kinds = {Table.addresses: "address", Table.shops: "shop"}
+	new = lambda table, doc_id, d, referrer: ref(new_ids[table], doc_id, f"{referrer} {d.doc_id}", kinds[table])
+	rewrite = {
+		Table.shops: lambda d: {**d, "address_id": new(Table.addresses, d["address_id"], d, "shop")},
+		Table.orders: lambda d: {**d, "address_id": new(Table.addresses, d["address_id"], d, "order"),
+			"shop_id": new(Table.shops, d["shop_id"], d, "order")},
+		# the orders of cart lines taken out again are deleted, their events stay
+		Table.order_events: lambda d: {**d, "order_id": new_ids[Table.orders].get(d["order_id"]),
+			"shop_id": new(Table.shops, d["shop_id"], d, "order event")},
+		Table.rollups: lambda d: {**d, "shop_id": new(Table.shops, d["shop_id"], d, "rollup")},
+		Table.users: lambda d: {**d, "address_ids": [new(Table.addresses, a, d, "user") for a in d["address_ids"]]},
+		Table.carts: lambda d: {**d, "lines": [[new(Table.shops, line[0], d, "cart"), *line[1:]] for line in d["lines"]]},
+	}
+	docs: Dict[Table, List[Document]] = {}
+	for table in Table:
+		if table in (Table.invalidations, Table.sequences): # workers start over with an empty log
+			continue
+		change = rewrite.get(table, dict)
+		docs[table] = [Document(change(d), new_ids[table][d.doc_id] if table in SHARD_KEYS else d.doc_id) for d in data[table]]
+
+	weights: Dict[int, int] = {}
+	for table in SHARD_KEYS:
+		for doc in docs[table]:
+			weights[pincode_of(doc.doc_id)] = weights.get(pincode_of(doc.doc_id), 0) + 1
+	names = [f"shard-{i}" for i in range(1, shards + 1)]
+	shard_map = ShardMap(map_path, path_beside(map_path, GLOBAL, suffix), {n: path_beside(map_path, n, suffix) for n in names},
+		spread(weights, names), names[0])
+	for path in [shard_map.global_path, *shard_map.shards.values()]:
+		if os.path.exists(shard_map.resolve(path)):
+			raise FileExistsError(shard_map.resolve(path))
+
+	for name, path in [(GLOBAL, shard_map.global_path), *shard_map.shards.items()]:
+		storage = open_storage(shard_map.resolve(path))
+		try:
+			with storage.transaction():
+				for table, table_docs in docs.items():
+					if (table in SHARD_KEYS) == (name != GLOBAL):
+						storage.insert_documents(table, [d for d in table_docs if name == GLOBAL or shard_map.shard_of(pincode_of(d.doc_id)) == name])
+				for (table, pincode), seq in seqs.items():
+					if name != GLOBAL and shard_map.shard_of(pincode) == name:
+						storage.insert(Table.sequences, {"name": table.name, "pincode": pincode, "next": seq + 1})
+		finally:
+			storage.close()
+	shard_map.save()
+	return shard_map
+
+
+def pincode_docs(storage: Storage, pincode: Optional[int] = None) -> Dict[Table, List[Document]]:
+	# a shard's documents of one pincode (all of them for None)
+	return {table: [d for d in storage.all(table) if pincode is None or pincode_of(d.doc_id) == pincode] for table in SHARD_KEYS}
+
+
+def move(shard_map: ShardMap, pincode: int, target: str, path: Optional[str] = None) -> Dict[str, int]:
+	# moves a pincode's documents (ids unchanged) and id counters to shard `target`, a new one when `path` is
+	# given; the map is switched once the copy is written, so a crash before leaves the source as it was
+	source = shard_map.shard_of(pincode)
+	if target == source:
+		return {}
+	if target not in shard_map.shards:
+		if path is None:
+			raise ValueError(f"no shard {target!r}, give the path of its new datastore")
+		shard_map.shards[target] = path
+	src = open_storage(shard_map.resolve(shard_map.shards[source]))
+	dst = open_storage(shard_map.resolve(shard_map.shards[target]))
+	try:
+		moving = pincode_docs(src, pincode)
+		counters = src.search(Table.sequences, pincode=pincode)
+		with dst.transaction():
+			# leftovers of an interrupted move
+			for table, docs in pincode_docs(dst, pincode).items():
+				dst.remove(table, [d.doc_id for d in docs])
+			dst.remove(Table.sequences, [d.doc_id for d in dst.search(Table.sequences, pincode=pincode)])
+			for table, docs in moving.items():
+				dst.insert_documents(table, docs)
+			for counter in counters:
+				dst.insert(Table.sequences, dict(counter))
+		shard_map.pincodes[pincode] = target
+		shard_map.save()
+		with src.transaction():
+			for table, docs in moving.items():
+				src.remove(table, [d.doc_id for d in docs])
+			src.remove(Table.sequences, [d.doc_id for d in counters])
+	finally:
+		src.close()
+		dst.close()
+	return {table.name: len(docs) for table, docs in moving.items()}
+
+
+def shard_loads(shard_map: ShardMap) -> Dict[str, Dict[int, int]]:
+	# shard -> pincode -> documents it holds
+	rv: Dict[str, Dict[int, int]] = {}
+	for name, path in shard_map.shards.items():
+		storage = open_storage(shard_map.resolve(path))
+		try:
+			loads = rv[name] = {}
+			for docs in pincode_docs(storage).values():
+				for doc in docs:
+					loads[pincode_of(doc.doc_id)] = loads.get(pincode_of(doc.doc_id), 0) + 1
+		finally:
+			storage.close()
+	return rv
+
+
+def plan_balance(loads: Dict[str, Dict[int, int]]) -> List[Tuple[int, str, str]]:
+	# -> (pincode, from, to) moves: while a pincode of the fullest shard weighs less than its gap to the
+	# emptiest one, the one closest to half the gap goes over
+	loads = {name: dict(pincodes) for name, pincodes in loads.items()}
+	totals = {name: sum(pincodes.values()) for name, pincodes in loads.items()}
+	moves = []
+	while len(totals) > 1:
+		full, empty = max(totals, key=lambda n: totals[n]), min(totals, key=lambda n: totals[n])
+		gap = totals[full] - totals[empty]
+		fits = [(abs(gap - 2 * w), p) for p, w in loads[full].items() if 0 < w < gap]
+		if not fits:
+			break
+		_, pincode = min(fits)
+		weight = loads[full].pop(pincode)
+		loads[empty][pincode] = weight
+		totals[full] -= weight
+		totals[empty] += weight
+		moves.append((pincode, full, empty))
+	return moves
+
+
+def main():
+	parser = argparse.ArgumentParser(description="split a rental database by pincode, inspect and rebalance the shards (stop the workers first)")
+	commands = parser.add_subparsers(dest="command", required=True)
+	p = commands.add_parser("split", help="copy a single datastore into a global one and pincode shards")
+	p.add_argument("source", help="rental.json, rental.snapshot or a .sqlite3 file")
+	p.add_argument("map", help=f"the new shard map, e.g. rental{SHARD_MAP_SUFFIX}")
+	p.add_argument("--shards", type=int, default=4)
+	p.add_argument("--suffix", default=".json", help="of the new datastores: .json, .snapshot or .sqlite3")
+	p = commands.add_parser("status", help="documents and pincodes per shard")
+	p.add_argument("map")
+	p = commands.add_parser("move", help="move a pincode to another (or a new) shard")
+	p.add_argument("map")
+	p.add_argument("pincode", type=int)
+	p.add_argument("shard")
+	p.add_argument("--path", help="datastore of a new shard, relative to the map")
+	p = commands.add_parser("balance", help="move pincodes off the fullest shards")
+	p.add_argument("map")
+	p.add_argument("--apply", action="store_true", help="make the moves instead of listing them")
+	args = parser.parse_args()
+
+	try:
+		if args.command == "split":
+			shard_map = split(args.source, args.map, args.shards, args.suffix)
+			print(f"{len(shard_map.pincodes)} pincodes over {len(shard_map.shards)} shards, start the app with --db {args.map}")
+			return
+		shard_map = ShardMap.load(args.map)
+		if args.command == "status":
+			for name, pincodes in shard_loads(shard_map).items():
+				path = shard_map.resolve(shard_map.shards[name])
+				size = os.path.getsize(path) if os.path.exists(path) else 0
+				default = " (default)" if name == shard_map.default else ""
+				print(f"{name}{default}: {sum(pincodes.values())} docs, {len(pincodes)} pincodes, {size} bytes  {shard_map.shards[name]}")
+		elif args.command == "move":
+			moved = move(shard_map, args.pincode, args.shard, args.path)
+			print(", ".join(f"{table}: {n}" for table, n in moved.items()) or f"{args.pincode} is already in {args.shard}")
+		elif args.command == "balance":
+			moves = plan_balance(shard_loads(shard_map))
+			for pincode, source, target in moves:
+				print(f"{pincode}: {source} -> {target}")
+				if args.apply:
+					move(shard_map, pincode, target)
+			if not moves:
+				print("balanced")
+	except (ValueError, FileExistsError) as e:
+		parser.error(str(e))
+
+
+if __name__ == "__main__":
+	main()
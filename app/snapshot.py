@@ -0,0 +1,138 @@
+import argparse
+import json
+import marshal
+import mmap
+import os
+import sys
+from typing import Any, Dict, Optional
+
+from tinydb.storages import Storage, touch
+
+try:
+	import msgpack
+except ImportError: # optional, snapshots fall back to marshal (readable by the same python version only)
+	msgpack = None
+
+SNAPSHOT_SUFFIXES = (".snapshot",)
+MAGIC = b"RNTLSNAP"
+FORMAT_VERSION = 1
+MSGPACK, MARSHAL = b"m", b"M"
+# magic, format version, codec, python major/minor (marshal only, zero otherwise)
+HEADER_SIZE = len(MAGIC) + 4
+
+
+class SnapshotError(ValueError):
+	pass
+
+
+def is_snapshot(path: str) -> bool:
+	return path.endswith(SNAPSHOT_SUFFIXES)
+
+
+def dumps(data: Dict[str, Any]) -> bytes:
+	# `data` is tinydb's layout: table name -> str(doc_id) -> document
+	if msgpack is not None:
+		return MAGIC + bytes([FORMAT_VERSION]) + MSGPACK + bytes(2) + msgpack.packb(data, use_bin_type=True)
+	return MAGIC + bytes([FORMAT_VERSION]) + MARSHAL + bytes(sys.version_info[:2]) + marshal.dumps(data)
+
+
+def loads(raw: Any) -> Dict[str, Any]:
+	# `raw` is anything exposing the buffer protocol: bytes, or a mapped file
+	header = bytes(raw[:HEADER_SIZE])
+	if not header.startswith(MAGIC):
+		raise SnapshotError("not a rental snapshot")
+	version, codec, python = header[len(MAGIC)], header[len(MAGIC) + 1:len(MAGIC) + 2], tuple(header[len(MAGIC) + 2:])
+	if version != FORMAT_VERSION:
+		raise SnapshotError(f"snapshot format {version} is not supported (expected {FORMAT_VERSION})")
+	payload = memoryview(raw)[HEADER_SIZE:]
+	try:
+		if codec == MSGPACK:
+			if msgpack is None:
+				raise SnapshotError("this snapshot needs msgpack: pip install msgpack")
+			return msgpack.unpackb(payload, raw=False)
+		if python != tuple(sys.version_info[:2]):
+			raise SnapshotError(f"this snapshot was written by python {python[0]}.{python[1]}, convert it again (python -m app.snapshot)")
+		return marshal.loads(payload)
+	finally:
+		payload.release()
+
+
+def read_snapshot(path: str) -> Optional[Dict[str, Any]]:
+	# None for a missing or empty file, like tinydb's JSONStorage
+	try:
+		size = os.path.getsize(path)
+	except FileNotFoundError:
+		return None
+	if size == 0:
+		return None
+	with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+		return loads(mapped)
+
+
+def write_snapshot(path: str, data: Dict[str, Any]) -> int:
+	raw = dumps(data)
+	tmp_path = path + ".tmp"
+	with open(tmp_path, "wb") as f:
+		f.write(raw)
+		f.flush()
+		os.fsync(f.fileno())
+	os.replace(tmp_path, path)
+	return len(raw)
+
+
+class SnapshotStorage(Storage):
+	# tinydb storage over a snapshot file, the binary counterpart of `JSONStorage`
+	def __init__(self, path: str, create_dirs: bool = False, **kwargs: Any) -> None:
+		self.path = path
+		self.last_size = 0 # bytes of the last write
+		touch(path, create_dirs=create_dirs)
+
+	def read(self) -> Optional[Dict[str, Any]]:
+		return read_snapshot(self.path)
+
+	def write(self, data: Dict[str, Any]):
+		self.last_size = write_snapshot(self.path, data)
+
+
+def read_any(path: str) -> Dict[str, Any]:
+	if is_snapshot(path):
+		return read_snapshot(path) or {}
+	with open(path, encoding="utf-8") as f:
+		content = f.read()
+	return json.loads(content) if content.strip() else {}
+
+
+def convert(source: str, target: str) -> Dict[str, int]:
+	# json -> snapshot or snapshot -> json, decided by the file names
+	if is_snapshot(source) == is_snapshot(target):
+		raise ValueError("convert between a .json file and a .snapshot file")
+	if os.path.exists(target) and os.path.getsize(target) > 0:
+		raise FileExistsError(target)
+	data = read_any(source)
+	if is_snapshot(target):
+		write_snapshot(target, data)
+	else:
+		tmp_path = target + ".tmp"
+		with open(tmp_path, "w", encoding="utf-8") as f:
+			json.dump(data, f)
+		os.replace(tmp_path, target)
+	return {table: len(docs) for table, docs in data.items()}
+
+
+def main():
+	parser = argparse.ArgumentParser(description="convert a rental database between json and the binary snapshot format")
+	parser.add_argument("source", help="rental.json or rental.snapshot")
+	parser.add_argument("target", help="a new file with the other suffix")
+	args = parser.parse_args()
+	try:
+		counts = convert(args.source, args.target)
+	except (ValueError, FileExistsError) as e:
+		parser.error(str(e))
+	for table, count in counts.items():
+		print(f"{table}: {count}")
+	codec = ("msgpack" if msgpack is not None else "marshal") if is_snapshot(args.target) else "json"
+	print(f"{os.path.getsize(args.source)} -> {os.path.getsize(args.target)} bytes ({codec})")
+
+
+if __name__ == "__main__":
+	main()
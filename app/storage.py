@@ -0,0 +1,718 @@
+import abc
+import contextlib
+import enum
+import json
+import sqlite3
+import threading
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Set, Tuple
+
+from tinydb import TinyDB, Query
+from tinydb.middlewares import Middleware
+from tinydb.storages import JSONStorage
+from tinydb.table import Document
+
+from . import metrics
+from .indexes import TableIndexes
+from .locks import FileLock
+from .snapshot import SnapshotStorage, is_snapshot
+from .write_behind import WriteBehindConfig, WriteBehindStorage
+
+
+class Table(enum.Enum):
+	users = enum.auto()
+	sessions = enum.auto()
+	orders = enum.auto()
+	shops = enum.auto()
+	items = enum.auto()
+	addresses = enum.auto()
+	invalidations = enum.auto() # cache invalidations published to the other worker processes
+	carts = enum.auto() # one aggregate per user, doc_id == user_id
+	order_events = enum.auto() # append-only order lifecycle log, see `reports`
+	rollups = enum.auto() # sales counters per (day, shop_id, item_id), folded from `order_events`
+	sequences = enum.auto() # per (table, pincode) id counters of a shard, see `shards`
+
+
+class Storage(abc.ABC):
+	# Documents are handed out as tinydb `Document`s by every backend so that
+	# `models.*.from_doc` keeps working unchanged.
+
+	@abc.abstractmethod
+	def insert(self, table: Table, doc: Dict[str, Any]) -> int:
+		...
+
+	@abc.abstractmethod
+	def insert_documents(self, table: Table, docs: Iterable[Document]):
+		# bulk insert that keeps the given doc_ids, used by migrations/imports
+		...
+
+	@abc.abstractmethod
+	def get(self, table: Table, doc_id: int) -> Optional[Document]:
+		...
+
+	@abc.abstractmethod
+	def get_many(self, table: Table, doc_ids: Iterable[int]) -> List[Document]:
+		# missing ids are skipped, result is ordered by doc_id
+		...
+
+	@abc.abstractmethod
+	def search(self, table: Table, **fields: Any) -> List[Document]:
+		...
+
+	def find_one(self, table: Table, **fields: Any) -> Optional[Document]:
+		result = self.search(table, **fields)
+		return result[0] if result else None
+
+	@abc.abstractmethod
+	def all(self, table: Table) -> List[Document]:
+		...
+
+	def search_sorted(self, table: Table, order_by: str, limit: int, before: Optional[Tuple[Any, int]] = None,
+			**fields: Any) -> List[Document]:
+		# matching docs by (order_by, doc_id) descending, only those strictly below `before`;
+		# backends answer this from an index when SORTED_INDEXES has one
+		docs = [d for d in self.search(table, **fields) if d.get(order_by) is not None]
+		docs.sort(key=lambda d: (d[order_by], d.doc_id), reverse=True)
+		if before is not None:
+			docs = [d for d in docs if (d[order_by], d.doc_id) < tuple(before)]
+		return docs[:limit]
+
+	def since(self, table: Table, doc_id: int) -> List[Document]:
+		# documents inserted after `doc_id`
+		return [d for d in self.all(table) if d.doc_id > doc_id]
+
+	def generation(self) -> Any:
+		# changes whenever another process committed something
+		return None
+
+	@abc.abstractmethod
+	def update(self, table: Table, fields: Dict[str, Any], doc_ids: List[int]):
+		...
+
+	@abc.abstractmethod
+	def update_where(self, table: Table, fields: Dict[str, Any], **cond: Any):
+		...
+
+	@abc.abstractmethod
+	def remove(self, table: Table, doc_ids: List[int]):
+		...
+
+	@abc.abstractmethod
+	def transaction(self) -> "contextlib.AbstractContextManager[None]":
+		# everything inside is atomic with respect to other threads and processes, re-entrant
+		...
+
+	def increment(self, table: Table, doc_id: int, field: str, delta: int, **fields: Any) -> Optional[int]:
+		# atomically adds `delta` to `field` (and sets `fields`), returns the new value
+		with self.transaction():
+			doc = self.get(table, doc_id)
+			if doc is None:
+				return None
+			value = doc[field] + delta
+			self.update(table, {field: value, **fields}, doc_ids=[doc_id])
+			return value
+
+	def append(self, table: Table, doc_id: int, field: str, value: Any):
+		# atomically appends `value` to the list in `field`
+		with self.transaction():
+			doc = self.get(table, doc_id)
+			if doc is None:
+				raise KeyError(doc_id)
+			self.update(table, {field: doc[field] + [value]}, doc_ids=[doc_id])
+
+	def remove_below(self, table: Table, field: str, value: Any) -> int:
+		# removes the docs whose `field` sorts below `value`, returns how many
+		with self.transaction():
+			doc_ids = [d.doc_id for d in self.all(table) if d.get(field) is not None and d[field] < value]
+			if doc_ids:
+				self.remove(table, doc_ids)
+			return len(doc_ids)
+
+	def count(self, table: Table) -> int:
+		return len(self.all(table))
+
+	def compact(self):
+		# gives back the space freed by removals
+		...
+
+	def flush(self):
+		...
+
+	def close(self):
+		...
+
+
+class WriteThroughCache(Middleware):
+	# keeps the parsed file in memory so reads don't re-parse rental.json, every write still hits disk
+	# (once per transaction: writes made inside `deferred()` are written out together at its end)
+	def __init__(self, storage_cls=JSONStorage) -> None:
+		super().__init__(storage_cls)
+		self.cache = None
+		self.deferring = False
+		self.dirty = False
+		self.before_write: Optional[Callable[[], None]] = None
+
+	def read(self):
+		if self.cache is None:
+			self.cache = self.storage.read()
+		return self.cache
+
+	def write(self, data):
+		self.cache = data
+		if self.deferring:
+			self.dirty = True
+			return
+		if self.before_write is not None:
+			self.before_write()
+		self.storage.write(data)
+		# the whole file is rewritten
+		if isinstance(self.storage, SnapshotStorage):
+			metrics.count(bytes_written=self.storage.last_size)
+		else:
+			metrics.count(bytes_written=self.storage._handle.tell()) # type: ignore
+
+	@contextlib.contextmanager
+	def deferred(self) -> Iterator[None]:
+		self.deferring = True
+		try:
+			yield
+		finally:
+			self.deferring = False
+			if self.dirty:
+				self.dirty = False
+				self.write(self.cache)
+
+
+class TinyDBStorage(Storage):
+	# `shared=True` when other processes (uvicorn workers) open the same file: every operation then
+	# runs under a `FileLock` and reloads the file if someone else changed it since we last saw it.
+	def __init__(self, db_path: str, write_behind: Optional[WriteBehindConfig] = None, shared: bool = False) -> None:
+		if shared and write_behind is not None:
+			raise ValueError("write-behind keeps the data in this process, it can't be shared")
+		self.path = db_path
+		# tinydb itself is not thread safe and the cache + indexes are shared
+		self.lock = threading.RLock()
+		self.lock_depth = 0
+		self.lock_exclusive = False
+		self.file_lock = FileLock(db_path + ".lock") if shared else None
+		self.signature = None # the lock file's write generation our cache reflects
+		self.reloads = 0
+		self.write_behind: Optional[WriteBehindStorage] = None
+		self.pending_records: Optional[List[Dict[str, Any]]] = None # journal entries of the open transaction
+		if write_behind is None:
+			self.database = TinyDB(db_path, storage=WriteThroughCache(SnapshotStorage if is_snapshot(db_path) else JSONStorage))
+			if self.file_lock is not None:
+				self.database.storage.before_write = self.bump_generation # type: ignore
+		else:
+			self.database = TinyDB(db_path, storage=WriteBehindStorage, config=write_behind, lock=self.lock)
+			self.write_behind = self.database.storage # type: ignore
+		self.database.table(Table.users.name)
+		self.indexes = {table: TableIndexes(TINYDB_INDEXES.get(table, []), SORTED_INDEXES.get(table, [])) for table in Table}
+		self.built: Set[Table] = set() # tables whose indexes are up to date, the rest are built on first use
+
+	def table(self, table: Table):
+		return self.database.table(table.name)
+
+	def rebuild_indexes(self):
+		with self.lock:
+			self.built.clear()
+
+	def table_indexes(self, table: Table) -> TableIndexes:
+		# callers hold `lock`, and take the indexes before changing the table
+		if table not in self.built:
+			# straight from the raw table, building a tinydb `Document` per row costs as much as the indexing
+			data = self.database.storage.read() or {}
+			self.indexes[table].rebuild(data.get(table.name, {}))
+			self.built.add(table)
+		return self.indexes[table]
+
+	@contextlib.contextmanager
+	def locked(self, exclusive: bool = False) -> Iterator[None]:
+		with self.lock:
+			outermost = self.lock_depth == 0
+			if not outermost and exclusive and not self.lock_exclusive:
+				raise RuntimeError("can't write while holding a shared lock")
+			self.lock_depth += 1
+			if outermost:
+				self.lock_exclusive = exclusive
+			try:
+				if self.file_lock is None or not outermost:
+					with (self.deferred_writes() if outermost and exclusive else contextlib.nullcontext()):
+						yield
+				else:
+					with (self.file_lock.exclusive() if exclusive else self.file_lock.shared()):
+						self.refresh_if_changed()
+						with (self.deferred_writes() if exclusive else contextlib.nullcontext()):
+							yield
+			finally:
+				self.lock_depth -= 1
+				if outermost:
+					self.lock_exclusive = False
+
+	def transaction(self):
+		return self.locked(exclusive=True)
+
+	def deferred_writes(self):
+		# without write-behind every tinydb write rewrites the file, a transaction does it once;
+		# with it, a transaction's journal entries are appended (and fsynced) together
+		if self.write_behind is not None:
+			return self.journal_batch()
+		return self.database.storage.deferred() # type: ignore
+
+	@contextlib.contextmanager
+	def journal_batch(self) -> Iterator[None]:
+		self.pending_records = []
+		try:
+			yield
+		finally:
+			entries, self.pending_records = self.pending_records, None
+			if entries:
+				self.write_behind.record_many(entries) # type: ignore
+
+	def bump_generation(self):
+		# every write bumps the counter in the lock file: a file rewritten in place with the same size
+		# inside one mtime tick would look unchanged to os.stat
+		self.signature = self.file_lock.bump() # type: ignore
+
+	def refresh_if_changed(self):
+		signature = self.file_lock.generation() # type: ignore
+		if signature == self.signature:
+			return
+		self.signature = signature
+		self.database.storage.cache = None # type: ignore
+		self.database._tables.clear() # cached tables remember their next doc id
+		self.rebuild_indexes()
+		self.reloads += 1
+
+	def generation(self) -> Any:
+		if self.file_lock is None:
+			return None
+		with self.locked():
+			return self.reloads
+
+	def record(self, op: str, table: Table, **entry: Any):
+		if self.write_behind is None:
+			return
+		if self.pending_records is not None:
+			self.pending_records.append({"op": op, "table": table.name, **entry})
+		else:
+			self.write_behind.record({"op": op, "table": table.name, **entry})
+
+	def flush(self):
+		if self.write_behind is not None:
+			self.write_behind.flush()
+
+	def compact(self):
+		# every commit rewrites the whole file, so this only has to commit the pending removals
+		self.flush()
+
+	def insert(self, table: Table, doc: Dict[str, Any]) -> int:
+		with self.locked(exclusive=True):
+			indexes = self.table_indexes(table)
+			doc_id = self.table(table).insert(doc)
+			indexes.add([Document(doc, doc_id)])
+			self.record("insert", table, doc_id=doc_id, doc=doc)
+			return doc_id
+
+	def insert_documents(self, table: Table, docs: Iterable[Document]):
+		docs = list(docs)
+		with self.locked(exclusive=True):
+			indexes = self.table_indexes(table)
+			self.table(table).insert_multiple(docs)
+			indexes.add(docs)
+			for doc in docs:
+				self.record("insert", table, doc_id=doc.doc_id, doc=doc)
+
+	def get(self, table: Table, doc_id: int) -> Optional[Document]:
+		with self.locked():
+			return self.table(table).get(doc_id=doc_id)
+
+	def get_many(self, table: Table, doc_ids: Iterable[int]) -> List[Document]:
+		with self.locked():
+			tiny_table = self.table(table)
+			docs = (tiny_table.get(doc_id=i) for i in sorted(set(doc_ids)))
+			return [d for d in docs if d is not None]
+
+	def search(self, table: Table, **fields: Any) -> List[Document]:
+		with self.locked():
+			index = self.table_indexes(table).find(fields)
+			if index is None:
+				metrics.count(scans=1)
+				return self.table(table).search(Query().fragment(fields))
+			return self.get_many(table, index.lookup(fields))
+
+	def search_sorted(self, table: Table, order_by: str, limit: int, before: Optional[Tuple[Any, int]] = None,
+			**fields: Any) -> List[Document]:
+		with self.locked():
+			index = self.table_indexes(table).find_sorted(fields, order_by)
+			if index is None:
+				return super().search_sorted(table, order_by, limit, before, **fields)
+			doc_ids = index.page(fields, limit, before)
+			docs = {d.doc_id: d for d in self.get_many(table, doc_ids)}
+			return [docs[i] for i in doc_ids if i in docs]
+
+	def all(self, table: Table) -> List[Document]:
+		with self.locked():
+			metrics.count(scans=1)
+			return self.table(table).all()
+
+	def update(self, table: Table, fields: Dict[str, Any], doc_ids: List[int]):
+		with self.locked(exclusive=True):
+			indexes = self.table_indexes(table)
+			old = self.get_many(table, doc_ids)
+			self.table(table).update(fields, doc_ids=doc_ids)
+			indexes.discard(old)
+			indexes.add(self.get_many(table, doc_ids))
+			self.record("update", table, doc_ids=list(doc_ids), fields=fields)
+
+	def update_where(self, table: Table, fields: Dict[str, Any], **cond: Any):
+		with self.locked(exclusive=True):
+			self.update(table, fields, [d.doc_id for d in self.search(table, **cond)])
+
+	def remove(self, table: Table, doc_ids: List[int]):
+		with self.locked(exclusive=True):
+			indexes = self.table_indexes(table)
+			old = self.get_many(table, doc_ids)
+			self.table(table).remove(doc_ids=doc_ids)
+			indexes.discard(old)
+			self.record("remove", table, doc_ids=list(doc_ids))
+
+	def close(self):
+		# not under `lock`: closing the write-behind storage joins its flusher thread, which takes it
+		self.database.close()
+		if self.file_lock is not None:
+			self.file_lock.close()
+
+
+JSON = "JSON" # stored as TEXT, (de)serialised by the backend
+
+SCHEMA: Dict[Table, Dict[str, str]] = {
+	Table.users: {
+		"first_name": "TEXT",
+		"last_name": "TEXT",
+		"email": "TEXT",
+		"password": "TEXT",
+		"address_ids": JSON,
+	},
+	Table.sessions: {
+		"created_at": "TEXT",
+		"user_id": "INTEGER",
+		"token": "TEXT",
+	},
+	Table.orders: {
+		"placed_at": "TEXT",
+		"updated_at": "TEXT",
+		"address_id": "INTEGER",
+		"user_id": "INTEGER",
+		"item_id": "INTEGER",
+		"shop_id": "INTEGER",
+		"quantity": "INTEGER",
+		"status": "TEXT",
+	},
+	Table.shops: {
+		"name": "TEXT",
+		"address_id": "INTEGER",
+		"items": JSON,
+	},
+	Table.items: {
+		"name": "TEXT",
+		"price": "REAL",
+		"image_name": "TEXT",
+	},
+	Table.addresses: {
+		"person_name": "TEXT",
+		"pincode": "INTEGER",
+		"building": "TEXT",
+		"city": "TEXT",
+		"district": "TEXT",
+		"state": "TEXT",
+		"landmark": "TEXT",
+		"street": "TEXT",
+	},
+	Table.invalidations: {
+		"kind": "TEXT",
+		"key": JSON,
+		"created_at": "TEXT",
+	},
+	Table.carts: {
+		"pincode": "INTEGER",
+		"lines": JSON,
+		"total": "REAL",
+	},
+	Table.order_events: {
+		"kind": "TEXT",
+		"at": "TEXT",
+		"order_id": "INTEGER",
+		"user_id": "INTEGER",
+		"shop_id": "INTEGER",
+		"item_id": "INTEGER",
+		"pincode": "INTEGER",
+		"quantity": "INTEGER",
+		"price": "REAL",
+	},
+	Table.rollups: {
+		"day": "TEXT",
+		"shop_id": "INTEGER",
+		"item_id": "INTEGER",
+		"pincode": "INTEGER",
+		"cart_adds": "INTEGER",
+		"cart_removes": "INTEGER",
+		"orders_placed": "INTEGER",
+		"units_placed": "INTEGER",
+		"revenue_placed": "REAL",
+		"orders_delivered": "INTEGER",
+		"units_delivered": "INTEGER",
+		"revenue_delivered": "REAL",
+	},
+	Table.sequences: {
+		"name": "TEXT", # of the table
+		"pincode": "INTEGER",
+		"next": "INTEGER",
+	},
+}
+
+INDEXES: Dict[Table, List[List[str]]] = {
+	Table.users: [["email"]],
+	Table.sessions: [["token"], ["user_id"], ["created_at"]],
+	Table.orders: [["user_id"], ["user_id", "status"], ["user_id", "item_id", "shop_id", "status"]],
+	Table.shops: [["address_id"]],
+	Table.items: [],
+	Table.addresses: [["pincode"]],
+	Table.invalidations: [],
+	Table.carts: [],
+	Table.order_events: [["order_id", "kind"], ["pincode"]],
+	Table.rollups: [["day", "shop_id", "item_id"], ["day"], ["shop_id"], ["item_id"], ["pincode"]],
+	Table.sequences: [["name", "pincode"]],
+}
+
+# (fields, order_by): docs matching `fields` kept ordered by `order_by`, see `Storage.search_sorted`
+SORTED_INDEXES: Dict[Table, List[Tuple[List[str], str]]] = {
+	Table.orders: [(["user_id", "status"], "updated_at"), (["shop_id", "status"], "placed_at")],
+}
+
+# tinydb documents are schemaless, so addresses can also be looked up by user_id here
+TINYDB_INDEXES: Dict[Table, List[List[str]]] = {**INDEXES, Table.addresses: INDEXES[Table.addresses] + [["user_id"]]}
+
+SQLITE_MAX_PARAMS = 500
+
+
+def payload_bytes(values: Iterable[Any]) -> int:
+	# what a write hands to sqlite, without its page and WAL overhead
+	return sum(len(v) if isinstance(v, (str, bytes)) else 8 for v in values if v is not None)
+
+
+class SQLiteStorage(Storage):
+	def __init__(self, db_path: str) -> None:
+		# one connection shared between the threadpool workers, serialised by `lock`
+		self.connection = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None, timeout=30)
+		self.lock = threading.RLock()
+		self.transaction_depth = 0
+		self.connection.execute("PRAGMA journal_mode=WAL")
+		self.connection.execute("PRAGMA synchronous=NORMAL")
+		self.create_tables()
+
+	def create_tables(self):
+		with self.lock:
+			for table, columns in SCHEMA.items():
+				cols = ", ".join(f"{name} {'TEXT' if kind == JSON else kind}" for name, kind in columns.items())
+				self.connection.execute(f"CREATE TABLE IF NOT EXISTS {table.name} (id INTEGER PRIMARY KEY AUTOINCREMENT, {cols})")
+				for fields in INDEXES[table]:
+					index_name = f"ix_{table.name}_{'_'.join(fields)}"
+					self.connection.execute(f"CREATE INDEX IF NOT EXISTS {index_name} ON {table.name} ({', '.join(fields)})")
+				for fields, order_by in SORTED_INDEXES.get(table, []):
+					index_name = f"ix_{table.name}_{'_'.join(fields)}_{order_by}"
+					self.connection.execute(
+						f"CREATE INDEX IF NOT EXISTS {index_name} ON {table.name} ({', '.join(fields)}, {order_by}, id)"
+					)
+
+	def _encode(self, table: Table, doc: Dict[str, Any]) -> Dict[str, Any]:
+		columns = SCHEMA[table]
+		rv = {}
+		for key, value in doc.items():
+			if key not in columns:
+				raise KeyError(f"{table.name} has no column {key}")
+			rv[key] = json.dumps(value) if columns[key] == JSON and value is not None else value
+		return rv
+
+	def _decode(self, table: Table, row: sqlite3.Row) -> Document:
+		columns = SCHEMA[table]
+		doc = {}
+		for key in columns:
+			value = row[key]
+			doc[key] = json.loads(value) if columns[key] == JSON and value is not None else value
+		return Document(doc, doc_id=row["id"])
+
+	def _where(self, table: Table, cond: Dict[str, Any]):
+		encoded = self._encode(table, cond)
+		clause = " AND ".join(f"{key} IS ?" for key in encoded) or "1"
+		return clause, list(encoded.values())
+
+	def _select(self, sql: str, params: Iterable[Any] = ()) -> List[sqlite3.Row]:
+		with self.lock:
+			cursor = self.connection.execute(sql, list(params))
+			cursor.row_factory = sqlite3.Row
+			return cursor.fetchall()
+
+	def insert(self, table: Table, doc: Dict[str, Any]) -> int:
+		encoded = self._encode(table, doc)
+		placeholders = ", ".join("?" for _ in encoded)
+		with self.lock:
+			cursor = self.connection.execute(
+				f"INSERT INTO {table.name} ({', '.join(encoded)}) VALUES ({placeholders})", list(encoded.values())
+			)
+		metrics.count(bytes_written=payload_bytes(encoded.values()))
+		return cursor.lastrowid # type: ignore
+
+	@contextlib.contextmanager
+	def transaction(self) -> Iterator[None]:
+		# BEGIN IMMEDIATE takes sqlite's write lock up front, so other processes wait instead of
+		# failing halfway through; `lock` keeps other threads' statements out of our transaction
+		with self.lock:
+			outermost = self.transaction_depth == 0
+			if outermost:
+				self.connection.execute("BEGIN IMMEDIATE")
+			self.transaction_depth += 1
+			try:
+				yield
+			except BaseException:
+				self.transaction_depth -= 1
+				if outermost:
+					self.connection.execute("ROLLBACK")
+				raise
+			self.transaction_depth -= 1
+			if outermost:
+				self.connection.execute("COMMIT")
+
+	def insert_documents(self, table: Table, docs: Iterable[Document]):
+		with self.transaction():
+			for doc in docs:
+				encoded = self._encode(table, doc)
+				encoded["id"] = doc.doc_id
+				placeholders = ", ".join("?" for _ in encoded)
+				self.connection.execute(
+					f"INSERT INTO {table.name} ({', '.join(encoded)}) VALUES ({placeholders})", list(encoded.values())
+				)
+				metrics.count(bytes_written=payload_bytes(encoded.values()))
+
+	def increment(self, table: Table, doc_id: int, field: str, delta: int, **fields: Any) -> Optional[int]:
+		encoded = self._encode(table, fields)
+		assignments = "".join(f", {key} = ?" for key in encoded)
+		with self.transaction():
+			self.connection.execute(
+				f"UPDATE {table.name} SET {field} = {field} + ?{assignments} WHERE id = ?", [delta, *encoded.values(), doc_id]
+			)
+			metrics.count(bytes_written=payload_bytes([delta, *encoded.values()]))
+			rows = self._select(f"SELECT {field} FROM {table.name} WHERE id = ?", [doc_id])
+			return rows[0][field] if rows else None
+
+	def append(self, table: Table, doc_id: int, field: str, value: Any):
+		with self.transaction():
+			cursor = self.connection.execute(
+				f"UPDATE {table.name} SET {field} = json_insert(COALESCE({field}, '[]'), '$[#]', json(?)) WHERE id = ?",
+				[json.dumps(value), doc_id]
+			)
+			if cursor.rowcount == 0:
+				raise KeyError(doc_id)
+			metrics.count(bytes_written=payload_bytes([json.dumps(value)]))
+
+	def get(self, table: Table, doc_id: int) -> Optional[Document]:
+		rows = self._select(f"SELECT * FROM {table.name} WHERE id = ?", [doc_id])
+		return self._decode(table, rows[0]) if rows else None
+
+	def get_many(self, table: Table, doc_ids: Iterable[int]) -> List[Document]:
+		doc_ids = sorted(set(doc_ids))
+		rv = []
+		for start in range(0, len(doc_ids), SQLITE_MAX_PARAMS):
+			chunk = doc_ids[start:start + SQLITE_MAX_PARAMS]
+			placeholders = ", ".join("?" for _ in chunk)
+			rows = self._select(f"SELECT * FROM {table.name} WHERE id IN ({placeholders}) ORDER BY id", chunk)
+			rv.extend(self._decode(table, r) for r in rows)
+		return rv
+
+	def search(self, table: Table, **fields: Any) -> List[Document]:
+		if not fields.keys() <= SCHEMA[table].keys(): # like tinydb, a missing field never matches
+			return []
+		if not any(index[0] in fields for index in INDEXES[table]):
+			metrics.count(scans=1)
+		clause, params = self._where(table, fields)
+		return [self._decode(table, r) for r in self._select(f"SELECT * FROM {table.name} WHERE {clause} ORDER BY id", params)]
+
+	def search_sorted(self, table: Table, order_by: str, limit: int, before: Optional[Tuple[Any, int]] = None,
+			**fields: Any) -> List[Document]:
+		if not fields.keys() <= SCHEMA[table].keys():
+			return []
+		clause, params = self._where(table, fields)
+		if before is not None:
+			clause += f" AND ({order_by}, id) < (?, ?)"
+			params += list(before)
+		rows = self._select(
+			f"SELECT * FROM {table.name} WHERE {clause} AND {order_by} IS NOT NULL ORDER BY {order_by} DESC, id DESC LIMIT ?",
+			params + [limit]
+		)
+		return [self._decode(table, r) for r in rows]
+
+	def all(self, table: Table) -> List[Document]:
+		metrics.count(scans=1)
+		return [self._decode(table, r) for r in self._select(f"SELECT * FROM {table.name} ORDER BY id")]
+
+	def since(self, table: Table, doc_id: int) -> List[Document]:
+		return [self._decode(table, r) for r in self._select(f"SELECT * FROM {table.name} WHERE id > ? ORDER BY id", [doc_id])]
+
+	def generation(self) -> Any:
+		return self._select("PRAGMA data_version")[0][0]
+
+	def count(self, table: Table) -> int:
+		return self._select(f"SELECT COUNT(*) AS n FROM {table.name}")[0]["n"]
+
+	def remove_below(self, table: Table, field: str, value: Any) -> int:
+		if field not in SCHEMA[table]:
+			return 0
+		with self.lock:
+			return self.connection.execute(f"DELETE FROM {table.name} WHERE {field} < ?", [value]).rowcount
+
+	def compact(self):
+		with self.lock:
+			self.connection.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+			free, total = self._select("PRAGMA freelist_count")[0][0], self._select("PRAGMA page_count")[0][0]
+			if free * 4 > total: # VACUUM rewrites the whole file, only worth it once a quarter is free
+				self.connection.execute("VACUUM")
+
+	def update(self, table: Table, fields: Dict[str, Any], doc_ids: List[int]):
+		encoded = self._encode(table, fields)
+		assignments = ", ".join(f"{key} = ?" for key in encoded)
+		with self.lock:
+			self.connection.executemany(
+				f"UPDATE {table.name} SET {assignments} WHERE id = ?", [list(encoded.values()) + [i] for i in doc_ids]
+			)
+		metrics.count(bytes_written=payload_bytes(encoded.values()) * len(doc_ids))
+
+	def update_where(self, table: Table, fields: Dict[str, Any], **cond: Any):
+		if not cond.keys() <= SCHEMA[table].keys():
+			return
+		encoded = self._encode(table, fields)
+		assignments = ", ".join(f"{key} = ?" for key in encoded)
+		clause, params = self._where(table, cond)
+		with self.lock:
+			cursor = self.connection.execute(f"UPDATE {table.name} SET {assignments} WHERE {clause}", list(encoded.values()) + params)
+		metrics.count(bytes_written=payload_bytes(encoded.values()) * max(cursor.rowcount, 0))
+
+	def remove(self, table: Table, doc_ids: List[int]):
+		with self.lock:
+			self.connection.executemany(f"DELETE FROM {table.name} WHERE id = ?", [[i] for i in doc_ids])
+
+	def close(self):
+		with self.lock:
+			self.connection.close()
+
+
+SQLITE_SUFFIXES = (".sqlite", ".sqlite3", ".db")
+SHARD_MAP_SUFFIX = ".shards.json"
+
+
+def open_storage(db_path: str, write_behind: Optional[WriteBehindConfig] = None, shared: bool = False) -> Storage:
+	if db_path.endswith(SHARD_MAP_SUFFIX):
+		from .shards import ShardMap, ShardedStorage # shards builds on this module
+		return ShardedStorage(ShardMap.load(db_path), write_behind=write_behind, shared=shared)
+	# sqlite is always safe to share between processes
+	if db_path.endswith(SQLITE_SUFFIXES):
+		return SQLiteStorage(db_path)
+	return TinyDBStorage(db_path, write_behind=write_behind, shared=shared)
@@ -0,0 +1,149 @@
+import atexit
+import json
+import os
+import threading
+from dataclasses import dataclass
+from typing import Any, Dict, List, Optional
+
+from tinydb.storages import Storage, touch
+
+from . import metrics
+from .snapshot import is_snapshot, read_snapshot, write_snapshot
+
+
+@dataclass(frozen=True)
+class WriteBehindConfig:
+	flush_interval: float = 1.0 # seconds between group commits
+	flush_bytes: int = 1 << 20 # flush early once this many journaled bytes are pending
+	journal: bool = True # fsync every mutation to `<path>.journal` before acknowledging it
+
+
+class WriteBehindStorage(Storage):
+	# tinydb storage that keeps the dataset in memory and writes it out in group commits.
+	# Mutations are recorded through `record()` (see `TinyDBStorage`), which appends them to the
+	# journal; on open the journal is replayed on top of the last snapshot.
+	def __init__(self, path: str, config: WriteBehindConfig = WriteBehindConfig(), lock: Optional[threading.RLock] = None) -> None:
+		self.path = path
+		self.config = config
+		self.lock = lock if lock is not None else threading.RLock()
+		self.journal_path = path + ".journal"
+		touch(path, create_dirs=False)
+		self.data: Optional[Dict[str, Any]] = self.load()
+		self.dirty = False
+		self.pending_bytes = 0
+		self.journal = None
+		if self.replay_journal():
+			self.flush()
+		if config.journal:
+			self.journal = open(self.journal_path, "a", encoding="utf-8")
+		self.wake = threading.Event()
+		self.closed = False
+		self.flusher = threading.Thread(target=self.flush_loop, name="write-behind", daemon=True)
+		self.flusher.start()
+		atexit.register(self.close)
+
+	def load(self) -> Optional[Dict[str, Any]]:
+		if is_snapshot(self.path):
+			return read_snapshot(self.path)
+		with open(self.path, encoding="utf-8") as f:
+			content = f.read()
+		return json.loads(content) if content.strip() else None
+
+	def replay_journal(self) -> bool:
+		if not os.path.exists(self.journal_path):
+			return False
+		replayed = False
+		with open(self.journal_path, encoding="utf-8") as f:
+			for line in f:
+				try:
+					entry = json.loads(line)
+				except ValueError: # torn last line, that write was never acknowledged
+					break
+				self.apply(entry)
+				replayed = True
+		return replayed
+
+	def apply(self, entry: Dict[str, Any]):
+		# journal entries carry resulting values, so replaying one twice is harmless
+		if entry["op"] == "batch":
+			for e in entry["entries"]:
+				self.apply(e)
+			return
+		if self.data is None:
+			self.data = {}
+		table = self.data.setdefault(entry["table"], {})
+		if entry["op"] == "insert":
+			table[str(entry["doc_id"])] = entry["doc"]
+		elif entry["op"] == "update":
+			for doc_id in entry["doc_ids"]:
+				if str(doc_id) in table:
+					table[str(doc_id)].update(entry["fields"])
+		elif entry["op"] == "remove":
+			for doc_id in entry["doc_ids"]:
+				table.pop(str(doc_id), None)
+		self.dirty = True
+
+	def read(self) -> Optional[Dict[str, Any]]:
+		return self.data
+
+	def write(self, data: Dict[str, Any]):
+		with self.lock:
+			self.data = data
+			self.dirty = True
+
+	def record(self, entry: Dict[str, Any]):
+		self.record_many([entry])
+
+	def record_many(self, entries: List[Dict[str, Any]]):
+		# one line, so a torn write loses all of them or none
+		entry = entries[0] if len(entries) == 1 else {"op": "batch", "entries": entries}
+		line = json.dumps(entry) + "\n"
+		with self.lock:
+			if self.journal is not None:
+				self.journal.write(line)
+				self.journal.flush()
+				os.fsync(self.journal.fileno())
+				metrics.count(bytes_written=len(line))
+			self.pending_bytes += len(line)
+			if self.pending_bytes >= self.config.flush_bytes:
+				self.wake.set()
+
+	def flush(self):
+		with self.lock:
+			if not self.dirty:
+				return
+			if is_snapshot(self.path):
+				metrics.count(bytes_written=write_snapshot(self.path, self.data or {}))
+			else:
+				tmp_path = self.path + ".tmp"
+				with open(tmp_path, "w", encoding="utf-8") as f:
+					json.dump(self.data or {}, f)
+					f.flush()
+					metrics.count(bytes_written=f.tell())
+					os.fsync(f.fileno())
+				os.replace(tmp_path, self.path)
+			if self.journal is not None:
+				self.journal.truncate(0)
+				self.journal.seek(0)
+			elif os.path.exists(self.journal_path):
+				os.remove(self.journal_path)
+			self.dirty = False
+			self.pending_bytes = 0
+
+	def flush_loop(self):
+		while not self.closed:
+			self.wake.wait(self.config.flush_interval)
+			self.wake.clear()
+			self.flush()
+
+	def close(self):
+		with self.lock:
+			if self.closed:
+				return
+			self.closed = True
+		self.wake.set()
+		self.flusher.join()
+		self.flush()
+		if self.journal is not None:
+			self.journal.close()
+		atexit.unregister(self.close)